@@ -0,0 +1,264 @@
+import sys
+import json
+import logging
+import argparse
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+# importing server loads the KBs from server_config.json, as under gunicorn
+import server
+from kb_utils import LLMQueueTimeout, Deadline, DeadlineExceeded, set_request_deadline
+from kb_utils import AdmissionRejected, get_bulkhead, bulkhead_context
+
+logger = logging.getLogger(__name__)
+
+# Async serving mode
+#
+# LLM endpoints (QA, PubMedQA, litsum) run as coroutines on one event loop per worker,
+# so slow generations are multiplexed instead of holding a worker thread each.
+# Every other endpoint is served by the Flask app in server.py through a WSGI adapter,
+# with the same behavior as before.
+#
+#     python asgi_server.py --port 12345
+#     gunicorn -k uvicorn.workers.UvicornWorker asgi_server:app
+
+
+async def set_deadline(request):
+    # the request task and the threads it starts all see this deadline
+    argument_timeout = request.query_params.get("request_timeout")
+    if argument_timeout is None and request.method == "POST":
+        argument_timeout = server.get_body_timeout(await request.body())
+    timeout = server.get_request_timeout(request.url.path, request.headers.get("X-Request-Timeout"), argument_timeout)
+    set_request_deadline(Deadline(timeout))
+    return
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        """
+        Admit each request through the bulkhead of its cost class, for async routes and the Flask app alike;
+        the slot is held until the response, streamed or not, has been sent
+        """
+        self.app = app
+        return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        bulkhead = get_bulkhead(server.get_cost_class(scope["path"]))
+        try:
+            await bulkhead.async_acquire()
+        except AdmissionRejected as e:
+            logger.info(f"[Admission] {scope['path']}: {e}")
+            response = Response(
+                json.dumps({"error": str(e)}), status_code=e.status, headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        # the Flask app runs in a thread that copies this context, so it does not admit the request again
+        token = bulkhead_context.set(bulkhead)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            bulkhead_context.reset(token)
+            bulkhead.release()
+        return
+
+
+async def get_query(request):
+    if request.method == "GET":
+        query = json.loads(request.query_params["query"])
+    else:
+        query = json.loads(await request.body())["query"]
+    return query
+
+
+async def run_qa(request):
+    await set_deadline(request)
+    query = await get_query(request)
+    logger.info(f"[run_qa:query] {query}")
+
+    # qa
+    d_set, g_set, v_set = await run_in_threadpool(server.get_qa_target_set, query)
+    question = query["question"]
+    answer_completion, p_set = await server.qa.async_query(question, d_set, g_set, v_set)
+
+    # reference
+    reference_line_list = await run_in_threadpool(server.get_qa_reference_line_list, p_set)
+
+    # the gpt_utils completion stream is synchronous, so StreamingResponse iterates it in the thread pool
+    return StreamingResponse(
+        server.get_qa_html_stream(answer_completion, reference_line_list),
+        media_type="text/html",
+    )
+
+
+async def query_qa(request):
+    await set_deadline(request)
+    response = {}
+
+    query = await get_query(request)
+    logger.info(f"[query_qa:query] {query}")
+
+    response["url_argument"] = {
+        "query": query,
+    }
+
+    # qa
+    d_set, g_set, v_set = await run_in_threadpool(server.get_qa_target_set, query, lower_variant_name=False)
+    question = query["question"]
+    answer_completion, p_set = await server.qa.async_query(question, d_set, g_set, v_set)
+    response["answer"] = await run_in_threadpool(server.get_qa_answer, answer_completion)
+    response["pmid_list"] = list(p_set)
+
+    return Response(json.dumps(response))
+
+
+async def run_pubmed_qa(request):
+    await set_deadline(request)
+    query = await get_query(request)
+    logger.info(f"[run_pubmed_qa:query] {query}")
+
+    text = query.get("query")
+    level = query.get("level", None)
+
+    if not query.get("stream", False):
+        response = await server.pubmed_qa.async_query(text, level=level, is_html=True)
+        return Response(json.dumps(response))
+
+    async def response():
+        async for event, data in server.pubmed_qa.async_query_stream(text, level=level):
+            yield server.get_pubmed_qa_html_chunk(event, data)
+        yield "</div>"
+        return
+
+    return StreamingResponse(response(), media_type="text/html")
+
+
+async def query_pubmed_qa(request):
+    await set_deadline(request)
+    query = await get_query(request)
+    logger.info(f"[query_pubmed_qa:query] {query}")
+
+    text = query.get("query")
+    level = query.get("level", None)
+
+    # identical concurrent questions share one retrieval and generation
+    single_flight = server.get_single_flight(request.url.path)
+    key = server.get_request_key(request.url.path, query)
+
+    if not server.is_ndjson_requested(query, request.headers.get("Accept")):
+        response = await single_flight.async_run(
+            key, lambda: server.pubmed_qa.async_query(text, level=level, is_html=False),
+        )
+        return Response(json.dumps(response))
+
+    async def response():
+        stream = single_flight.async_stream(
+            key, lambda: server.pubmed_qa.async_query_stream(text, level=level),
+            partial_chunk=("text", f"\n\n{server.partial_result_message}"),
+        )
+        async for event, data in stream:
+            yield server.get_pubmed_qa_ndjson_line(event, data)
+        return
+
+    return StreamingResponse(response(), media_type="application/x-ndjson")
+
+
+async def run_litsum(request):
+    await set_deadline(request)
+    data = json.loads(await request.body())
+    await run_in_threadpool(server.check_litsum_api_key, data.get("openai_api_key"))
+    server.gpt_utils.openai.api_key = data["openai_api_key"]
+    query = json.loads(data["query"])
+    logger.info(f"query={query}")
+
+    # PaperGPT and ReviewGPT are synchronous
+    result = await run_in_threadpool(
+        server.get_litsum_html, query["entity_1"], query["entity_2"], query["pmid_list"],
+    )
+    response = {"result": result}
+    return Response(json.dumps(response))
+
+
+async def query_litsum(request):
+    await set_deadline(request)
+    response = {}
+
+    await run_in_threadpool(server.check_litsum_api_key, request.query_params.get("openai_api_key"))
+    server.gpt_utils.openai.api_key = request.query_params.get("openai_api_key")
+
+    query = request.query_params.get("query")
+    response["url_argument"] = {
+        "query": query,
+        "openai_api_key": "yolo",
+    }
+    query = json.loads(query)
+    logger.info(f"query={query}")
+
+    paper_summary_list, review_summary = await run_in_threadpool(
+        server.get_litsum_summary, query["entity_1"], query["entity_2"], query["pmid_list"],
+    )
+    response["paper_summary_list"] = paper_summary_list
+    response["review_summary"] = review_summary
+    return Response(json.dumps(response))
+
+
+async def handle_llm_queue_timeout(request, e):
+    logger.info(f"[LLM Governor] {e}")
+    response = {"error": str(e)}
+    return Response(json.dumps(response), status_code=503, headers={"Retry-After": "10"})
+
+
+async def handle_invalid_api_key(request, e):
+    logger.info(f"[litsum] {e}")
+    response = {"error": str(e)}
+    return Response(json.dumps(response), status_code=401)
+
+
+async def handle_deadline_exceeded(request, e):
+    logger.info(f"[Deadline] {request.url.path}: {e}")
+    response = {"error": str(e)}
+    return Response(json.dumps(response), status_code=504)
+
+
+app = Starlette(middleware=[Middleware(AdmissionMiddleware)], exception_handlers={
+    LLMQueueTimeout: handle_llm_queue_timeout,
+    DeadlineExceeded: handle_deadline_exceeded,
+    server.InvalidAPIKey: handle_invalid_api_key,
+}, routes=[
+    Route("/run_qa", run_qa, methods=["GET", "POST"]),
+    Route("/query_qa", query_qa, methods=["GET", "POST"]),
+    Route("/run_pubmed_qa", run_pubmed_qa, methods=["GET", "POST"]),
+    Route("/query_pubmed_qa", query_pubmed_qa, methods=["GET", "POST"]),
+    Route("/run_litsum", run_litsum, methods=["POST"]),
+    Route("/query_litsum", query_litsum, methods=["GET"]),
+    Mount("/", WSGIMiddleware(server.app)),
+])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    arg = parser.parse_args()
+    for key, value in vars(arg).items():
+        if value is not None:
+            logger.info(f"[{key}] {value}")
+
+    uvicorn.run(app, host=arg.host, port=arg.port)
+    return
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import random
+import hashlib
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+
+from kb_utils import EmbeddingPaperRetriever, UMLSImpactEmbeddingPaperRetriever, PubMedQA
+from kb_utils import NumpyQdrantClient, make_synthetic_embedding_collection, build_local_embedding_store
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(process)d - %(name)s - %(message)s",
+    datefmt="%Y/%m/%d %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+class SyntheticQueryEmbedding:
+    def __init__(self, dimension, run_time=0.0):
+        # deterministic random vector per text; run_time simulates model latency
+        self.dimension = dimension
+        self.run_time = run_time
+        return
+
+    def embed_query(self, text_list, use_cache=True):
+        embedding_list = []
+        for text in text_list:
+            seed = int(hashlib.md5(text.encode("utf8")).hexdigest()[:8], 16)
+            embedding = np.random.default_rng(seed).standard_normal(self.dimension, dtype=np.float32)
+            embedding_list.append(embedding / np.linalg.norm(embedding))
+        time.sleep(self.run_time)
+        return np.stack(embedding_list)
+
+    def get_cache_stats(self):
+        return {"entries": 0, "max_entries": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+
+
+class SyntheticUMLSImpactPaperRetriever:
+    def __init__(self, pmid_list, run_time=0.0):
+        # deterministic random candidates per text; run_time simulates UMLS, BM25, and impact ranking
+        self.pmid_list = pmid_list
+        self.run_time = run_time
+        return
+
+    def query(self, text, case_sensitive=None, top_umls_pmids=None, top_combine_pmids=None):
+        if top_combine_pmids is None:
+            top_combine_pmids = 20
+        rng = random.Random(text)
+        pmid_list = rng.sample(self.pmid_list, min(top_combine_pmids, len(self.pmid_list)))
+        time.sleep(self.run_time)
+        return pmid_list
+
+
+class SyntheticPaperText:
+    def query(self, pmid):
+        return f"Title of {pmid}", f"Abstract of {pmid}."
+
+
+def get_latency_summary(latency_list):
+    latency_list = sorted(latency_list)
+    p50 = latency_list[len(latency_list) // 2] * 1000
+    p95 = latency_list[min(len(latency_list) - 1, int(len(latency_list) * 0.95))] * 1000
+    mean = sum(latency_list) / len(latency_list) * 1000
+    return f"p50={p50:.1f} ms, p95={p95:.1f} ms, mean={mean:.1f} ms"
+
+
+def run_benchmark(name, function, query_list):
+    # silence per-query logs of the retrievers while timing
+    kb_logger = logging.getLogger("kb_utils")
+    level = kb_logger.level
+    kb_logger.setLevel(logging.WARNING)
+
+    latency_list = []
+    for query in query_list:
+        start_time = time.time()
+        function(query)
+        latency_list.append(time.time() - start_time)
+
+    kb_logger.setLevel(level)
+    logger.info(f"[{name}] {len(query_list):,} queries: {get_latency_summary(latency_list)}")
+    return latency_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--papers", type=int, default=200000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--candidates", type=int, default=1000)
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--embedding_time", type=float, default=0.0)
+    parser.add_argument("--umls_impact_time", type=float, default=0.0)
+    parser.add_argument("--embedding_store_dir", type=str)
+    arg = parser.parse_args()
+    for key, value in vars(arg).items():
+        if value is not None:
+            logger.info(f"[{key}] {value}")
+
+    # synthetic collection behind an in-process qdrant stand-in
+    start_time = time.time()
+    pmid_list, embedding_matrix = make_synthetic_embedding_collection(arg.papers, dimension=arg.dimension)
+    qdrant_client = NumpyQdrantClient(pmid_list, embedding_matrix)
+    run_time = time.time() - start_time
+    logger.info(f"[Synthetic Collection] {arg.papers:,} x {arg.dimension:,} in {run_time:.1f} sec")
+
+    # local store exported from the same collection
+    embedding_store_dir = arg.embedding_store_dir
+    if embedding_store_dir is None:
+        embedding_store_dir = tempfile.mkdtemp(prefix="embedding_store_")
+    if not os.path.exists(os.path.join(embedding_store_dir, "embedding.npy")):
+        build_local_embedding_store(None, "synthetic", embedding_store_dir, qdrant_client=qdrant_client)
+
+    query_embedding = SyntheticQueryEmbedding(arg.dimension, run_time=arg.embedding_time)
+    umls_impact_paper_retriever = SyntheticUMLSImpactPaperRetriever(pmid_list, run_time=arg.umls_impact_time)
+    query_list = [f"synthetic query {qi}" for qi in range(arg.queries)]
+
+    for backend, store_dir in [("qdrant", None), ("local_store", embedding_store_dir)]:
+        embedding_paper_retriever = EmbeddingPaperRetriever(
+            None, None, "synthetic",
+            embedding_store_dir=store_dir, qdrant_client=qdrant_client,
+        )
+        embedding_paper_retriever.query_embedding = query_embedding
+        umls_impact_embedding_paper_retriever = UMLSImpactEmbeddingPaperRetriever(
+            umls_impact_paper_retriever, embedding_paper_retriever,
+        )
+        os.environ.setdefault("FEDGPT_BASE_URL", "http://127.0.0.1")
+        pubmed_qa = PubMedQA(umls_impact_embedding_paper_retriever, SyntheticPaperText())
+
+        def filtered_search(query):
+            candidate_pmid_list = umls_impact_paper_retriever.query(query, top_combine_pmids=arg.candidates)
+            return embedding_paper_retriever.query(query, filter_pmid_list=candidate_pmid_list, top_k=arg.top_k)
+
+        run_benchmark(f"{backend}: EmbeddingPaperRetriever.query", filtered_search, query_list)
+        run_benchmark(
+            f"{backend}: UMLSImpactEmbeddingPaperRetriever.query",
+            lambda query: umls_impact_embedding_paper_retriever.query(
+                query, top_umls_impact_pmids=arg.candidates, top_k=arg.top_k,
+            ),
+            query_list,
+        )
+        run_benchmark(f"{backend}: PubMedQA.get_paper_list", pubmed_qa.get_paper_list, query_list)
+    return
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -187,6 +187,34 @@ def run_litsum_test(server_path, client_path):
     return
 
 
+def run_name_to_id_alias_batch_test(server_path, client_path):
+    query = {
+        "query_list": ["BRAF", "V600E", "melanoma", "BRAF", "lung cancer"],
+        "case_sensitive": "N",
+        "max_length_diff": "1",
+        "min_similarity": "0.85",
+        "max_names": "5",
+        "max_aliases": "5",
+    }
+    logger.info("[Query]")
+    for key, value in query.items():
+        logger.info(f"[argument] {key}={value}")
+
+    # results are streamed as ndjson, one line per query
+    response = requests.post(server_path, data=json.dumps(query), stream=True)
+    result_list = []
+    for line in response.iter_lines():
+        if line:
+            result = json.loads(line)
+            logger.info(f"[Result] query={result['query']} names={len(result['match_list']):,}")
+            result_list.append(result)
+
+    os.makedirs(client_path, exist_ok=True)
+    result_file = os.path.join(client_path, "name_to_id_alias_batch.jsonl")
+    write_json(result_file, result_list, is_jsonl=True)
+    return
+
+
 def main():
     parser = argparse.ArgumentParser()
     # parser.add_argument("--server", default="https://lab5-k8s.corp.ailabs.tw/pubmedkb-api/rel")
@@ -198,6 +226,7 @@ def main():
             logger.info(f"[{key}] {value}")
 
     # run_rel_test(arg.server, arg.client)
+    # run_name_to_id_alias_batch_test(arg.server, arg.client)
     run_litsum_test(arg.server, arg.client)
     return
 
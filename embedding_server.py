@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import traceback
+import socketserver
+
+import numpy as np
+import torch
+
+from kb_utils import SnowflakeQueryEmbedding
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(process)d - %(name)s - %(message)s",
+    datefmt="%Y/%m/%d %H:%M:%S",
+    level=logging.INFO,
+)
+
+# one model copy for all server workers, see SocketQueryEmbedding in kb_utils
+query_embedding = None
+
+
+class EmbeddingRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One json line per request, on a connection kept open by the client
+
+    request: {"text_list": [text, ...]}, optionally "use_cache": false
+    response: {"shape": [texts, dimension]}\\n + float32 embedding bytes
+
+    request: {"op": "stats"}
+    response: cache stats json line
+
+    on failure: {"error": message}
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+
+                if request.get("op") == "stats":
+                    self.write_json(query_embedding.get_cache_stats())
+                    continue
+
+                # concurrent connections are micro-batched in SnowflakeQueryEmbedding
+                embedding = query_embedding.embed_query(request["text_list"], use_cache=request.get("use_cache", True))
+                embedding = np.ascontiguousarray(embedding, dtype=np.float32)
+                self.write_json({"shape": list(embedding.shape)})
+                self.wfile.write(embedding.tobytes())
+                self.wfile.flush()
+
+            except Exception as e:
+                traceback.print_exc()
+                self.write_json({"error": repr(e)})
+        return
+
+    def write_json(self, data):
+        self.wfile.write((json.dumps(data) + "\n").encode("utf8"))
+        self.wfile.flush()
+        return
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default="/tmp/pubmedkb_embedding.sock")
+    parser.add_argument("--backend", type=str, default="torch")
+    parser.add_argument("--onnx_file", type=str)
+    parser.add_argument("--max_length", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    arg = parser.parse_args()
+    for key, value in vars(arg).items():
+        if value is not None:
+            logger.info(f"[{key}] {value}")
+
+    # the only place where the number of inference threads is set
+    torch.set_num_threads(arg.threads)
+
+    global query_embedding
+    query_embedding = SnowflakeQueryEmbedding(
+        backend=arg.backend,
+        onnx_file=arg.onnx_file,
+        max_length=arg.max_length,
+    )
+
+    if os.path.exists(arg.socket):
+        os.remove(arg.socket)
+
+    with EmbeddingServer(arg.socket, EmbeddingRequestHandler) as server:
+        logger.info(f"[Embedding Server] listening on {arg.socket}")
+        server.serve_forever()
+    return
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
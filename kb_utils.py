@@ -2,27 +2,40 @@ import os
 import csv
 import sys
 import html
+import re
 import json
+import math
 import time
 import heapq
+import sqlite3
 import asyncio
+import hashlib
 import difflib
+import socket
+import weakref
 import logging
 import argparse
+import threading
 import traceback
+import contextvars
 import unicodedata
 import urllib.parse
-from collections import defaultdict
+from types import SimpleNamespace
+from collections import defaultdict, Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import dbm.gnu
+import httpx
+import numpy as np
 import requests
 import backoff
 import spacy
 import torch
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoConfig
 from qdrant_client import QdrantClient
 from qdrant_client.models import Filter, FieldCondition, MatchAny
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APITimeoutError
 
 try:
     from gpt_utils import async_run_qa, run_qa, run_qa_stream, run_qka_stream, run_pqa_stream
@@ -65,6 +78,7 @@ entity_type_to_real_type_mapping = {
         "Mutation",
     ],
 }
+nen_qgram_size = 3
 
 
 def read_lines(file, line_by_line=False, write_log=True):
@@ -163,6 +177,42 @@ class DiskDict:
         value = json.loads(value)
         return value
 
+    def get_many(self, key_list, default_value=None):
+        # read values in file order to keep disk access sequential
+        key_to_value = {}
+        offset_to_key = {}
+
+        for key in key_list:
+            offset = self.key_to_offset.get(key)
+            if offset is None:
+                key_to_value[key] = default_value
+            else:
+                offset_to_key[offset] = key
+
+        for offset in sorted(offset_to_key):
+            self.value_fp.seek(offset)
+            value = self.value_fp.readline()
+            key_to_value[offset_to_key[offset]] = json.loads(value)
+        return key_to_value
+
+
+def write_disk_dict(key_file, value_file, key_value_iterable):
+    logger.info(f"Writing {key_file}")
+    keys = 0
+    value_offset = 0
+
+    with open(key_file, "w", encoding="utf8") as kf, open(value_file, "w", encoding="utf8") as vf:
+        for key, value in key_value_iterable:
+            # json.dumps() escapes non-ASCII characters, so string length equals byte offset
+            value = json.dumps(value) + "\n"
+            vf.write(value)
+            kf.write(json.dumps([key, value_offset]) + "\n")
+            value_offset += len(value)
+            keys += 1
+
+    logger.info(f"Written {keys:,} keys")
+    return
+
 
 def intersection_of_key_to_set(dict_list):
     if len(dict_list) <= 1:
@@ -269,12 +319,180 @@ def filter_frequency(name_to_frequency, ratio=0):
     return result
 
 
+def get_qgram_list(text, q=nen_qgram_size):
+    """
+
+    :param text: str
+    :param q: int
+    :return: [(qgram, occurrence), ...]
+        occurrence numbers repeated q-grams, so that set intersection counts shared q-grams as a multiset
+    """
+    qgram_to_occurrences = defaultdict(lambda: 0)
+    qgram_list = []
+
+    for i in range(len(text) - q + 1):
+        qgram = text[i:i + q]
+        qgram_to_occurrences[qgram] += 1
+        qgram_list.append((qgram, qgram_to_occurrences[qgram]))
+    return qgram_list
+
+
+def get_min_shared_qgrams(length_a, length_b, min_similarity, q=nen_qgram_size):
+    """
+    Count filter for difflib.SequenceMatcher(a, b).ratio() >= min_similarity
+
+    ratio = 2M/T, where M is the total size of matching blocks and T = len(a) + len(b).
+    Consecutive matching blocks are separated by at least one unmatched character,
+    so there are at most (T - 2M + 1) blocks, each losing at most (q - 1) q-grams.
+    Hence a and b share at least M - (q - 1)(T - 2M + 1) q-grams.
+
+    :return: None if no b of length_b can reach min_similarity; otherwise the minimum number of shared q-grams
+    """
+    total_length = length_a + length_b
+    max_matches = min(length_a, length_b)
+
+    # smallest M with 2M/T >= min_similarity, using the same float expression as SequenceMatcher.ratio()
+    matches = max(0, math.ceil(min_similarity * total_length / 2))
+    while matches > 0 and 2.0 * (matches - 1) / total_length >= min_similarity:
+        matches -= 1
+    while matches <= max_matches and 2.0 * matches / total_length < min_similarity:
+        matches += 1
+    if matches > max_matches:
+        return None
+
+    min_shared_qgrams = matches - (q - 1) * (total_length - 2 * matches + 1)
+    return min_shared_qgrams
+
+
+def build_nen_qgram_index(data_dir):
+    """
+    Offline q-gram inverted index over length_name
+
+    key: (name_length, qgram, occurrence)
+    value: ascending indices of names in the length_name bucket
+
+    The lowercased index additionally keys (name_length, "", 0) to names whose lowercased length differs,
+    which are always returned as candidates.
+    """
+    k_file = os.path.join(data_dir, "length_name_key.jsonl")
+    v_file = os.path.join(data_dir, "length_name_value.jsonl")
+    length_name = DiskDict(k_file, v_file)
+    length_list = sorted(length_name.key_to_offset)
+
+    for index_name, case_sensitive in [("qgram_name", True), ("qgram_name_lower", False)]:
+        def get_key_value():
+            for name_length in length_list:
+                key_to_index_list = defaultdict(lambda: [])
+
+                for index, name in enumerate(length_name.get(name_length)):
+                    if not case_sensitive:
+                        name = name.lower()
+                        if len(name) != name_length:
+                            key_to_index_list[(name_length, "", 0)].append(index)
+                            continue
+                    for qgram, occurrence in get_qgram_list(name):
+                        key_to_index_list[(name_length, qgram, occurrence)].append(index)
+
+                for key, index_list in key_to_index_list.items():
+                    yield key, index_list
+            return
+
+        k_file = os.path.join(data_dir, f"{index_name}_key.jsonl")
+        v_file = os.path.join(data_dir, f"{index_name}_value.jsonl")
+        write_disk_dict(k_file, v_file, get_key_value())
+    return
+
+
+def build_nen_type_id_name_index(data_dir, max_aliases=100):
+    """
+    Offline composite-key indices over typeid_name_frequency, with umbrella types pre-merged
+
+    type_id_name_frequency_db.bin
+        key: [type, id, name], for real types and umbrella types
+        value: [[real_type, frequency], ...], in the order of entity_type_to_real_type_mapping
+
+    umbrella_type_id_alias_frequency_db.bin
+        key: [umbrella_type, id]
+        value: [[alias, frequency], ...], the top max_aliases aliases of all real types by frequency
+    """
+    k_file = os.path.join(data_dir, "typeid_name_frequency_key.jsonl")
+    v_file = os.path.join(data_dir, "typeid_name_frequency_value.jsonl")
+    typeid_name_frequency = DiskDict(k_file, v_file)
+
+    real_type_to_umbrella_type_index = {
+        real_type: (umbrella_type, type_index)
+        for umbrella_type, real_type_list in entity_type_to_real_type_mapping.items()
+        for type_index, real_type in enumerate(real_type_list)
+    }
+    umbrella_id_name_to_type_index_frequency = defaultdict(lambda: [])
+    umbrella_id_to_type_index_alias_frequency = defaultdict(lambda: [])
+
+    start_time = time.time()
+    db_file = os.path.join(data_dir, "type_id_name_frequency_db.bin")
+    db = dbm.gnu.open(db_file, "nf")
+
+    # real types
+    typeid_list = sorted(typeid_name_frequency.key_to_offset, key=lambda k: typeid_name_frequency.key_to_offset[k])
+    for typeid in typeid_list:
+        _type, _id = typeid.split("_", 1)
+        name_to_frequency = typeid_name_frequency.get(typeid)
+
+        for name, frequency in name_to_frequency.items():
+            db[json.dumps([_type, _id, name])] = json.dumps([[_type, frequency]])
+
+        if _type in real_type_to_umbrella_type_index:
+            umbrella_type, type_index = real_type_to_umbrella_type_index[_type]
+            for name, frequency in name_to_frequency.items():
+                umbrella_id_name_to_type_index_frequency[(umbrella_type, _id, name)].append(
+                    (type_index, _type, frequency)
+                )
+            umbrella_id_to_type_index_alias_frequency[(umbrella_type, _id)].append(
+                (type_index, list(name_to_frequency.items())[:max_aliases])
+            )
+
+    # umbrella types
+    for (umbrella_type, _id, name), type_index_frequency_list in umbrella_id_name_to_type_index_frequency.items():
+        type_frequency_list = [[_type, frequency] for _, _type, frequency in sorted(type_index_frequency_list)]
+        db[json.dumps([umbrella_type, _id, name])] = json.dumps(type_frequency_list)
+    db.close()
+
+    keys = len(typeid_list) + len(umbrella_id_name_to_type_index_frequency)
+    run_time = time.time() - start_time
+    logger.info(f"[NEN] wrote {db_file}: {keys:,} (type, id) groups in {run_time:.1f} sec")
+
+    start_time = time.time()
+    db_file = os.path.join(data_dir, "umbrella_type_id_alias_frequency_db.bin")
+    db = dbm.gnu.open(db_file, "nf")
+
+    for (umbrella_type, _id), type_index_alias_frequency_list in umbrella_id_to_type_index_alias_frequency.items():
+        # same as concatenating the alias lists of all real types in mapping order, then a stable sort by frequency
+        alias_frequency_list = [
+            alias_frequency
+            for _, alias_frequency_list in sorted(type_index_alias_frequency_list, key=lambda x: x[0])
+            for alias_frequency in alias_frequency_list
+        ]
+        alias_frequency_list = sorted(alias_frequency_list, key=lambda af: -af[1])[:max_aliases]
+        db[json.dumps([umbrella_type, _id])] = json.dumps(alias_frequency_list)
+    db.close()
+
+    keys = len(umbrella_id_to_type_index_alias_frequency)
+    run_time = time.time() - start_time
+    logger.info(f"[NEN] wrote {db_file}: {keys:,} keys in {run_time:.1f} sec")
+    return
+
+
 class NEN:
     def __init__(self, data_dir):
         self.typeid_name_frequency = None
         self.typeid_to_most_frequent_name = None
         self.name_type_id_frequency = None
-        self.length_name = None
+        self.length_to_name_list = {}
+        self.length_to_name_lower_list = {}
+        self.qgram_name = None
+        self.qgram_name_lower = None
+        self.type_id_name_frequency_db = None
+        self.umbrella_type_id_alias_frequency_db = None
+        self.umbrella_max_aliases = 100
 
         if data_dir:
             k_file = os.path.join(data_dir, "typeid_name_frequency_key.jsonl")
@@ -290,9 +508,84 @@ class NEN:
 
             k_file = os.path.join(data_dir, "length_name_key.jsonl")
             v_file = os.path.join(data_dir, "length_name_value.jsonl")
-            self.length_name = DiskDict(k_file, v_file)
+            self.load_length_name(k_file, v_file)
+
+            # optional q-gram index, see build_nen_qgram_index()
+            k_file = os.path.join(data_dir, "qgram_name_key.jsonl")
+            v_file = os.path.join(data_dir, "qgram_name_value.jsonl")
+            if os.path.exists(k_file):
+                self.qgram_name = DiskDict(k_file, v_file, key_process=tuple)
+
+            k_file = os.path.join(data_dir, "qgram_name_lower_key.jsonl")
+            v_file = os.path.join(data_dir, "qgram_name_lower_value.jsonl")
+            if os.path.exists(k_file):
+                self.qgram_name_lower = DiskDict(k_file, v_file, key_process=tuple)
+
+            # optional composite-key indices, see build_nen_type_id_name_index()
+            db_file = os.path.join(data_dir, "type_id_name_frequency_db.bin")
+            if os.path.exists(db_file):
+                self.type_id_name_frequency_db = dbm.gnu.open(db_file, "r")
+
+            db_file = os.path.join(data_dir, "umbrella_type_id_alias_frequency_db.bin")
+            if os.path.exists(db_file):
+                self.umbrella_type_id_alias_frequency_db = dbm.gnu.open(db_file, "r")
+        return
+
+    def load_length_name(self, key_file, value_file):
+        """
+        Hold all length buckets in memory, each as a tuple of names and a tuple of their lowercased forms,
+        so that fuzzy matching neither decodes buckets nor lowercases names per request.
+        """
+        length_name = DiskDict(key_file, value_file)
+        names = 0
+
+        for name_length in length_name.key_to_offset:
+            name_list = length_name.get(name_length)
+            name_lower_list = []
+            for name in name_list:
+                name_lower = name.lower()
+                # share the string object when lowercasing does not change the name
+                name_lower_list.append(name if name_lower == name else name_lower)
+            self.length_to_name_list[name_length] = tuple(name_list)
+            self.length_to_name_lower_list[name_length] = tuple(name_lower_list)
+            names += len(name_list)
+
+        length_name.value_fp.close()
+        lengths = len(self.length_to_name_list)
+        logger.info(f"[NEN] loaded {names:,} names in {lengths:,} length buckets")
         return
 
+    def get_candidate_index_list(self, matcher_text, name_length, case_sensitive, min_similarity):
+        """
+
+        :return: None if the whole length_name bucket needs to be scanned;
+            otherwise ascending indices of names in the bucket that pass the q-gram count filter
+        """
+        qgram_name = self.qgram_name if case_sensitive else self.qgram_name_lower
+        if qgram_name is None:
+            return None
+
+        min_shared_qgrams = get_min_shared_qgrams(len(matcher_text), name_length, min_similarity)
+        if min_shared_qgrams is None:
+            index_set = set()
+        elif min_shared_qgrams <= 0:
+            return None
+        else:
+            index_to_shared_qgrams = Counter()
+            for qgram, occurrence in get_qgram_list(matcher_text):
+                index_to_shared_qgrams.update(qgram_name.get((name_length, qgram, occurrence), []))
+            index_set = set(
+                index
+                for index, shared_qgrams in index_to_shared_qgrams.items()
+                if shared_qgrams >= min_shared_qgrams
+            )
+
+        # names whose lowercased length differs from the bucket length are not indexed
+        for index in qgram_name.get((name_length, "", 0), []):
+            index_set.add(index)
+
+        return sorted(index_set)
+
     def get_names_by_query(self, query, case_sensitive=False, max_length_diff=1, min_similarity=0.85, max_names=20):
         # exact match
         exact_match_list = [(query, 1.0)] if self.name_type_id_frequency.get(query) else []
@@ -301,16 +594,14 @@ class NEN:
         max_non_exact_matches = max_names - len(exact_match_list)
 
         # set up matcher
+        matcher_text = query if case_sensitive else query.lower()
         if min_similarity == 1:
             if case_sensitive:
                 return exact_match_list
             else:
-                matcher = query.lower()
+                matcher = matcher_text
         else:
-            if case_sensitive:
-                matcher = difflib.SequenceMatcher(a=query, autojunk=False)
-            else:
-                matcher = difflib.SequenceMatcher(a=query.lower(), autojunk=False)
+            matcher = difflib.SequenceMatcher(a=matcher_text, autojunk=False)
 
         query_length = len(query)
         name_to_similarity = {}
@@ -331,7 +622,21 @@ class NEN:
                     sign_string = f" ({query_length}-{length_diff})"
                 logger.info(f"[{query}]: searching names with length {name_length}{sign_string} ...")
 
-                for name in self.length_name.get(name_length, []):
+                name_list = self.length_to_name_list.get(name_length, ())
+                if case_sensitive:
+                    matcher_name_list = name_list
+                else:
+                    matcher_name_list = self.length_to_name_lower_list.get(name_length, ())
+
+                index_list = self.get_candidate_index_list(matcher_text, name_length, case_sensitive, min_similarity)
+                if index_list is None:
+                    index_list = range(len(name_list))
+                else:
+                    logger.info(f"[{query}]: {len(index_list):,}/{len(name_list):,} candidates by q-gram count filter")
+
+                for index in index_list:
+                    name = name_list[index]
+
                     # skip exact match
                     if name == query:
                         continue
@@ -339,12 +644,9 @@ class NEN:
                     # compute similarity
                     if min_similarity == 1:
                         # must be case-insensitive
-                        similarity = 1 if name.lower() == matcher else 0
+                        similarity = 1 if matcher_name_list[index] == matcher else 0
                     else:
-                        if case_sensitive:
-                            matcher.set_seq2(name)
-                        else:
-                            matcher.set_seq2(name.lower())
+                        matcher.set_seq2(matcher_name_list[index])
                         similarity = matcher.ratio()
 
                     if similarity >= min_similarity:
@@ -362,27 +664,119 @@ class NEN:
         name_similarity_list = exact_match_list + name_similarity_list
         return name_similarity_list
 
-    def get_ids_by_name(self, name):
+    @staticmethod
+    def get_type_id_frequency_list(type_id_frequency):
         type_id_frequency_list = [
             [_type, _id, frequency]
-            for _type, id_to_frequency in self.name_type_id_frequency.get(name, {}).items()
+            for _type, id_to_frequency in type_id_frequency.items()
             for _id, frequency in id_to_frequency.items()
         ]
         type_id_frequency_list = sorted(type_id_frequency_list, key=lambda x: x[2], reverse=True)
         return type_id_frequency_list
 
-    def get_aliases_by_id(self, _type, _id, max_aliases=20):
+    @staticmethod
+    def get_alias_frequency_list(alias_frequency, max_aliases):
         alias_frequency_list = [
             [alias, frequency]
-            for alias, frequency in self.typeid_name_frequency.get(f"{_type}_{_id}", {}).items()
+            for alias, frequency in alias_frequency.items()
         ]
         alias_frequency_list = alias_frequency_list[:max_aliases]
         return alias_frequency_list
 
+    def get_ids_by_name(self, name):
+        return self.get_type_id_frequency_list(self.name_type_id_frequency.get(name, {}))
+
+    def get_aliases_by_id(self, _type, _id, max_aliases=20):
+        return self.get_alias_frequency_list(self.typeid_name_frequency.get(f"{_type}_{_id}", {}), max_aliases)
+
+    def resolve_many(
+            self, query_list,
+            case_sensitive=False, max_length_diff=1, min_similarity=0.85, max_names=20, max_aliases=20,
+    ):
+        """
+
+        :param query_list: [query: str, ...]
+        :return: generator of (
+            query,
+            [(name, similarity, [(type, id, type_id_name_frequency, alias_frequency_list), ...]), ...],
+        ), in the order of query_list
+            each result is yielded as soon as its query is resolved
+            repeated queries, names, and (type, id) pairs are looked up only once
+        """
+        query_to_match_list = {}
+        name_to_type_id_frequency_list = {}
+        typeid_to_alias_frequency_list = {}
+
+        for query in query_list:
+            if query in query_to_match_list:
+                yield query, query_to_match_list[query]
+                continue
+
+            name_similarity_list = self.get_names_by_query(
+                query,
+                case_sensitive=case_sensitive,
+                max_length_diff=max_length_diff,
+                min_similarity=min_similarity,
+                max_names=max_names,
+            )
+
+            # ids: one bulk lookup for all unseen names
+            name_list = [
+                name
+                for name, _similarity in name_similarity_list
+                if name not in name_to_type_id_frequency_list
+            ]
+            for name, type_id_frequency in self.name_type_id_frequency.get_many(name_list, {}).items():
+                name_to_type_id_frequency_list[name] = self.get_type_id_frequency_list(type_id_frequency)
+
+            # aliases: one bulk lookup for all unseen (type, id) pairs
+            typeid_list = [
+                f"{_type}_{_id}"
+                for name, _similarity in name_similarity_list
+                for _type, _id, _frequency in name_to_type_id_frequency_list[name]
+                if f"{_type}_{_id}" not in typeid_to_alias_frequency_list
+            ]
+            for typeid, alias_frequency in self.typeid_name_frequency.get_many(typeid_list, {}).items():
+                typeid_to_alias_frequency_list[typeid] = self.get_alias_frequency_list(alias_frequency, max_aliases)
+
+            match_list = [
+                (
+                    name,
+                    similarity,
+                    [
+                        (_type, _id, frequency, typeid_to_alias_frequency_list[f"{_type}_{_id}"])
+                        for _type, _id, frequency in name_to_type_id_frequency_list[name]
+                    ],
+                )
+                for name, similarity in name_similarity_list
+            ]
+            query_to_match_list[query] = match_list
+            yield query, match_list
+        return
+
     def get_most_frequent_name_by_id(self, _type, _id):
         return self.typeid_to_most_frequent_name.get(f"{_type}_{_id}")
 
+    def get_aliases_by_umbrella_id(self, _type, _id, max_aliases=20):
+        # umbrella types: one lookup in the pre-merged index
+        if _type in entity_type_to_real_type_mapping \
+                and self.umbrella_type_id_alias_frequency_db is not None \
+                and max_aliases <= self.umbrella_max_aliases:
+            alias_frequency_list = self.umbrella_type_id_alias_frequency_db.get(json.dumps([_type, _id]))
+            alias_frequency_list = json.loads(alias_frequency_list) if alias_frequency_list else []
+            return alias_frequency_list[:max_aliases]
+
+        # expand the umbrella type to real types
+        alias_frequency_list = []
+        for real_type in entity_type_to_real_type_mapping.get(_type, [_type]):
+            alias_frequency_list += self.get_aliases_by_id(real_type, _id, max_aliases=max_aliases)
+        alias_frequency_list = sorted(alias_frequency_list, key=lambda af: -af[1])[:max_aliases]
+        return alias_frequency_list
+
     def get_variant_in_kb(self, id_list, name_list):
+        if self.type_id_name_frequency_db is not None:
+            return self.get_variant_in_kb_by_index(id_list, name_list)
+
         type_id_name_frequency = []
 
         for _type in entity_type_to_real_type_mapping["VARIANT"]:
@@ -395,6 +789,24 @@ class NEN:
         type_id_name_frequency = sorted(type_id_name_frequency, key=lambda tidf: tidf[3], reverse=True)
         return type_id_name_frequency
 
+    def get_variant_in_kb_by_index(self, id_list, name_list):
+        type_to_index = {_type: ti for ti, _type in enumerate(entity_type_to_real_type_mapping["VARIANT"])}
+        key_type_id_name_frequency = []
+
+        for ii, _id in enumerate(id_list):
+            for ni, name in enumerate(name_list):
+                type_frequency_list = self.type_id_name_frequency_db.get(json.dumps(["VARIANT", _id, name]))
+                if not type_frequency_list:
+                    continue
+                for _type, frequency in json.loads(type_frequency_list):
+                    key = (-frequency, type_to_index[_type], ii, ni)
+                    key_type_id_name_frequency.append((key, (_type, _id, name, frequency)))
+
+        # same order as the (type, id, name) loop in get_variant_in_kb() followed by a stable sort by frequency
+        key_type_id_name_frequency = sorted(key_type_id_name_frequency, key=lambda x: x[0])
+        type_id_name_frequency = [tidf for _key, tidf in key_type_id_name_frequency]
+        return type_id_name_frequency
+
 
 class V2G:
     def __init__(self, variant_dir, gene_dir):
@@ -1004,14 +1416,20 @@ class UMLSImpactPaperRetriever:
             top_combine_pmids = 20
 
         # UMLS: search by text and retrieved ranked PMIDs
+        start_time = time.time()
         umls_pmid_list = self.umls_paper_retriever.query_by_text(
             text,
             case_sensitive=case_sensitive,
             top_k=top_umls_pmids,
         )
+        umls_time = time.time() - start_time
 
         # paper impact: rank PMIDs by paper impact
+        get_request_deadline().check("paper impact ranking")
+        start_time = time.time()
         impact_pmid_list = self.paper_impact_retriever.query(umls_pmid_list)
+        impact_time = time.time() - start_time
+        logger.info(f"[UMLS Impact Paper Retriever] umls={umls_time:.3f} sec, impact={impact_time:.3f} sec")
 
         # calculate combined score using both UMLS and impact rankings
         pmid_to_score = {
@@ -1034,27 +1452,128 @@ class UMLSImpactPaperRetriever:
 
 
 class TransformersEmbedding:
-    def __init__(self, model, max_length=None):
+    def __init__(self, model, max_length=None, backend="torch", onnx_file=None, batch_size=32, max_batch_tokens=16384):
+        """
+
+        :param backend: "torch" / "torch-int8" / "onnx"
+            torch-int8: linear layers dynamically quantized to int8, CPU only
+            onnx: ONNX Runtime on CPU, onnx_file is exported from the torch model if it does not exist
+        :param batch_size: max texts in a forward pass
+        :param max_batch_tokens: max padded tokens in a forward pass, except for a single longer text
+        """
         self.tokenizer = AutoTokenizer.from_pretrained(model)
-        self.model = AutoModel.from_pretrained(model, add_pooling_layer=False)
+        self.dim = AutoConfig.from_pretrained(model).hidden_size
         self.max_length = max_length
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.backend = backend
+        self.model = None
+        self.onnx_session = None
+
+        if backend == "onnx":
+            if onnx_file is None:
+                raise ValueError("TransformersEmbedding: backend=\"onnx\" requires onnx_file")
+            import onnxruntime
+            if not os.path.exists(onnx_file):
+                self.export_onnx(model, onnx_file)
+            self.device = "cpu"
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = torch.get_num_threads()
+            self.onnx_session = onnxruntime.InferenceSession(
+                onnx_file, sess_options=session_options, providers=["CPUExecutionProvider"],
+            )
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model.to(self.device)
-        logger.info(f"[TransformersEmbedding] using {self.device}")
+        else:
+            self.model = AutoModel.from_pretrained(model, add_pooling_layer=False)
+            self.model.eval()
+
+            if backend == "torch":
+                self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            elif backend == "torch-int8":
+                self.device = "cpu"
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            else:
+                assert False
+            self.model.to(self.device)
 
-        self.model.eval()
+        logger.info(f"[TransformersEmbedding] using {self.backend} on {self.device}")
         return
 
-    def embed(self, text_list):
-        # encoded_input: pytorch tensor of token ids
-        encoded_input = self.tokenizer(
-            text_list,
-            max_length=self.max_length,
-            truncation=True,
-            padding=True,
-            return_tensors="pt",
+    def export_onnx(self, model, onnx_file):
+        logger.info(f"[TransformersEmbedding] exporting {model} to {onnx_file}")
+        start_time = time.time()
+
+        torch_model = AutoModel.from_pretrained(model, add_pooling_layer=False)
+        torch_model.eval()
+        encoded_input = self.tokenizer(["query: export"], return_tensors="pt")
+
+        torch.onnx.export(
+            torch_model,
+            (encoded_input["input_ids"], encoded_input["attention_mask"]),
+            onnx_file,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=17,
         )
+        del torch_model
+
+        run_time = time.time() - start_time
+        logger.info(f"[TransformersEmbedding] exported in {run_time:.1f} sec")
+        return
+
+    def embed(self, text_list, max_length=None):
+        if max_length is None:
+            max_length = self.max_length
+        if not text_list:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        # token ids without padding
+        input_ids_list = self.tokenizer(text_list, max_length=max_length, truncation=True)["input_ids"]
+
+        # run length-homogeneous sub-batches, so that padding follows real token counts
+        embedding = None
+        for batch_index_list in self.get_length_batch_list(input_ids_list):
+            encoded_input = self.tokenizer.pad(
+                {"input_ids": [input_ids_list[i] for i in batch_index_list]},
+                return_tensors="np" if self.backend == "onnx" else "pt",
+            )
+            if self.backend == "onnx":
+                batch_embedding = self.embed_onnx(encoded_input)
+            else:
+                batch_embedding = self.embed_torch(encoded_input)
+
+            # restore the original order
+            if embedding is None:
+                embedding = np.zeros((len(text_list), batch_embedding.shape[1]), dtype=batch_embedding.dtype)
+            embedding[batch_index_list] = batch_embedding
+        return embedding
+
+    def get_length_batch_list(self, input_ids_list):
+        index_list = sorted(range(len(input_ids_list)), key=lambda i: len(input_ids_list[i]))
+        batch_index_list_list = []
+        batch_index_list = []
+
+        for i in index_list:
+            # lengths are ascending, so the current length is the padded length of the batch
+            padded_tokens = (len(batch_index_list) + 1) * len(input_ids_list[i])
+            if batch_index_list and (
+                    len(batch_index_list) >= self.batch_size or padded_tokens > self.max_batch_tokens
+            ):
+                batch_index_list_list.append(batch_index_list)
+                batch_index_list = []
+            batch_index_list.append(i)
+
+        if batch_index_list:
+            batch_index_list_list.append(batch_index_list)
+        return batch_index_list_list
+
+    def embed_torch(self, encoded_input):
+        # encoded_input: pytorch tensor of token ids
         if self.device == "cuda":
             encoded_input = encoded_input.to(self.device)
 
@@ -1072,51 +1591,491 @@ class TransformersEmbedding:
             embedding = embedding.numpy()
         return embedding
 
+    def embed_onnx(self, encoded_input):
+        # encoded_input: numpy array of token ids
+        model_output = self.onnx_session.run(
+            ["last_hidden_state"],
+            {
+                "input_ids": encoded_input["input_ids"].astype(np.int64),
+                "attention_mask": encoded_input["attention_mask"].astype(np.int64),
+            },
+        )
+
+        # CLS of last hidden state, L2 normalized
+        embedding = model_output[0][:, 0]
+        norm = np.linalg.norm(embedding, ord=2, axis=1, keepdims=True)
+        embedding = embedding / np.maximum(norm, 1e-12)
+        return embedding
+
 
 class SnowflakeQueryEmbedding:
-    def __init__(self):
+    def __init__(
+            self, backend="torch", onnx_file=None, max_length=512,
+            cache_size=10000, batch_window=0.005, max_batch_size=16,
+    ):
+        # queries are short, so max_length is much less than the 8192 tokens of the model
         self.embedding = TransformersEmbedding(
             "Snowflake/snowflake-arctic-embed-l-v2.0",
-            max_length=8192,
+            max_length=max_length,
+            backend=backend,
+            onnx_file=onnx_file,
+        )
+
+        # LRU cache: normalized text -> embedding
+        self.cache_size = cache_size
+        self.text_to_embedding = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # micro-batcher: texts from concurrent calls within batch_window are embedded in one forward pass
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.batch_condition = threading.Condition()
+        self.pending_text_future_list = []
+        self.batch_thread = None
+        return
+
+    @staticmethod
+    def normalize_text(text):
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    def embed_query(self, text_list, use_cache=True):
+        text_list = [self.normalize_text(text) for text in text_list]
+        if not use_cache:
+            # e.g., health probes, which should neither evict real queries nor count as lookups
+            text_future_list = [(text, Future()) for text in dict.fromkeys(text_list)]
+            self.submit_batch(text_future_list)
+            text_to_embedding = {text: future.result() for text, future in text_future_list}
+            return np.stack([text_to_embedding[text] for text in text_list])
+
+        text_to_embedding = {}
+        text_to_future = {}
+
+        with self.cache_lock:
+            for text in text_list:
+                if text in text_to_embedding or text in text_to_future:
+                    continue
+                embedding = self.text_to_embedding.get(text)
+                if embedding is None:
+                    self.cache_misses += 1
+                    text_to_future[text] = Future()
+                else:
+                    self.cache_hits += 1
+                    self.text_to_embedding.move_to_end(text)
+                    text_to_embedding[text] = embedding
+
+        if text_to_future:
+            self.submit_batch(list(text_to_future.items()))
+            for text, future in text_to_future.items():
+                text_to_embedding[text] = future.result()
+
+            with self.cache_lock:
+                for text in text_to_future:
+                    self.text_to_embedding[text] = text_to_embedding[text]
+                    self.text_to_embedding.move_to_end(text)
+                while len(self.text_to_embedding) > self.cache_size:
+                    self.text_to_embedding.popitem(last=False)
+
+        embedding = np.stack([text_to_embedding[text] for text in text_list])
+        return embedding
+
+    def get_cache_stats(self):
+        with self.cache_lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "entries": len(self.text_to_embedding),
+                "max_entries": self.cache_size,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            }
+
+    def submit_batch(self, text_future_list):
+        with self.batch_condition:
+            # started lazily so that the thread lives in the process that serves requests, e.g., after a fork
+            if self.batch_thread is None or not self.batch_thread.is_alive():
+                self.batch_thread = threading.Thread(target=self.run_batch_loop, daemon=True)
+                self.batch_thread.start()
+            self.pending_text_future_list.extend(text_future_list)
+            self.batch_condition.notify()
+        return
+
+    def run_batch_loop(self):
+        while True:
+            with self.batch_condition:
+                while not self.pending_text_future_list:
+                    self.batch_condition.wait()
+
+                # wait for concurrent calls, up to batch_window or max_batch_size
+                deadline = time.time() + self.batch_window
+                while len(self.pending_text_future_list) < self.max_batch_size:
+                    remaining_time = deadline - time.time()
+                    if remaining_time <= 0:
+                        break
+                    self.batch_condition.wait(remaining_time)
+
+                text_future_list = self.pending_text_future_list[:self.max_batch_size]
+                self.pending_text_future_list = self.pending_text_future_list[self.max_batch_size:]
+
+            # the same text may be pending from several calls
+            text_to_future_list = defaultdict(lambda: [])
+            for text, future in text_future_list:
+                text_to_future_list[text].append(future)
+            batch_text_list = list(text_to_future_list)
+
+            try:
+                start_time = time.time()
+                embedding = self.embedding.embed([f"query: {text}" for text in batch_text_list])
+                run_time = time.time() - start_time
+                texts = len(batch_text_list)
+                calls = len(text_future_list)
+                logger.info(f"[SnowflakeQueryEmbedding] embedded {texts:,} texts for {calls:,} calls in {run_time:.2f} sec")
+                for text, vector in zip(batch_text_list, embedding):
+                    for future in text_to_future_list[text]:
+                        future.set_result(vector)
+            except Exception as e:
+                traceback.print_exc()
+                for _text, future in text_future_list:
+                    future.set_exception(e)
+
+
+class SocketQueryEmbedding:
+    def __init__(self, socket_file, time_out=300):
+        # the model lives in embedding_server.py; each thread keeps its own connection
+        self.socket_file = socket_file
+        self.time_out = time_out
+        self.local = threading.local()
+        return
+
+    def get_connection(self):
+        if getattr(self.local, "fp", None) is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.time_out)
+            connection.connect(self.socket_file)
+            self.local.connection = connection
+            self.local.fp = connection.makefile("rwb")
+        return self.local.fp
+
+    def close_connection(self):
+        try:
+            self.local.fp.close()
+            self.local.connection.close()
+        except Exception:
+            pass
+        self.local.fp = None
+        self.local.connection = None
+        return
+
+    def request(self, request):
+        # retry once on a new connection, e.g., after the embedding server restarted
+        for attempt in range(2):
+            try:
+                fp = self.get_connection()
+                fp.write((json.dumps(request) + "\n").encode("utf8"))
+                fp.flush()
+                response = fp.readline()
+                if not response:
+                    raise ConnectionError("embedding server closed the connection")
+                response = json.loads(response)
+                break
+            except OSError:
+                self.close_connection()
+                if attempt > 0:
+                    raise
+            except Exception:
+                self.close_connection()
+                raise
+
+        # the stream position is unknown after a server error, so the connection is not reused
+        if "error" in response:
+            self.close_connection()
+            raise RuntimeError(f"embedding server: {response['error']}")
+        return fp, response
+
+    def embed_query(self, text_list, use_cache=True):
+        request = {"text_list": text_list}
+        if not use_cache:
+            request["use_cache"] = False
+        fp, header = self.request(request)
+        texts, dimension = header["shape"]
+        size = texts * dimension * 4
+
+        # a payload read cut short leaves unread bytes that the next request would parse as its header
+        try:
+            data = fp.read(size)
+            if len(data) != size:
+                raise ConnectionError(f"embedding server sent {len(data):,} of {size:,} embedding bytes")
+        except Exception:
+            self.close_connection()
+            raise
+
+        embedding = np.frombuffer(data, dtype=np.float32).reshape(texts, dimension)
+        return embedding
+
+    def get_cache_stats(self):
+        _fp, cache_stats = self.request({"op": "stats"})
+        return cache_stats
+
+
+class LocalEmbeddingStore:
+    def __init__(self, data_dir):
+        """
+        Paper embeddings sorted by pmid, memory-mapped so that only the rows of queried pmids are read
+
+        pmid.npy: int64 [papers]
+        embedding.npy: float16 [papers, dimension]
+        """
+        self.data_dir = data_dir
+        self.pmid_array = None
+        self.embedding_matrix = None
+
+        if data_dir:
+            self.load_data()
+        return
+
+    def load_data(self):
+        start_time = time.time()
+        self.pmid_array = np.load(os.path.join(self.data_dir, "pmid.npy"), mmap_mode="r")
+        self.embedding_matrix = np.load(os.path.join(self.data_dir, "embedding.npy"), mmap_mode="r")
+        run_time = time.time() - start_time
+        papers, dimension = self.embedding_matrix.shape
+        logger.info(f"[Local Embedding Store] mapped {papers:,} x {dimension:,} embeddings in {run_time:.1f} sec")
+        return
+
+    def query(self, query_vector, pmid_list, top_k):
+        # pmid -> row, for pmids in the store
+        pmid_array = np.unique(np.array([int(pmid) for pmid in pmid_list if pmid.isdigit()], dtype=np.int64))
+        row_array = np.searchsorted(self.pmid_array, pmid_array)
+        row_array = np.minimum(row_array, len(self.pmid_array) - 1)
+        found = self.pmid_array[row_array] == pmid_array
+        pmid_array, row_array = pmid_array[found], row_array[found]
+        if len(pmid_array) == 0:
+            return []
+
+        # gather rows, then cosine similarity of normalized embeddings
+        candidate_matrix = self.embedding_matrix[row_array].astype(np.float32)
+        score_array = candidate_matrix @ np.asarray(query_vector, dtype=np.float32)
+
+        if top_k < len(score_array):
+            index_array = np.argpartition(-score_array, top_k)[:top_k]
+        else:
+            index_array = np.arange(len(score_array))
+        index_array = index_array[np.argsort(-score_array[index_array], kind="stable")]
+        retrieved_pmid_list = [str(pmid) for pmid in pmid_array[index_array]]
+        return retrieved_pmid_list
+
+
+def build_local_embedding_store(qdrant_server, qdrant_collection, data_dir, batch_size=1000, qdrant_client=None):
+    """
+    Offline export of a qdrant collection of paper embeddings into LocalEmbeddingStore files
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    if qdrant_client is None:
+        qdrant_client = QdrantClient(qdrant_server, timeout=300)
+    points = qdrant_client.count(collection_name=qdrant_collection, exact=True).count
+    logger.info(f"[Local Embedding Store] exporting {points:,} points")
+
+    # unsorted export
+    start_time = time.time()
+    pmid_array = np.zeros(points, dtype=np.int64)
+    unsorted_file = os.path.join(data_dir, "embedding_unsorted.npy")
+    unsorted_matrix = None
+    exported = 0
+    offset = None
+
+    while exported < points:
+        point_list, offset = qdrant_client.scroll(
+            collection_name=qdrant_collection,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["pmid"],
+            with_vectors=True,
         )
+        point_list = point_list[:points - exported]
+        if not point_list:
+            break
+        if unsorted_matrix is None:
+            dimension = len(point_list[0].vector)
+            unsorted_matrix = np.lib.format.open_memmap(
+                unsorted_file, mode="w+", dtype=np.float16, shape=(points, dimension),
+            )
+        for point in point_list:
+            pmid_array[exported] = int(point.payload["pmid"])
+            unsorted_matrix[exported] = point.vector
+            exported += 1
+
+        if exported % (batch_size * 100) == 0:
+            logger.info(f"[Local Embedding Store] exported {exported:,}/{points:,} points")
+        if offset is None:
+            break
+
+    run_time = time.time() - start_time
+    logger.info(f"[Local Embedding Store] exported {exported:,} points in {run_time:.1f} sec")
+
+    # sort by pmid, keeping the first point of a pmid
+    start_time = time.time()
+    pmid_array = pmid_array[:exported]
+    pmid_array, row_array = np.unique(pmid_array, return_index=True)
+    np.save(os.path.join(data_dir, "pmid.npy"), pmid_array)
+
+    embedding_matrix = np.lib.format.open_memmap(
+        os.path.join(data_dir, "embedding.npy"), mode="w+", dtype=np.float16, shape=(len(row_array), dimension),
+    )
+    for start in range(0, len(row_array), batch_size * 100):
+        end = start + batch_size * 100
+        embedding_matrix[start:end] = unsorted_matrix[row_array[start:end]]
+    embedding_matrix.flush()
+    del embedding_matrix, unsorted_matrix
+    os.remove(unsorted_file)
+
+    papers = len(pmid_array)
+    run_time = time.time() - start_time
+    logger.info(f"[Local Embedding Store] wrote {papers:,} papers in {run_time:.1f} sec")
+    return
+
+
+class NumpyQdrantClient:
+    def __init__(self, pmid_list, embedding_matrix):
+        """
+        In-process stand-in for the QdrantClient calls used by EmbeddingPaperRetriever and build_local_embedding_store()
+
+        :param pmid_list: [pmid: str, ...], payload of each point
+        :param embedding_matrix: [points, dimension], L2 normalized
+        """
+        self.pmid_list = pmid_list
+        self.embedding_matrix = np.asarray(embedding_matrix, dtype=np.float32)
+        self.pmid_to_index_list = defaultdict(lambda: [])
+        for index, pmid in enumerate(pmid_list):
+            self.pmid_to_index_list[pmid].append(index)
         return
 
-    def embed_query(self, text_list):
-        text_list = [
-            f"query: {text}"
-            for text in text_list
+    def get_point(self, index, score=None, with_payload=True, with_vectors=False):
+        return SimpleNamespace(
+            id=index,
+            score=score,
+            payload={"pmid": self.pmid_list[index]} if with_payload else None,
+            vector=self.embedding_matrix[index].tolist() if with_vectors else None,
+        )
+
+    def query_points(self, collection_name, query, query_filter=None, with_payload=True, limit=10, timeout=None):
+        # supported filter: must=[FieldCondition(key="pmid", match=MatchAny(any=[...])), ...]
+        if query_filter is None:
+            index_array = np.arange(len(self.pmid_list))
+        else:
+            pmid_set = None
+            for condition in query_filter.must:
+                assert condition.key == "pmid"
+                condition_pmid_set = set(condition.match.any)
+                pmid_set = condition_pmid_set if pmid_set is None else pmid_set & condition_pmid_set
+            index_array = np.array(
+                sorted(index for pmid in pmid_set for index in self.pmid_to_index_list.get(pmid, [])),
+                dtype=np.int64,
+            )
+
+        score_array = self.embedding_matrix[index_array] @ np.asarray(query, dtype=np.float32)
+        order_array = np.argsort(-score_array, kind="stable")[:limit]
+        point_list = [
+            self.get_point(int(index_array[i]), score=float(score_array[i]), with_payload=with_payload)
+            for i in order_array
         ]
-        return self.embedding.embed(text_list)
+        return SimpleNamespace(points=point_list)
+
+    def scroll(self, collection_name, limit=10, offset=None, with_payload=True, with_vectors=False):
+        start = 0 if offset is None else offset
+        end = min(start + limit, len(self.pmid_list))
+        point_list = [
+            self.get_point(index, with_payload=with_payload, with_vectors=with_vectors)
+            for index in range(start, end)
+        ]
+        next_offset = end if end < len(self.pmid_list) else None
+        return point_list, next_offset
+
+    def count(self, collection_name, exact=True):
+        return SimpleNamespace(count=len(self.pmid_list))
+
+
+def make_synthetic_embedding_collection(papers, dimension=1024, seed=0):
+    """
+    Random L2 normalized embeddings of papers with distinct numeric pmids, for NumpyQdrantClient
+    """
+    rng = np.random.default_rng(seed)
+    pmid_array = rng.choice(40000000, size=papers, replace=False) + 1
+    pmid_list = [str(pmid) for pmid in pmid_array]
+
+    embedding_matrix = np.zeros((papers, dimension), dtype=np.float32)
+    for start in range(0, papers, 10000):
+        end = min(start + 10000, papers)
+        embedding = rng.standard_normal((end - start, dimension), dtype=np.float32)
+        embedding_matrix[start:end] = embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
+    return pmid_list, embedding_matrix
 
 
 class EmbeddingPaperRetriever:
-    def __init__(self, query_embedding, qdrant_server, qdrant_collection):
+    def __init__(
+            self, query_embedding, qdrant_server, qdrant_collection,
+            query_embedding_backend="torch", query_embedding_onnx_file=None, query_embedding_max_length=512,
+            query_embedding_socket=None, embedding_store_dir=None, qdrant_client=None,
+    ):
         # embedding model
         if query_embedding is None:
             pass
+        elif query_embedding_socket is not None:
+            self.query_embedding = SocketQueryEmbedding(query_embedding_socket)
+            logger.info(f"[Embedding Paper Retriever] using query embedding server at {query_embedding_socket}")
         elif query_embedding == "Snowflake/snowflake-arctic-embed-l-v2.0":
             start_time = time.time()
-            self.query_embedding = SnowflakeQueryEmbedding()
+            self.query_embedding = SnowflakeQueryEmbedding(
+                backend=query_embedding_backend,
+                onnx_file=query_embedding_onnx_file,
+                max_length=query_embedding_max_length,
+            )
             run_time = time.time() - start_time
             logger.info(f"[Embedding Paper Retriever] loaded query embedding model in {run_time:.1f} sec")
         else:
             assert False
 
-        # vector DB client
-        if qdrant_server is not None:
+        # vector DB client, or an injected client such as NumpyQdrantClient
+        if qdrant_client is not None:
+            self.time_out = 300
+            self.qdrant_client = qdrant_client
+            self.qdrant_collection = qdrant_collection
+        elif qdrant_server is not None:
             self.time_out = 300
             self.qdrant_client = QdrantClient(qdrant_server, timeout=self.time_out)
             self.qdrant_collection = qdrant_collection
+
+        # optional local store for filtered search, see build_local_embedding_store()
+        self.embedding_store = LocalEmbeddingStore(embedding_store_dir)
         return
 
     def query(self, text, filter_pmid_list=None, top_k=None):
-        if top_k is None:
-            top_k = 20
+        query_vector = self.embed_query(text)
+        return self.search(query_vector, filter_pmid_list=filter_pmid_list, top_k=top_k)
 
+    def embed_query(self, text, use_cache=True):
         start_time = time.time()
-        query_vector = self.query_embedding.embed_query([text])[0]
+        query_vector = self.query_embedding.embed_query([text], use_cache=use_cache)[0]
         run_time = time.time() - start_time
-        logger.info(f"[Embedding Paper Retriever] query embedded in {run_time:.1f} sec")
+        cache_stats = self.query_embedding.get_cache_stats()
+        logger.info(
+            f"[Embedding Paper Retriever] query embedded in {run_time:.1f} sec;"
+            f" cache: {cache_stats['hits']:,} hits, {cache_stats['misses']:,} misses,"
+            f" {cache_stats['entries']:,} entries"
+        )
+        return query_vector
+
+    def search(self, query_vector, filter_pmid_list=None, top_k=None):
+        if top_k is None:
+            top_k = 20
+
+        if filter_pmid_list is not None and self.embedding_store.embedding_matrix is not None:
+            start_time = time.time()
+            retrieved_pmid_list = self.embedding_store.query(query_vector, filter_pmid_list, top_k)
+            run_time = time.time() - start_time
+            pmids = len(retrieved_pmid_list)
+            logger.info(f"[Embedding Paper Retriever] retrieved {pmids:,} pmids from local store in {run_time:.3f} sec")
+            return retrieved_pmid_list
 
         start_time = time.time()
         if filter_pmid_list is None:
@@ -1154,35 +2113,266 @@ class EmbeddingPaperRetriever:
         return retrieved_pmid_list
 
 
-class UMLSImpactEmbeddingPaperRetriever:
-    def __init__(self, umls_impact_paper_retriever, embedding_paper_retriever):
-        self.umls_impact_paper_retriever = umls_impact_paper_retriever
-        self.embedding_paper_retriever = embedding_paper_retriever
-        return
+class DeadlineExceeded(Exception):
+    pass
 
-    def query(self, text, case_sensitive=None, top_umls_pmids=None, top_umls_impact_pmids=None, top_k=None):
-        if top_umls_pmids is None:
-            top_umls_pmids = 10000
-        if top_umls_impact_pmids is None:
-            top_umls_impact_pmids = 1000
-        if top_k is None:
-            top_k = 20
 
-        # search using UMLS and impact
-        pmid_list = self.umls_impact_paper_retriever.query(
-            text,
-            case_sensitive=case_sensitive,
-            top_umls_pmids=top_umls_pmids,
-            top_combine_pmids=top_umls_impact_pmids,
-        )
+class Deadline:
+    def __init__(self, timeout=None):
+        """
+        Time budget of one request, shared by all of its stages
 
-        # search using embedding
-        pmid_list = self.embedding_paper_retriever.query(
-            text,
-            filter_pmid_list=pmid_list,
-            top_k=top_k,
-        )
-        return pmid_list
+        :param timeout: seconds from now; None means unlimited
+        """
+        self.timeout = timeout
+        self.end_time = time.time() + timeout if timeout else None
+        return
+
+    def get_remaining_time(self, limit=None):
+        """
+
+        :return: seconds left, at most limit; limit if the deadline is unlimited
+        """
+        if self.end_time is None:
+            return limit
+        remaining_time = max(0.0, self.end_time - time.time())
+        if limit is None:
+            return remaining_time
+        return min(limit, remaining_time)
+
+    def is_expired(self):
+        return self.end_time is not None and time.time() >= self.end_time
+
+    def check(self, stage):
+        if self.is_expired():
+            raise DeadlineExceeded(f"request deadline of {self.timeout:.1f} sec reached before {stage}")
+        return
+
+    def copy(self):
+        deadline = Deadline()
+        deadline.timeout = self.timeout
+        deadline.end_time = self.end_time
+        return deadline
+
+    def extend(self, deadline):
+        # work shared by several requests runs until the latest of their deadlines
+        if self.end_time is None:
+            return
+        if deadline.end_time is None or deadline.end_time > self.end_time:
+            self.timeout = deadline.timeout
+            self.end_time = deadline.end_time
+        return
+
+
+# deadline of the request served by the current thread or asyncio task
+request_deadline_context = contextvars.ContextVar("request_deadline", default=Deadline())
+partial_result_message = "The request deadline was reached; the result is incomplete."
+# once a stream has started, the 503 of LLMQueueTimeout can no longer be sent
+busy_result_message = "The LLM service is busy; please try again later."
+
+
+def set_request_deadline(deadline):
+    request_deadline_context.set(deadline)
+    return
+
+
+def get_request_deadline():
+    return request_deadline_context.get()
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=3, slow_time=5.0, stage_timeout=10.0, recovery_time=30.0):
+        """
+        Opens after failure_threshold consecutive slow or failed calls; while open, a background thread
+        runs the probe every recovery_time seconds and closes the breaker once a probe is fast again
+
+        :param slow_time: a call slower than this counts as a failure
+        :param stage_timeout: callers stop waiting for the protected stage after this
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_time = slow_time
+        self.stage_timeout = stage_timeout
+        self.recovery_time = recovery_time
+        self.probe = None
+
+        self.lock = threading.Lock()
+        self.is_open = False
+        self.failures = 0
+        self.trips = 0
+        self.fallbacks = 0
+        return
+
+    def allow(self):
+        with self.lock:
+            if self.is_open:
+                self.fallbacks += 1
+            return not self.is_open
+
+    def record(self, run_time, is_failure=False):
+        is_failure = is_failure or run_time > self.slow_time
+        with self.lock:
+            if not is_failure:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.is_open or self.failures < self.failure_threshold:
+                return
+            self.is_open = True
+            self.trips += 1
+
+        logger.info(f"[{self.name} Circuit Breaker] open after {self.failures:,} slow or failed calls")
+        threading.Thread(target=self.run_probe_loop, daemon=True).start()
+        return
+
+    def run_probe_loop(self):
+        while True:
+            time.sleep(self.recovery_time)
+            start_time = time.time()
+            try:
+                self.probe()
+                run_time = time.time() - start_time
+                is_recovered = run_time <= self.slow_time
+            except Exception:
+                run_time = time.time() - start_time
+                is_recovered = False
+                logger.info(f"[{self.name} Circuit Breaker] probe error:\n{traceback.format_exc()}")
+
+            logger.info(f"[{self.name} Circuit Breaker] probe in {run_time:.1f} sec: recovered={is_recovered}")
+            if is_recovered:
+                with self.lock:
+                    self.is_open = False
+                    self.failures = 0
+                return
+
+    def get_stats(self):
+        return {
+            "is_open": self.is_open,
+            "failures": self.failures,
+            "trips": self.trips,
+            "fallbacks": self.fallbacks,
+        }
+
+
+class UMLSImpactEmbeddingPaperRetriever:
+    def __init__(self, umls_impact_paper_retriever, embedding_paper_retriever, max_workers=4, circuit_breaker=None):
+        self.umls_impact_paper_retriever = umls_impact_paper_retriever
+        self.embedding_paper_retriever = embedding_paper_retriever
+
+        # the query embedding does not depend on UMLS and impact retrieval, so it runs concurrently
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # when embedding or vector search is slow, fall back to the UMLS and impact ranking
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker("Embedding")
+        self.circuit_breaker = circuit_breaker
+        self.circuit_breaker.probe = self.probe_embedding
+        return
+
+    def probe_embedding(self):
+        # bypass the query embedding cache, so the model answers the probe and real queries stay cached
+        query_vector = self.embedding_paper_retriever.embed_query("circuit breaker probe", use_cache=False)
+        self.embedding_paper_retriever.search(query_vector, top_k=1)
+        return
+
+    def embed_query(self, text):
+        start_time = time.time()
+        query_vector = self.embedding_paper_retriever.embed_query(text)
+        run_time = time.time() - start_time
+        return query_vector, run_time
+
+    def query(self, text, case_sensitive=None, top_umls_pmids=None, top_umls_impact_pmids=None, top_k=None):
+        pmid_list, _is_degraded = self.query_with_status(
+            text,
+            case_sensitive=case_sensitive,
+            top_umls_pmids=top_umls_pmids,
+            top_umls_impact_pmids=top_umls_impact_pmids,
+            top_k=top_k,
+        )
+        return pmid_list
+
+    def query_with_status(
+            self, text, case_sensitive=None, top_umls_pmids=None, top_umls_impact_pmids=None, top_k=None,
+    ):
+        """
+
+        :return: pmid_list, is_degraded; degraded results are ranked by UMLS and impact only
+        """
+        if top_umls_pmids is None:
+            top_umls_pmids = 10000
+        if top_umls_impact_pmids is None:
+            top_umls_impact_pmids = 1000
+        if top_k is None:
+            top_k = 20
+
+        request_deadline = get_request_deadline()
+        request_deadline.check("UMLS and impact retrieval")
+
+        # embed query in the background
+        query_start_time = time.time()
+        is_embedding_allowed = self.circuit_breaker.allow()
+        if is_embedding_allowed:
+            embedding_future = self.executor.submit(self.embed_query, text)
+
+        # search using UMLS and impact
+        start_time = time.time()
+        pmid_list = self.umls_impact_paper_retriever.query(
+            text,
+            case_sensitive=case_sensitive,
+            top_umls_pmids=top_umls_pmids,
+            top_combine_pmids=top_umls_impact_pmids,
+        )
+        umls_impact_time = time.time() - start_time
+
+        if not is_embedding_allowed:
+            logger.info("[UMLS Impact Embedding Paper Retriever] embedding circuit open, umls_impact ranking only")
+            return pmid_list[:top_k], True
+
+        # search using embedding; embedding and vector search each get the stage timeout,
+        # cut short by the request deadline
+        stage_timeout = self.circuit_breaker.stage_timeout
+        try:
+            start_time = time.time()
+            remaining_time = max(0.0, stage_timeout - (start_time - query_start_time))
+            query_vector, embedding_time = embedding_future.result(
+                timeout=request_deadline.get_remaining_time(remaining_time),
+            )
+            embedding_wait_time = time.time() - start_time
+
+            start_time = time.time()
+            search_future = self.executor.submit(
+                self.embedding_paper_retriever.search,
+                query_vector,
+                filter_pmid_list=pmid_list,
+                top_k=top_k,
+            )
+            embedding_pmid_list = search_future.result(timeout=request_deadline.get_remaining_time(stage_timeout))
+            search_time = time.time() - start_time
+
+        except Exception as e:
+            if isinstance(e, FutureTimeoutError) and request_deadline.is_expired():
+                # the request ran out of time, which says nothing about the health of the embedding stage
+                logger.info("[UMLS Impact Embedding Paper Retriever] request deadline reached in embedding stage")
+                return pmid_list[:top_k], True
+            self.circuit_breaker.record(time.time() - query_start_time, is_failure=True)
+            if isinstance(e, FutureTimeoutError):
+                logger.info("[UMLS Impact Embedding Paper Retriever] embedding stage timed out")
+            else:
+                logger.info(f"[UMLS Impact Embedding Paper Retriever] embedding stage error:\n{traceback.format_exc()}")
+            return pmid_list[:top_k], True
+
+        self.circuit_breaker.record(embedding_time + search_time)
+        pmid_list = embedding_pmid_list
+        total_time = time.time() - query_start_time
+
+        logger.info(
+            f"[UMLS Impact Embedding Paper Retriever]"
+            f" umls_impact={umls_impact_time:.3f} sec,"
+            f" embedding={embedding_time:.3f} sec (waited {embedding_wait_time:.3f} sec),"
+            f" embedding_search={search_time:.3f} sec,"
+            f" total={total_time:.3f} sec"
+        )
+        return pmid_list, False
 
 
 class PaperText:
@@ -1211,6 +2401,1287 @@ class PaperText:
         return title, abstract
 
 
+class RateLimiter:
+    def __init__(self, rate=None):
+        """
+        Space calls evenly at no more than rate per second; None means unlimited
+        """
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+        return
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+
+        if start_time > now:
+            time.sleep(start_time - now)
+        return
+
+
+class LLMQueueTimeout(Exception):
+    pass
+
+
+class LLMGovernor:
+    def __init__(
+            self, name, requests_per_second=None, burst=1, max_in_flight=None, max_queue_time=30.0, lock_dir=None,
+    ):
+        """
+        Token bucket and max-in-flight limit for one LLM endpoint
+
+        :param requests_per_second: token refill rate; None means unlimited
+        :param burst: bucket capacity
+        :param max_in_flight: concurrent requests; None means unlimited
+        :param max_queue_time: seconds a request may wait before LLMQueueTimeout is raised
+        :param lock_dir: if set, limits are shared by all processes using this directory
+        """
+        self.name = name
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queue_time = max_queue_time
+        self.lock_dir = lock_dir
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.tokens = burst
+        self.token_time = time.time()
+
+        self.requests = 0
+        self.rejections = 0
+        self.total_queue_time = 0.0
+        self.max_observed_queue_time = 0.0
+
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        return
+
+    def try_acquire_slot(self):
+        """
+
+        :return: slot to release, or None if all slots are in use
+        """
+        if not self.max_in_flight:
+            with self.lock:
+                self.in_flight += 1
+            return True
+
+        if not self.lock_dir:
+            with self.lock:
+                if self.in_flight >= self.max_in_flight:
+                    return None
+                self.in_flight += 1
+            return True
+
+        # one lock file per slot; the OS releases a slot if its process dies
+        import fcntl
+        for i in range(self.max_in_flight):
+            slot_file = os.path.join(self.lock_dir, f"{self.name}.slot_{i}")
+            fd = os.open(slot_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            with self.lock:
+                self.in_flight += 1
+            return fd
+        return None
+
+    def release_slot(self, slot):
+        with self.lock:
+            self.in_flight -= 1
+        if slot is not True:
+            os.close(slot)
+        return
+
+    def reserve_token(self, max_wait):
+        """
+
+        :return: seconds to wait before sending, or None if longer than max_wait (nothing is reserved)
+        """
+        if not self.requests_per_second:
+            return 0.0
+
+        if not self.lock_dir:
+            with self.lock:
+                self.tokens, self.token_time, wait = self.get_reserved_bucket(self.tokens, self.token_time, max_wait)
+            return wait
+
+        import fcntl
+        bucket_file = os.path.join(self.lock_dir, f"{self.name}.bucket")
+        with open(bucket_file, "a+", encoding="utf8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            tokens, token_time = json.loads(data) if data else (self.burst, time.time())
+            tokens, token_time, wait = self.get_reserved_bucket(tokens, token_time, max_wait)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps([tokens, token_time]))
+        return wait
+
+    def get_reserved_bucket(self, tokens, token_time, max_wait):
+        # tokens may go negative: each reservation waits until its token is refilled
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - token_time) * self.requests_per_second)
+        wait = max(0.0, (1 - tokens) / self.requests_per_second)
+        if wait > max_wait:
+            return tokens, now, None
+        return tokens - 1, now, wait
+
+    def record(self, queue_time, is_rejected):
+        with self.lock:
+            self.requests += 1
+            if is_rejected:
+                self.rejections += 1
+            self.total_queue_time += queue_time
+            self.max_observed_queue_time = max(self.max_observed_queue_time, queue_time)
+        return
+
+    def get_queue_timeout(self, max_queue_time):
+        if max_queue_time < self.max_queue_time:
+            # the request deadline, not the queue limit, cut the wait short
+            return DeadlineExceeded(f"request deadline reached while waiting in the {self.name} LLM queue")
+        return LLMQueueTimeout(
+            f"{self.name} LLM queue wait exceeded {self.max_queue_time:.1f} sec"
+            f" ({self.in_flight:,} requests in flight)"
+        )
+
+    def get_max_queue_time(self):
+        request_deadline = get_request_deadline()
+        request_deadline.check(f"{self.name} LLM call")
+        return request_deadline.get_remaining_time(self.max_queue_time)
+
+    def acquire(self):
+        start_time = time.time()
+        max_queue_time = self.get_max_queue_time()
+        end_time = start_time + max_queue_time
+        poll_time = 0.005
+
+        slot = self.try_acquire_slot()
+        while slot is None:
+            if time.time() + poll_time > end_time:
+                self.record(time.time() - start_time, True)
+                raise self.get_queue_timeout(max_queue_time)
+            time.sleep(poll_time)
+            poll_time = min(poll_time * 2, 0.1)
+            slot = self.try_acquire_slot()
+
+        wait = self.reserve_token(end_time - time.time())
+        if wait is None:
+            self.release_slot(slot)
+            self.record(time.time() - start_time, True)
+            raise self.get_queue_timeout(max_queue_time)
+        time.sleep(wait)
+
+        self.record(time.time() - start_time, False)
+        return slot
+
+    async def async_acquire(self):
+        start_time = time.time()
+        max_queue_time = self.get_max_queue_time()
+        end_time = start_time + max_queue_time
+        poll_time = 0.005
+
+        slot = self.try_acquire_slot()
+        while slot is None:
+            if time.time() + poll_time > end_time:
+                self.record(time.time() - start_time, True)
+                raise self.get_queue_timeout(max_queue_time)
+            await asyncio.sleep(poll_time)
+            poll_time = min(poll_time * 2, 0.1)
+            slot = self.try_acquire_slot()
+
+        wait = self.reserve_token(end_time - time.time())
+        if wait is None:
+            self.release_slot(slot)
+            self.record(time.time() - start_time, True)
+            raise self.get_queue_timeout(max_queue_time)
+        await asyncio.sleep(wait)
+
+        self.record(time.time() - start_time, False)
+        return slot
+
+    def run(self, function):
+        slot = self.acquire()
+        try:
+            return function()
+        finally:
+            self.release_slot(slot)
+
+    async def async_run(self, async_function):
+        slot = await self.async_acquire()
+        try:
+            return await async_function()
+        finally:
+            self.release_slot(slot)
+
+    def stream(self, generate_stream):
+        # the slot is held until the stream is exhausted or closed; a stream past the request deadline is cut off
+        slot = self.acquire()
+        request_deadline = get_request_deadline()
+        stream = generate_stream()
+        try:
+            for data in stream:
+                request_deadline.check(f"the end of the {self.name} LLM stream")
+                yield data
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+            self.release_slot(slot)
+        return
+
+    async def async_stream(self, async_generate_stream):
+        slot = await self.async_acquire()
+        request_deadline = get_request_deadline()
+        stream = async_generate_stream()
+        try:
+            async for data in stream:
+                request_deadline.check(f"the end of the {self.name} LLM stream")
+                yield data
+        finally:
+            await stream.aclose()
+            self.release_slot(slot)
+        return
+
+    def get_stats(self):
+        return {
+            "requests": self.requests,
+            "rejections": self.rejections,
+            "in_flight": self.in_flight,
+            "mean_queue_time": self.total_queue_time / self.requests if self.requests else 0.0,
+            "max_queue_time": self.max_observed_queue_time,
+        }
+
+
+# LLM endpoint name -> LLMGovernor; unconfigured endpoints are unlimited
+llm_governor_dict = {}
+
+
+def configure_llm_governor(name, **kwargs):
+    llm_governor_dict[name] = LLMGovernor(name, **kwargs)
+    logger.info(f"[LLM Governor] {name}: {kwargs}")
+    return
+
+
+def get_llm_governor(model):
+    name = "fedgpt" if model.startswith("fedgpt") else "openai"
+    if name not in llm_governor_dict:
+        llm_governor_dict[name] = LLMGovernor(name)
+    return llm_governor_dict[name]
+
+
+def get_llm_governor_stats():
+    return {
+        name: governor.get_stats()
+        for name, governor in llm_governor_dict.items()
+    }
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, status=503, retry_after=10):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        return
+
+
+class Bulkhead:
+    def __init__(self, name, max_concurrent=None, max_queue=None, max_queue_time=10.0, retry_after=10):
+        """
+        Concurrency limit and bounded wait queue for one class of endpoints
+
+        :param max_concurrent: requests served at once; None means unlimited
+        :param max_queue: requests waiting for a slot; None means unlimited; a request over it is rejected with 429
+        :param max_queue_time: seconds a request may wait before it is rejected with 503
+        :param retry_after: seconds suggested to rejected clients
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+
+        self.admissions = 0
+        self.rejections = 0
+        self.total_wait_time = 0.0
+        self.max_observed_wait_time = 0.0
+        return
+
+    def is_free(self):
+        return not self.max_concurrent or self.in_flight < self.max_concurrent
+
+    def is_queue_full(self):
+        return self.max_queue is not None and self.queued >= self.max_queue
+
+    def record(self, wait_time, is_rejected):
+        # called with self.condition held
+        if is_rejected:
+            self.rejections += 1
+            return
+        self.admissions += 1
+        self.total_wait_time += wait_time
+        self.max_observed_wait_time = max(self.max_observed_wait_time, wait_time)
+        return
+
+    def get_queue_full(self):
+        return AdmissionRejected(
+            f"{self.name} requests are over capacity ({self.in_flight:,} in flight, {self.queued:,} queued)",
+            status=429, retry_after=self.retry_after,
+        )
+
+    def get_queue_timeout(self, max_queue_time):
+        return AdmissionRejected(
+            f"{self.name} request waited {max_queue_time:.1f} sec without a free slot"
+            f" ({self.in_flight:,} in flight, {self.queued:,} queued)",
+            status=503, retry_after=self.retry_after,
+        )
+
+    def acquire(self, is_queued=True):
+        """
+
+        :param is_queued: False to reject at once when no slot is free, e.g., where a waiting request holds a thread
+        """
+        start_time = time.time()
+        max_queue_time = get_request_deadline().get_remaining_time(self.max_queue_time)
+
+        with self.condition:
+            if not self.is_free():
+                if not is_queued or self.is_queue_full():
+                    self.record(0.0, True)
+                    raise self.get_queue_full()
+
+                self.queued += 1
+                try:
+                    end_time = start_time + max_queue_time
+                    while not self.is_free():
+                        remaining_time = end_time - time.time()
+                        if remaining_time <= 0:
+                            self.record(0.0, True)
+                            raise self.get_queue_timeout(max_queue_time)
+                        self.condition.wait(remaining_time)
+                finally:
+                    self.queued -= 1
+
+            self.in_flight += 1
+            self.record(time.time() - start_time, False)
+        return
+
+    async def async_acquire(self):
+        # a Condition cannot be awaited, so waiting tasks poll like LLMGovernor.async_acquire()
+        start_time = time.time()
+        max_queue_time = get_request_deadline().get_remaining_time(self.max_queue_time)
+        end_time = start_time + max_queue_time
+        poll_time = 0.005
+
+        with self.condition:
+            if self.is_free():
+                self.in_flight += 1
+                self.record(0.0, False)
+                return
+            if self.is_queue_full():
+                self.record(0.0, True)
+                raise self.get_queue_full()
+            self.queued += 1
+
+        try:
+            while True:
+                if time.time() + poll_time > end_time:
+                    with self.condition:
+                        self.record(0.0, True)
+                        raise self.get_queue_timeout(max_queue_time)
+                await asyncio.sleep(poll_time)
+                poll_time = min(poll_time * 2, 0.1)
+                with self.condition:
+                    if self.is_free():
+                        self.in_flight += 1
+                        self.record(time.time() - start_time, False)
+                        return
+        finally:
+            with self.condition:
+                self.queued -= 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+        return
+
+    def get_stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admissions": self.admissions,
+            "rejections": self.rejections,
+            "mean_wait_time": self.total_wait_time / self.admissions if self.admissions else 0.0,
+            "max_wait_time": self.max_observed_wait_time,
+        }
+
+
+# cost class name -> Bulkhead; unconfigured classes are unlimited
+bulkhead_dict = {}
+# bulkhead that admitted the request served by the current thread or asyncio task, if admitted outside Flask
+bulkhead_context = contextvars.ContextVar("bulkhead", default=None)
+
+
+def configure_bulkhead(name, **kwargs):
+    bulkhead_dict[name] = Bulkhead(name, **kwargs)
+    logger.info(f"[Bulkhead] {name}: {kwargs}")
+    return
+
+
+def get_bulkhead(name):
+    if name not in bulkhead_dict:
+        bulkhead_dict[name] = Bulkhead(name)
+    return bulkhead_dict[name]
+
+
+def get_bulkhead_stats():
+    return {
+        name: bulkhead.get_stats()
+        for name, bulkhead in bulkhead_dict.items()
+    }
+
+
+class SharedStreamCancelled(Exception):
+    pass
+
+
+class SharedStream:
+    def __init__(self, generate_stream, on_finish):
+        """
+        A stream read once by a background thread and replayed to any number of consumers,
+        each from its first chunk and until its own deadline; the source is closed early if every consumer leaves
+        """
+        self.on_finish = on_finish
+        self.condition = threading.Condition()
+        self.chunk_list = []
+        self.is_done = False
+        self.error = None
+        self.consumers = 1
+        self.is_abandoned = False
+
+        # the source runs in the context of the first request, with a deadline that later consumers extend
+        self.deadline = get_request_deadline().copy()
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self.run, generate_stream), daemon=True).start()
+        return
+
+    def run(self, generate_stream):
+        set_request_deadline(self.deadline)
+        error = None
+        stream = generate_stream()
+        try:
+            for chunk in stream:
+                with self.condition:
+                    if self.is_abandoned:
+                        break
+                    self.chunk_list.append(chunk)
+                    self.condition.notify_all()
+        except Exception as e:
+            error = e
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+            with self.condition:
+                self.is_done = True
+                self.error = error
+                self.condition.notify_all()
+            self.on_finish(self)
+        return
+
+    def add_consumer(self, deadline):
+        """
+
+        :return: False if the stream can no longer be joined
+        """
+        with self.condition:
+            if self.is_abandoned or self.is_done or self.deadline.is_expired():
+                return False
+            self.consumers += 1
+            self.deadline.extend(deadline)
+            return True
+
+    def iterate(self, deadline, partial_chunk=None):
+        """
+
+        :param partial_chunk: last chunk of a consumer whose deadline is reached before the end of the stream;
+            without it, the consumer gets DeadlineExceeded
+        """
+        ci = 0
+        try:
+            while True:
+                with self.condition:
+                    while ci >= len(self.chunk_list) and not self.is_done and not deadline.is_expired():
+                        self.condition.wait(deadline.get_remaining_time())
+                    # no chunk is added after is_done
+                    chunk_list = self.chunk_list[ci:]
+                    is_done = self.is_done
+                    error = self.error
+
+                for chunk in chunk_list:
+                    yield chunk
+                ci += len(chunk_list)
+
+                if is_done:
+                    if error is not None:
+                        raise error
+                    return
+
+                # the source runs on for consumers with a later deadline
+                if deadline.is_expired():
+                    if partial_chunk is None:
+                        deadline.check("the end of the shared stream")
+                    yield partial_chunk
+                    return
+        finally:
+            with self.condition:
+                self.consumers -= 1
+                if self.consumers == 0 and not self.is_done:
+                    self.is_abandoned = True
+
+
+class AsyncSharedStream:
+    def __init__(self, async_generate_stream, on_finish):
+        """
+        Same as SharedStream, with an asyncio task reading the source
+        """
+        self.on_finish = on_finish
+        self.condition = asyncio.Condition()
+        self.chunk_list = []
+        self.is_done = False
+        self.error = None
+        self.consumers = 1
+        self.is_abandoned = False
+        self.deadline = get_request_deadline().copy()
+        self.task = asyncio.ensure_future(self.run(async_generate_stream))
+        return
+
+    async def run(self, async_generate_stream):
+        # the task runs in a copy of the context of the first request
+        set_request_deadline(self.deadline)
+        error = None
+        stream = async_generate_stream()
+        try:
+            async for chunk in stream:
+                async with self.condition:
+                    self.chunk_list.append(chunk)
+                    self.condition.notify_all()
+        except asyncio.CancelledError:
+            # consumers still waiting must not mistake the cut-off stream for a complete one
+            error = SharedStreamCancelled("the shared stream was cancelled")
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            await stream.aclose()
+            async with self.condition:
+                self.is_done = True
+                self.error = error
+                self.condition.notify_all()
+            self.on_finish(self)
+        return
+
+    def add_consumer(self, deadline):
+        if self.is_abandoned or self.is_done or self.deadline.is_expired():
+            return False
+        self.consumers += 1
+        self.deadline.extend(deadline)
+        return True
+
+    async def iterate(self, deadline, partial_chunk=None):
+        ci = 0
+        try:
+            while True:
+                async with self.condition:
+                    try:
+                        await asyncio.wait_for(
+                            self.condition.wait_for(lambda: ci < len(self.chunk_list) or self.is_done),
+                            timeout=deadline.get_remaining_time(),
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                    chunk_list = self.chunk_list[ci:]
+                    is_done = self.is_done
+                    error = self.error
+
+                for chunk in chunk_list:
+                    yield chunk
+                ci += len(chunk_list)
+
+                if is_done:
+                    if error is not None:
+                        raise error
+                    return
+
+                if deadline.is_expired():
+                    if partial_chunk is None:
+                        deadline.check("the end of the shared stream")
+                    yield partial_chunk
+                    return
+        finally:
+            self.consumers -= 1
+            if self.consumers == 0 and not self.is_done:
+                self.is_abandoned = True
+                self.task.cancel()
+
+
+class SingleFlight:
+    def __init__(self, name):
+        """
+        Identical concurrent calls, by key, share one computation; a call after it finishes starts a new one
+        """
+        self.name = name
+        self.lock = threading.Lock()
+        self.key_to_flight = {}
+
+        self.requests = 0
+        self.coalesced = 0
+        self.retries = 0
+        return
+
+    def finish(self, flight_key, flight):
+        with self.lock:
+            if self.key_to_flight.get(flight_key) is flight:
+                del self.key_to_flight[flight_key]
+        return
+
+    def get_wait_timeout(self):
+        return DeadlineExceeded(f"request deadline reached while waiting for an identical {self.name} request")
+
+    def join(self, flight_key, create_flight, is_retry):
+        """
+
+        :return: flight, is_leader
+        """
+        with self.lock:
+            if not is_retry:
+                self.requests += 1
+            flight = self.key_to_flight.get(flight_key)
+            if flight is None:
+                flight = create_flight()
+                self.key_to_flight[flight_key] = flight
+                return flight, True
+            if not is_retry:
+                self.coalesced += 1
+            return flight, False
+
+    def run(self, key, function):
+        """
+        Every identical call joins the running one, whatever its deadline; a follower that gets a result cut short
+        by the deadline of the first call, partial or DeadlineExceeded, runs again if it has time left
+        """
+        flight_key = ("run", key)
+        request_deadline = get_request_deadline()
+        is_retry = False
+
+        while True:
+            future, is_leader = self.join(flight_key, Future, is_retry)
+            if is_leader:
+                break
+
+            try:
+                result, is_cut_short = future.result(timeout=request_deadline.get_remaining_time())
+            except FutureTimeoutError:
+                raise self.get_wait_timeout()
+            except DeadlineExceeded:
+                if request_deadline.is_expired():
+                    raise
+                result, is_cut_short = None, True
+            if not is_cut_short or request_deadline.is_expired():
+                return result
+
+            logger.info(f"[Single Flight] {self.name}: identical request cut short by its deadline, running again")
+            with self.lock:
+                self.retries += 1
+            is_retry = True
+
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.finish(flight_key, future)
+        # a result finished past the deadline may be partial
+        future.set_result((result, request_deadline.is_expired()))
+        return result
+
+    def stream(self, key, generate_stream, partial_chunk=None):
+        """
+        Every identical call joins the running stream, which runs until the latest deadline of its consumers;
+        each consumer ends at its own deadline with partial_chunk
+        """
+        flight_key = ("stream", key)
+        request_deadline = get_request_deadline()
+        with self.lock:
+            self.requests += 1
+            shared_stream = self.key_to_flight.get(flight_key)
+            if shared_stream is not None and shared_stream.add_consumer(request_deadline):
+                self.coalesced += 1
+            else:
+                shared_stream = SharedStream(generate_stream, lambda flight: self.finish(flight_key, flight))
+                self.key_to_flight[flight_key] = shared_stream
+
+        yield from shared_stream.iterate(request_deadline, partial_chunk=partial_chunk)
+        return
+
+    async def async_run(self, key, async_function):
+        flight_key = ("async_run", key)
+        request_deadline = get_request_deadline()
+        is_retry = False
+
+        async def run_flight():
+            # in a copy of the context of the first call, so with its deadline
+            result = await async_function()
+            return result, get_request_deadline().is_expired()
+
+        def create_flight():
+            task = asyncio.ensure_future(run_flight())
+            task.add_done_callback(lambda flight: self.finish(flight_key, flight))
+            return task
+
+        while True:
+            task, is_leader = self.join(flight_key, create_flight, is_retry)
+
+            # shielded, so a client that leaves does not cancel the computation shared with the others;
+            # the computation runs with the deadline of the leader, so only followers need a timeout
+            try:
+                result, is_cut_short = await asyncio.wait_for(
+                    asyncio.shield(task), timeout=None if is_leader else request_deadline.get_remaining_time(),
+                )
+            except asyncio.TimeoutError:
+                raise self.get_wait_timeout()
+            except DeadlineExceeded:
+                if is_leader or request_deadline.is_expired():
+                    raise
+                result, is_cut_short = None, True
+            if is_leader or not is_cut_short or request_deadline.is_expired():
+                return result
+
+            logger.info(f"[Single Flight] {self.name}: identical request cut short by its deadline, running again")
+            with self.lock:
+                self.retries += 1
+            is_retry = True
+
+    async def async_stream(self, key, async_generate_stream, partial_chunk=None):
+        flight_key = ("async_stream", key)
+        request_deadline = get_request_deadline()
+        with self.lock:
+            self.requests += 1
+            shared_stream = self.key_to_flight.get(flight_key)
+            if shared_stream is not None and shared_stream.add_consumer(request_deadline):
+                self.coalesced += 1
+            else:
+                shared_stream = AsyncSharedStream(async_generate_stream, lambda flight: self.finish(flight_key, flight))
+                self.key_to_flight[flight_key] = shared_stream
+
+        async for chunk in shared_stream.iterate(request_deadline, partial_chunk=partial_chunk):
+            yield chunk
+        return
+
+    def get_stats(self):
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "in_flight": len(self.key_to_flight),
+        }
+
+
+# endpoint -> SingleFlight
+single_flight_dict = {}
+
+
+def get_single_flight(name):
+    if name not in single_flight_dict:
+        # the first burst of identical requests may race here, and all of them must share one instance
+        single_flight_dict.setdefault(name, SingleFlight(name))
+    return single_flight_dict[name]
+
+
+def get_single_flight_stats():
+    return {
+        name: single_flight.get_stats()
+        for name, single_flight in single_flight_dict.items()
+    }
+
+
+class LLMCache:
+    def __init__(self, db_file, ttl=604800, max_entries=100000, replay_characters=32):
+        """
+        Disk-backed LLM responses, keyed by a hash of (model, prompt, parameters)
+
+        :param ttl: seconds before an entry expires
+        :param max_entries: least recently used entries beyond this are deleted
+        :param replay_characters: chunk size when replaying a cached response as a stream
+        """
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.replay_characters = replay_characters
+        self.db = None
+        self.lock = threading.Lock()
+        self.sets = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_characters = 0
+
+        if db_file:
+            self.load_data()
+        return
+
+    def load_data(self):
+        self.db = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, accessed REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self.db.commit()
+        entries = self.db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        logger.info(f"[LLM Cache] opened {self.db_file}: {entries:,} entries")
+        return
+
+    @staticmethod
+    def get_key(model, prompt, parameters=None):
+        data = json.dumps([model, prompt, parameters], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT response, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.db.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.db.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+            self.saved_characters += len(row[0])
+
+        stats = self.get_stats()
+        logger.info(
+            f"[LLM Cache] hit: hit_rate={stats['hit_rate']:.1%},"
+            f" saved ~{stats['saved_tokens']:,} tokens over {stats['hits']:,} hits"
+        )
+        return row[0]
+
+    def set(self, key, model, response):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self.sets += 1
+
+            # expire and cap periodically rather than on every write
+            if self.sets % 100 == 1:
+                self.db.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,))
+                self.db.execute(
+                    "DELETE FROM llm_cache WHERE key IN"
+                    " (SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.db.commit()
+        return
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_characters": self.saved_characters,
+            "saved_tokens": self.saved_characters // 4,
+        }
+
+
+llm_cache = LLMCache(None)
+
+
+def configure_llm_cache(db_file, ttl=604800, max_entries=100000):
+    global llm_cache
+    llm_cache = LLMCache(db_file, ttl=ttl, max_entries=max_entries)
+    return
+
+
+def get_llm_cache_stats():
+    return llm_cache.get_stats()
+
+
+def get_cached_text(model, prompt, generate, parameters=None):
+    if llm_cache.db is None:
+        return generate()
+
+    key = llm_cache.get_key(model, prompt, parameters)
+    response = llm_cache.get(key)
+    if response is None:
+        response = generate()
+        llm_cache.set(key, model, response)
+    return response
+
+
+async def async_get_cached_text(model, prompt, async_generate, parameters=None):
+    if llm_cache.db is None:
+        return await async_generate()
+
+    key = llm_cache.get_key(model, prompt, parameters)
+    response = llm_cache.get(key)
+    if response is None:
+        response = await async_generate()
+        llm_cache.set(key, model, response)
+    return response
+
+
+def get_cached_stream(model, prompt, generate_stream, parameters=None):
+    """
+
+    :param generate_stream: function returning an iterable of text chunks
+    :return: generator of text chunks; a cached response is replayed in chunks,
+        and a new response is cached only if its stream is fully consumed
+    """
+    if llm_cache.db is None:
+        yield from generate_stream()
+        return
+
+    key = llm_cache.get_key(model, prompt, parameters)
+    response = llm_cache.get(key)
+    if response is not None:
+        for i in range(0, len(response), llm_cache.replay_characters):
+            yield response[i:i + llm_cache.replay_characters]
+        return
+
+    response = []
+    for text in generate_stream():
+        response.append(text)
+        yield text
+    llm_cache.set(key, model, "".join(response))
+    return
+
+
+async def async_get_cached_stream(model, prompt, async_generate_stream, parameters=None):
+    if llm_cache.db is None:
+        async for text in async_generate_stream():
+            yield text
+        return
+
+    key = llm_cache.get_key(model, prompt, parameters)
+    response = llm_cache.get(key)
+    if response is not None:
+        for i in range(0, len(response), llm_cache.replay_characters):
+            yield response[i:i + llm_cache.replay_characters]
+        return
+
+    response = []
+    async for text in async_generate_stream():
+        response.append(text)
+        yield text
+    llm_cache.set(key, model, "".join(response))
+    return
+
+
+def get_cached_completion_stream(model, prompt, generate_completion, parameters=None):
+    """
+
+    :param generate_completion: function returning an OpenAI chat completion stream
+    :return: generator of chunk objects with chunk.choices[0].delta.content, as in a completion stream
+    """
+    def generate_stream():
+        for chunk in generate_completion():
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        return
+
+    for text in get_cached_stream(model, prompt, generate_stream, parameters=parameters):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+    return
+
+
+class LLMTiming:
+    def __init__(self, name):
+        # connection setup is reported by the httpx trace extension, see get_openai_client()
+        self.name = name
+        self.start_time = time.time()
+        self.connect_start_time = None
+        self.connect_time = 0.0
+        self.first_token_time = None
+        return
+
+    def on_trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.started":
+            self.connect_start_time = time.time()
+        elif event_name in ["connection.connect_tcp.complete", "connection.start_tls.complete"]:
+            if self.connect_start_time is not None:
+                self.connect_time = time.time() - self.connect_start_time
+        return
+
+    async def async_on_trace(self, event_name, info):
+        self.on_trace(event_name, info)
+        return
+
+    def mark_token(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.time() - self.start_time
+        return
+
+    def log(self, characters):
+        total_time = time.time() - self.start_time
+        first_token_time = self.first_token_time if self.first_token_time is not None else total_time
+        logger.info(
+            f"[LLM] {self.name}: connect={self.connect_time:.3f} sec, first_token={first_token_time:.3f} sec,"
+            f" total={total_time:.1f} sec, {characters:,} characters"
+        )
+        return
+
+
+# timing of the LLM call in the current thread or asyncio task
+llm_timing_context = contextvars.ContextVar("llm_timing", default=None)
+
+
+def trace_llm_request(request):
+    llm_timing = llm_timing_context.get()
+    if llm_timing is not None:
+        request.extensions["trace"] = llm_timing.on_trace
+    return
+
+
+async def async_trace_llm_request(request):
+    llm_timing = llm_timing_context.get()
+    if llm_timing is not None:
+        request.extensions["trace"] = llm_timing.async_on_trace
+    return
+
+
+# long-lived clients with pooled HTTP connections, shared by all requests
+llm_client_lock = threading.Lock()
+llm_client_key_to_openai_client = {}
+llm_event_loop_to_key_to_async_openai_client = weakref.WeakKeyDictionary()
+llm_http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300)
+llm_http_timeout = httpx.Timeout(600, connect=10)
+# below this per attempt, a deadline-bound call gets all the time left and no retries
+llm_min_attempt_time = 10.0
+
+
+def get_openai_client(base_url=None, api_key=None):
+    key = (base_url, api_key)
+    with llm_client_lock:
+        if key not in llm_client_key_to_openai_client:
+            http_client = httpx.Client(
+                limits=llm_http_limits,
+                timeout=llm_http_timeout,
+                event_hooks={"request": [trace_llm_request]},
+            )
+            llm_client_key_to_openai_client[key] = OpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+        return llm_client_key_to_openai_client[key]
+
+
+def get_async_openai_client(base_url=None, api_key=None):
+    # async connections belong to the event loop that opened them
+    event_loop = asyncio.get_running_loop()
+    key = (base_url, api_key)
+    with llm_client_lock:
+        key_to_async_openai_client = llm_event_loop_to_key_to_async_openai_client.setdefault(event_loop, {})
+        if key not in key_to_async_openai_client:
+            http_client = httpx.AsyncClient(
+                limits=llm_http_limits,
+                timeout=llm_http_timeout,
+                event_hooks={"request": [async_trace_llm_request]},
+            )
+            key_to_async_openai_client[key] = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+        return key_to_async_openai_client[key]
+
+
+def get_deadline_client(client):
+    """
+    The call must end by the request deadline; the time left is split across the SDK's attempts,
+    so its retries of transient 429, 5xx, and connection errors still fit, unless an attempt would get too little
+    """
+    remaining_time = get_request_deadline().get_remaining_time()
+    if remaining_time is None:
+        return client
+    attempt_time = remaining_time / (client.max_retries + 1)
+    if attempt_time < llm_min_attempt_time:
+        timeout = httpx.Timeout(remaining_time, connect=min(10.0, remaining_time))
+        return client.with_options(timeout=timeout, max_retries=0)
+    timeout = httpx.Timeout(attempt_time, connect=min(10.0, attempt_time))
+    return client.with_options(timeout=timeout)
+
+
+def stream_chat_completion(client, model, prompt, name):
+    return get_cached_stream(
+        model, prompt,
+        lambda: get_llm_governor(model).stream(lambda: stream_uncached_chat_completion(client, model, prompt, name)),
+    )
+
+
+def stream_uncached_chat_completion(client, model, prompt, name):
+    llm_timing = LLMTiming(f"{name} {model}")
+    client = get_deadline_client(client)
+
+    # connections are opened in create(), so the trace only needs the context there
+    token = llm_timing_context.set(llm_timing)
+    try:
+        completion = client.chat.completions.create(
+            model=model,
+            n=1,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+        )
+    except APITimeoutError:
+        get_request_deadline().check(f"the {name} {model} response")
+        raise
+    finally:
+        llm_timing_context.reset(token)
+
+    characters = 0
+    try:
+        for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content:
+                llm_timing.mark_token()
+                characters += len(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+    except httpx.TimeoutException:
+        get_request_deadline().check(f"the end of the {name} {model} response")
+        raise
+
+    llm_timing.log(characters)
+    return
+
+
+def run_chat_completion(client, model, prompt, name, stream=True):
+    if stream:
+        return "".join(stream_chat_completion(client, model, prompt, name))
+
+    def generate():
+        llm_timing = LLMTiming(f"{name} {model}")
+        token = llm_timing_context.set(llm_timing)
+        try:
+            completion = get_deadline_client(client).chat.completions.create(
+                model=model,
+                n=1,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            response = completion.choices[0].message.content
+        except APITimeoutError:
+            get_request_deadline().check(f"the {name} {model} response")
+            raise
+        finally:
+            llm_timing_context.reset(token)
+
+        llm_timing.log(len(response))
+        return response
+
+    return get_cached_text(model, prompt, lambda: get_llm_governor(model).run(generate))
+
+
+def async_stream_chat_completion(client, model, prompt, name):
+    return async_get_cached_stream(
+        model, prompt,
+        lambda: get_llm_governor(model).async_stream(
+            lambda: async_stream_uncached_chat_completion(client, model, prompt, name),
+        ),
+    )
+
+
+async def async_stream_uncached_chat_completion(client, model, prompt, name):
+    llm_timing = LLMTiming(f"{name} {model}")
+    client = get_deadline_client(client)
+
+    token = llm_timing_context.set(llm_timing)
+    try:
+        completion = await client.chat.completions.create(
+            model=model,
+            n=1,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+        )
+    except APITimeoutError:
+        get_request_deadline().check(f"the {name} {model} response")
+        raise
+    finally:
+        llm_timing_context.reset(token)
+
+    characters = 0
+    try:
+        async for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content:
+                llm_timing.mark_token()
+                characters += len(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+    except httpx.TimeoutException:
+        get_request_deadline().check(f"the end of the {name} {model} response")
+        raise
+
+    llm_timing.log(characters)
+    return
+
+
+async def async_run_chat_completion(client, model, prompt, name, stream=True):
+    return await async_get_cached_text(
+        model, prompt,
+        lambda: get_llm_governor(model).async_run(
+            lambda: async_run_uncached_chat_completion(client, model, prompt, name, stream=stream),
+        ),
+    )
+
+
+async def async_run_uncached_chat_completion(client, model, prompt, name, stream=True):
+    llm_timing = LLMTiming(f"{name} {model}")
+    client = get_deadline_client(client)
+    token = llm_timing_context.set(llm_timing)
+    try:
+        if stream:
+            response = []
+            async for chunk in await client.chat.completions.create(
+                model=model,
+                n=1,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+            ):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    llm_timing.mark_token()
+                    response.append(chunk.choices[0].delta.content)
+            response = "".join(response)
+        else:
+            completion = await client.chat.completions.create(
+                model=model,
+                n=1,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            response = completion.choices[0].message.content
+    except (APITimeoutError, httpx.TimeoutException):
+        get_request_deadline().check(f"the {name} {model} response")
+        raise
+    finally:
+        llm_timing_context.reset(token)
+
+    llm_timing.log(len(response))
+    return response
+
+
 class _FedGPT:
     def __init__(self):
         self.conv_url = "https://10.7.240.11/api/chat/v2/conversations"
@@ -1221,8 +3692,13 @@ class _FedGPT:
     @backoff.on_exception(backoff.expo,
                           Exception,
                           max_tries=5,
+                          giveup=lambda e: isinstance(e, (LLMQueueTimeout, DeadlineExceeded)),
                           on_backoff=backoff_handler)
     def prompt(self, prompt, model="fedgpt-medium"):
+        # each try waits for its own governor slot, so retries do not pile up on a busy endpoint
+        return get_llm_governor(model).run(lambda: self.run_prompt(prompt, model))
+
+    def run_prompt(self, prompt, model):
         # request #1: conversion
         body = {
             "conversation": {
@@ -1232,7 +3708,10 @@ class _FedGPT:
                 "params": [],
             }
         }
-        response = requests.post(self.conv_url, headers=self.header, json=body, verify=False)
+        response = requests.post(
+            self.conv_url, headers=self.header, json=body, verify=False,
+            timeout=get_request_deadline().get_remaining_time(),
+        )
         conv_id = response.json()["conversation"]["convId"]
 
         # request #2: chat
@@ -1242,7 +3721,10 @@ class _FedGPT:
                 "text": prompt,
             },
         }
-        response = requests.post(self.chat_url, headers=self.header, json=body, verify=False)
+        response = requests.post(
+            self.chat_url, headers=self.header, json=body, verify=False,
+            timeout=get_request_deadline().get_remaining_time(),
+        )
         response = response.json()["messages"][0]["text"]
         return response
 
@@ -1255,94 +3737,248 @@ class FedGPT:
     def prompt(self, prompt, model):
         start_time = time.time()
 
-        client = OpenAI(base_url=self.base_url, api_key="YOLO")
-        completion = client.chat.completions.create(
-            model=model,
-            n=1,
-            messages=[
-                {"role": "user", "content": prompt},
-            ],
-        )
-        response = completion.choices[0].message.content
+        client = get_openai_client(base_url=self.base_url, api_key="YOLO")
+        response = run_chat_completion(client, model, prompt, "FedGPT", stream=False)
+
+        run_time = time.time() - start_time
+        logger.info(f"[FedGPT OpenAI] in {run_time:.1f} sec, processed request: {prompt}")
+        return response
+
+    async def async_prompt(self, prompt, model):
+        start_time = time.time()
+
+        client = get_async_openai_client(base_url=self.base_url, api_key="YOLO")
+        response = await async_run_chat_completion(client, model, prompt, "FedGPT", stream=False)
 
         run_time = time.time() - start_time
         logger.info(f"[FedGPT OpenAI] in {run_time:.1f} sec, processed request: {prompt}")
         return response
 
 
+model_to_token_counter = {}
+
+
+def get_token_counter(model):
+    """
+    tiktoken for OpenAI models when installed; otherwise about 4 characters per token
+
+    :return: function text -> tokens
+    """
+    if model in model_to_token_counter:
+        return model_to_token_counter[model]
+
+    encoding = None
+    if model.startswith("gpt"):
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            pass
+        except Exception:
+            logger.info(f"[Token Counter] {model} tokenizer error:\n{traceback.format_exc()}")
+
+    if encoding is None:
+        def count_tokens(text):
+            return (len(text) + 3) // 4
+    else:
+        def count_tokens(text):
+            return len(encoding.encode(text, disallowed_special=()))
+
+    model_to_token_counter[model] = count_tokens
+    return count_tokens
+
+
+def split_sentence(text):
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])", text.strip()) if sentence]
+
+
 class PubMedQA:
-    def __init__(self, umls_impact_embedding_paper_retriever, paper_text):
+    def __init__(self, umls_impact_embedding_paper_retriever, paper_text, umls_doc=None, model_to_context_tokens=None):
         self.umls_impact_embedding_paper_retriever = umls_impact_embedding_paper_retriever
         self.paper_text = paper_text
+        self.umls_doc = umls_doc
         self.fedgpt = FedGPT()
         self.instruction = """You are a researcher. Based on the provided reference document, answer the user's question with the following guidelines:
 1. Only rely on the reference document for reasoning and answering. Do not fabricate or assume information that is not explicitly stated.
 2. Use a professional tone and respond in the same language as the user (limited to English or Chinese).
 3. If the reference documents do not contain sufficient information to answer the question, simply state: \"the documents do not contain sufficient information to answer the question.\""""
         self.retrieval_papers = 20
+        self.degraded_message = "Semantic search is temporarily unavailable;" \
+                                " references are ranked by UMLS concepts and paper impact only."
         self.max_abstract_characters = 5000
+        self.model_to_context_tokens = {
+            "fedgpt-medium": 8000,
+            "gpt-4.1-nano": 12000,
+            "gpt-4.1-mini": 12000,
+            "gpt-4.1": 12000,
+        }
+        if model_to_context_tokens:
+            self.model_to_context_tokens.update(model_to_context_tokens)
         return
 
     def get_paper_list(self, query):
+        paper_list, _is_degraded = self.get_paper_list_with_status(query)
+        return paper_list
+
+    def get_paper_list_with_status(self, query):
+        """
+
+        :return: paper_list, is_degraded; degraded retrieval skipped the embedding stage
+        """
         start_time = time.time()
 
         paper_list = []
-        pmid_list = self.umls_impact_embedding_paper_retriever.query(query, top_k=self.retrieval_papers)
+        pmid_list, is_degraded = self.umls_impact_embedding_paper_retriever.query_with_status(
+            query, top_k=self.retrieval_papers,
+        )
+        request_deadline = get_request_deadline()
         for pmid in pmid_list:
+            if request_deadline.is_expired():
+                logger.info(f"[PubMedQA] request deadline reached after reading {len(paper_list):,} papers")
+                break
             title, abstract = self.paper_text.query(pmid)
             if title and abstract:
                 paper_list.append((pmid, title, abstract))
         del pmid_list
 
         run_time = time.time() - start_time
-        logger.info(f"[PubMedQA] retrieved {len(paper_list):,} papers in {run_time:.1f} sec")
-        return paper_list
-
-    def get_context(self, paper_list):
-        context = ["Reference documents:"]
-        for pmid, title, abstract in paper_list:
-            context.append(f"[PMID-{pmid}]\nTitle: {title}\nAbstract: {abstract[:self.max_abstract_characters]}")
-        context = "\n\n".join(context)
-        return context
+        logger.info(f"[PubMedQA] retrieved {len(paper_list):,} papers in {run_time:.1f} sec, degraded={is_degraded}")
+        return paper_list, is_degraded
 
-    def get_generation(self, query, context, level):
+    @staticmethod
+    def get_model(level):
         if level == 0:
             model = "fedgpt-medium"
-            max_context_characters = 120000
         elif level == 1:
             model = "gpt-4.1-nano"
-            max_context_characters = 4000000
         elif level == 2:
             model = "gpt-4.1-mini"
-            max_context_characters = 4000000
         else:
             model = "gpt-4.1"
-            max_context_characters = 4000000
+        return model
+
+    def get_relevant_sentence_list(self, query, paper_list):
+        """
+        Keep abstract sentences that share a UMLS concept with the query,
+        or the first sentence if none does; keep all sentences without umls_doc or query concepts
+
+        :return: [sentence_list, ...] for each paper
+        """
+        paper_sentence_list = [
+            split_sentence(abstract[:self.max_abstract_characters])
+            for _pmid, _title, abstract in paper_list
+        ]
+        if self.umls_doc is None:
+            return paper_sentence_list
+
+        text_list = [query] + [sentence for sentence_list in paper_sentence_list for sentence in sentence_list]
+        annotation_list = self.umls_doc.annotate(text_list)
+        query_cui_set = set(annotation_list[0][1])
+        if not query_cui_set:
+            return paper_sentence_list
+
+        relevant_paper_sentence_list = []
+        ai = 1
+        for sentence_list in paper_sentence_list:
+            relevant_sentence_list = []
+            for sentence in sentence_list:
+                _name_list, cui_list = annotation_list[ai]
+                ai += 1
+                if not query_cui_set.isdisjoint(cui_list):
+                    relevant_sentence_list.append(sentence)
+            if not relevant_sentence_list:
+                relevant_sentence_list = sentence_list[:1]
+            relevant_paper_sentence_list.append(relevant_sentence_list)
+        return relevant_paper_sentence_list
+
+    def get_context(self, query, paper_list, level):
+        """
+        Pack papers in retrieval order, sentence by sentence, until the model's context token budget is full
+        """
+        start_time = time.time()
+        model = self.get_model(level)
+        count_tokens = get_token_counter(model)
+        budget = self.model_to_context_tokens.get(model, 12000)
+
+        header = "Reference documents:"
+        context = [header]
+        tokens = count_tokens(header)
+        raw_tokens = tokens
+
+        paper_sentence_list = self.get_relevant_sentence_list(query, paper_list)
+
+        is_full = False
+
+        for (pmid, title, abstract), sentence_list in zip(paper_list, paper_sentence_list):
+            raw_tokens += count_tokens(f"[PMID-{pmid}]\nTitle: {title}\nAbstract: {abstract[:self.max_abstract_characters]}")
+            if is_full:
+                continue
+
+            paper = f"[PMID-{pmid}]\nTitle: {title}\nAbstract:"
+            paper_tokens = count_tokens(paper)
+            if tokens + paper_tokens > budget:
+                is_full = True
+                continue
+
+            # lower-ranked papers are not packed after the budget cuts into this one
+            for sentence in sentence_list:
+                sentence_tokens = count_tokens(" " + sentence)
+                if tokens + paper_tokens + sentence_tokens > budget:
+                    is_full = True
+                    break
+                paper += " " + sentence
+                paper_tokens += sentence_tokens
+            context.append(paper)
+            tokens += paper_tokens
+
+        context = "\n\n".join(context)
+        tokens = count_tokens(context)
+
+        run_time = time.time() - start_time
+        logger.info(
+            f"[PubMedQA] packed {tokens:,} of {raw_tokens:,} raw context tokens"
+            f" ({len(paper_list):,} papers, budget {budget:,}) for {model} in {run_time:.2f} sec"
+        )
+        return context
+
+    def get_model_prompt(self, query, context, level):
+        model = self.get_model(level)
 
         prompt = [
             self.instruction,
-            context[:max_context_characters],
+            context,
             f"Question:\n{query}",
         ]
         prompt = "\n\n".join(prompt)
+        return model, prompt
+
+    def get_generation(self, query, context, level):
+        return "".join(self.get_generation_stream(query, context, level))
+
+    def get_generation_stream(self, query, context, level):
+        model, prompt = self.get_model_prompt(query, context, level)
 
         if model.startswith("gpt"):
             try:
                 start_time = time.time()
-                client = OpenAI()
-                completion = client.chat.completions.create(
-                    model=model,
-                    n=1,
-                    messages=[
-                        {"role": "user", "content": prompt},
-                    ],
-                )
-                response = completion.choices[0].message.content
+                characters = 0
+                for text in stream_chat_completion(get_openai_client(), model, prompt, "PubMedQA"):
+                    characters += len(text)
+                    yield text
                 run_time = time.time() - start_time
-                logger.info(f"[PubMedQA] {model} generated a {len(response):,}-character response in {run_time:.1f} sec")
+                logger.info(f"[PubMedQA] {model} generated a {characters:,}-character response in {run_time:.1f} sec")
+            except LLMQueueTimeout as e:
+                logger.info(f"[PubMedQA] {e}")
+                yield f"{model} is busy, please try again later"
+            except DeadlineExceeded as e:
+                logger.info(f"[PubMedQA] {e}")
+                yield f"\n\n{partial_result_message}"
             except Exception:
                 logger.info(f"[PubMedQA] {model} generation error:\n{traceback.format_exc()}")
-                return f"{model} generation error"
+                yield f"{model} generation error"
 
         elif model.startswith("fedgpt"):
             try:
@@ -1350,18 +3986,81 @@ class PubMedQA:
                 response = self.fedgpt.prompt(prompt, model)
                 run_time = time.time() - start_time
                 logger.info(f"[PubMedQA] {model} generated a {len(response):,}-character response in {run_time:.1f} sec")
+            except LLMQueueTimeout as e:
+                logger.info(f"[PubMedQA] {e}")
+                response = f"{model} is busy, please try again later"
+            except DeadlineExceeded as e:
+                logger.info(f"[PubMedQA] {e}")
+                response = partial_result_message
             except Exception:
                 logger.info(f"[PubMedQA] {model} generation error:\n{traceback.format_exc()}")
-                return f"{model} generation error"
+                response = f"{model} generation error"
+            yield response
 
         else:
-            response = "Not implemented."
+            yield "Not implemented."
+        return
+
+    async def async_get_generation(self, query, context, level):
+        model, prompt = self.get_model_prompt(query, context, level)
+
+        try:
+            start_time = time.time()
+            if model.startswith("gpt"):
+                response = await async_run_chat_completion(get_async_openai_client(), model, prompt, "PubMedQA")
+            elif model.startswith("fedgpt"):
+                response = await self.fedgpt.async_prompt(prompt, model)
+            else:
+                return "Not implemented."
+            run_time = time.time() - start_time
+            logger.info(f"[PubMedQA] {model} generated a {len(response):,}-character response in {run_time:.1f} sec")
+        except LLMQueueTimeout as e:
+            logger.info(f"[PubMedQA] {e}")
+            return f"{model} is busy, please try again later"
+        except DeadlineExceeded as e:
+            logger.info(f"[PubMedQA] {e}")
+            return partial_result_message
+        except Exception:
+            logger.info(f"[PubMedQA] {model} generation error:\n{traceback.format_exc()}")
+            return f"{model} generation error"
 
         return response
 
-    def get_reference(self, paper_list, is_html):
+    async def async_get_generation_stream(self, query, context, level):
+        model, prompt = self.get_model_prompt(query, context, level)
+
+        try:
+            start_time = time.time()
+            characters = 0
+            if model.startswith("gpt"):
+                async for text in async_stream_chat_completion(get_async_openai_client(), model, prompt, "PubMedQA"):
+                    characters += len(text)
+                    yield text
+            elif model.startswith("fedgpt"):
+                response = await self.fedgpt.async_prompt(prompt, model)
+                characters = len(response)
+                yield response
+            else:
+                yield "Not implemented."
+                return
+            run_time = time.time() - start_time
+            logger.info(f"[PubMedQA] {model} generated a {characters:,}-character response in {run_time:.1f} sec")
+        except LLMQueueTimeout as e:
+            logger.info(f"[PubMedQA] {e}")
+            yield f"{model} is busy, please try again later"
+        except DeadlineExceeded as e:
+            logger.info(f"[PubMedQA] {e}")
+            yield f"\n\n{partial_result_message}"
+        except Exception:
+            logger.info(f"[PubMedQA] {model} generation error:\n{traceback.format_exc()}")
+            yield f"{model} generation error"
+        return
+
+    def get_reference(self, paper_list, is_html, is_degraded=False):
         if is_html:
             reference = ["References"]
+            if is_degraded:
+                reference.append(html.escape(self.degraded_message))
             for pmid, title, _abstract in paper_list:
                 pmid_url = urllib.parse.quote(pmid)
                 pmid_html = html.escape(f"[PMID-{pmid}]")
@@ -1374,6 +4073,8 @@ class PubMedQA:
 
         else:
             reference = ["References"]
+            if is_degraded:
+                reference.append(self.degraded_message)
             for pmid, title, _abstract in paper_list:
                 reference.append(f"[{pmid}] {title}")
             reference = "\n".join(reference)
@@ -1383,10 +4084,60 @@ class PubMedQA:
     def query(self, query, level=None, is_html=False):
         start_time = time.time()
 
-        paper_list = self.get_paper_list(query)
-        context = self.get_context(paper_list)
+        paper_list, is_degraded = self.get_paper_list_with_status(query)
+        context = self.get_context(query, paper_list, level)
         generation = self.get_generation(query, context, level)
-        reference = self.get_reference(paper_list, is_html)
+        reference = self.get_reference(paper_list, is_html, is_degraded=is_degraded)
+        del paper_list, context
+
+        if is_html:
+            response = generation.replace("\n", "<br />")
+            response = f"{response}<br /><br />{reference}"
+        else:
+            response = f"{generation}\n\n{reference}"
+
+        run_time = time.time() - start_time
+        logger.info(f"[PubMedQA] in {run_time:.1f} sec, processed query: {query}")
+        return response
+
+    def query_stream(self, query, level=None):
+        """
+
+        :return: generator of
+            ("degraded", message), only if retrieval skipped the embedding stage
+            ("paper_list", [(pmid, title, abstract), ...]), once retrieval finishes
+            ("text", generated_text_chunk), ...
+        """
+        start_time = time.time()
+
+        # the response has already started, so a retrieval past the deadline leaves no references instead of a 504
+        try:
+            paper_list, is_degraded = self.get_paper_list_with_status(query)
+        except DeadlineExceeded as e:
+            logger.info(f"[PubMedQA] {e}")
+            paper_list, is_degraded = [], False
+        if is_degraded:
+            yield "degraded", self.degraded_message
+        yield "paper_list", paper_list
+        context = self.get_context(query, paper_list, level)
+        del paper_list
+
+        for text in self.get_generation_stream(query, context, level):
+            yield "text", text
+
+        run_time = time.time() - start_time
+        logger.info(f"[PubMedQA] in {run_time:.1f} sec, streamed query: {query}")
+        return
+
+    async def async_query(self, query, level=None, is_html=False):
+        start_time = time.time()
+
+        # retrieval is CPU and disk bound, so it runs in a worker thread
+        paper_list, is_degraded = await asyncio.to_thread(self.get_paper_list_with_status, query)
+        # so is context packing, which annotates and counts the tokens of every abstract sentence
+        context = await asyncio.to_thread(self.get_context, query, paper_list, level)
+        generation = await self.async_get_generation(query, context, level)
+        reference = self.get_reference(paper_list, is_html, is_degraded=is_degraded)
         del paper_list, context
 
         if is_html:
@@ -1399,6 +4150,32 @@ class PubMedQA:
         logger.info(f"[PubMedQA] in {run_time:.1f} sec, processed query: {query}")
         return response
 
+    async def async_query_stream(self, query, level=None):
+        """
+
+        :return: async generator of the same events as query_stream
+        """
+        start_time = time.time()
+
+        # the response has already started, so a retrieval past the deadline leaves no references instead of a 504
+        try:
+            paper_list, is_degraded = await asyncio.to_thread(self.get_paper_list_with_status, query)
+        except DeadlineExceeded as e:
+            logger.info(f"[PubMedQA] {e}")
+            paper_list, is_degraded = [], False
+        if is_degraded:
+            yield "degraded", self.degraded_message
+        yield "paper_list", paper_list
+        context = await asyncio.to_thread(self.get_context, query, paper_list, level)
+        del paper_list
+
+        async for text in self.async_get_generation_stream(query, context, level):
+            yield "text", text
+
+        run_time = time.time() - start_time
+        logger.info(f"[PubMedQA] in {run_time:.1f} sec, streamed query: {query}")
+        return
+
 
 class VariantNEN:
     def __init__(self, variant_dir):
@@ -1440,6 +4217,7 @@ class KB:
         self.data = {}
         self.key = {}
         self.value = {}
+        self.pmid_db = {}
         return
 
     def load_data(self, data_type=("sentence", "annotation")):
@@ -1471,6 +4249,25 @@ class KB:
             logger.info(f"Read {keys:,} keys")
         return
 
+    def load_umbrella_index(self):
+        # optional pre-merged umbrella type posting lists, see build_kb_umbrella_index()
+        index_type = tuple(
+            f"umbrella_{idname}"
+            for idname in ["type_id", "type_name"]
+            if os.path.exists(os.path.join(self.data_dir, f"umbrella_{idname}_key.jsonl"))
+        )
+        self.load_index(index_type)
+        return
+
+    def load_pmid_index(self):
+        # optional per-pmid slices of large posting lists, see build_kb_pmid_index()
+        for idname in self.key:
+            db_file = os.path.join(self.data_dir, f"{idname}_pmid_db.bin")
+            if idname != "pmid" and os.path.exists(db_file):
+                self.pmid_db[idname] = dbm.gnu.open(db_file, "r")
+                logger.info(f"[KB] opened {db_file}")
+        return
+
     def get_sentence(self, sentence_file_offset):
         """
 
@@ -1537,6 +4334,52 @@ class KB:
         ht_pmid_ann = json.loads(ht_pmid_ann)
         return ht_pmid_ann
 
+    def query_ht_pmid_annset_by_type_idname(self, idname, key, pmid, key_ht_pmid_ann):
+        """
+
+        :param idname: "type_id" / "type_name" / "umbrella_type_id" / "umbrella_type_name"
+        :param key: (_type, id/name)
+        :param pmid: None / "35246262"
+        :param key_ht_pmid_ann: (type, id/name) -> "head"/"tail" -> pmid -> ann_list
+        :return: "head"/"tail" -> pmid -> ann_set
+        """
+        get_request_deadline().check(f"KB lookup of {key}")
+
+        if key in key_ht_pmid_ann:
+            # use result cached in shared storage
+            ht_pmid_ann = key_ht_pmid_ann[key]
+        elif pmid and idname in self.pmid_db and self.pmid_db[idname].get(json.dumps(key)):
+            # large posting list: read only the slice of this pmid
+            ht_ann = self.pmid_db[idname].get(json.dumps([*key, pmid]))
+            ht_ann = json.loads(ht_ann) if ht_ann else {}
+            ht_pmid_ann = {
+                ht: {pmid: ht_ann[ht]} if ht in ht_ann else {}
+                for ht in ["head", "tail"]
+            }
+            key_ht_pmid_ann[key] = ht_pmid_ann
+        else:
+            # query type_id/name, filter by pmid, and then save to shared storage
+            ht_pmid_ann = self.query_ht_pmid_annlist_by_type_idname(idname, key)
+            if pmid:
+                ht_single_pmid_ann = {}
+                for ht, pmid_to_ann in ht_pmid_ann.items():
+                    if pmid in pmid_to_ann:
+                        ht_single_pmid_ann[ht] = {pmid: pmid_to_ann[pmid]}
+                    else:
+                        ht_single_pmid_ann[ht] = {}
+                ht_pmid_ann = ht_single_pmid_ann
+            key_ht_pmid_ann[key] = ht_pmid_ann
+
+        # make ann_set from ann_list
+        ht_pmid_ann = {
+            ht: {
+                pmid: set(tuple(ann) for ann in ann_list)
+                for pmid, ann_list in pmid_to_ann.items()
+            }
+            for ht, pmid_to_ann in ht_pmid_ann.items()
+        }
+        return ht_pmid_ann
+
     def query_ht_pmid_annset_by_entity(self, entity_spec, pmid, idname_key_ht_pmid_ann=None):
         """
 
@@ -1588,7 +4431,14 @@ class KB:
             _type, idname_key = arg
             real_type_list = entity_type_to_real_type_mapping.get(_type, [_type])
 
-            if len(real_type_list) > 1:
+            if len(real_type_list) > 1 and f"umbrella_{idname}" in self.key:
+                # one read of the pre-merged posting list of all real types
+                key = (_type, idname_key)
+                return self.query_ht_pmid_annset_by_type_idname(
+                    f"umbrella_{idname}", key, pmid, idname_key_ht_pmid_ann[idname],
+                )
+
+            elif len(real_type_list) > 1:
                 expanded_entity_spec = ("OR", (
                     (idname, (real_type, idname_key))
                     for real_type in real_type_list
@@ -1598,32 +4448,7 @@ class KB:
             else:
                 _type = real_type_list[0]
                 key = (_type, idname_key)
-
-                if key in idname_key_ht_pmid_ann[idname]:
-                    # use result cached in shared storage
-                    ht_pmid_ann = idname_key_ht_pmid_ann[idname][key]
-                else:
-                    # query type_id/name, filter by pmid, and then save to shared storage
-                    ht_pmid_ann = self.query_ht_pmid_annlist_by_type_idname(idname, key)
-                    if pmid:
-                        ht_single_pmid_ann = {}
-                        for ht, pmid_to_ann in ht_pmid_ann.items():
-                            if pmid in pmid_to_ann:
-                                ht_single_pmid_ann[ht] = {pmid: pmid_to_ann[pmid]}
-                            else:
-                                ht_single_pmid_ann[ht] = {}
-                        ht_pmid_ann = ht_single_pmid_ann
-                    idname_key_ht_pmid_ann[idname][key] = ht_pmid_ann
-
-                # make ann_set from ann_list
-                ht_pmid_ann = {
-                    ht: {
-                        pmid: set(tuple(ann) for ann in ann_list)
-                        for pmid, ann_list in pmid_to_ann.items()
-                    }
-                    for ht, pmid_to_ann in ht_pmid_ann.items()
-                }
-                return ht_pmid_ann
+                return self.query_ht_pmid_annset_by_type_idname(idname, key, pmid, idname_key_ht_pmid_ann[idname])
 
         else:
             assert False
@@ -1651,6 +4476,7 @@ class KB:
         if e1_spec and e2_spec:
             e1_ht_pmid_annset = self.query_ht_pmid_annset_by_entity(e1_spec, pmid)
             e2_ht_pmid_annset = self.query_ht_pmid_annset_by_entity(e2_spec, pmid)
+            get_request_deadline().check("KB entity pair intersection")
 
             h1t2_pmid_annset = intersection_of_key_to_set([
                 e1_ht_pmid_annset["head"], e2_ht_pmid_annset["tail"],
@@ -1682,6 +4508,106 @@ class KB:
         return pmid_to_ann
 
 
+def build_kb_umbrella_index(data_dir):
+    """
+    Offline posting lists of umbrella types, merged from those of their real types
+
+    umbrella_type_id: (umbrella_type, id) -> "head"/"tail" -> pmid -> ann_list
+    umbrella_type_name: (umbrella_type, name) -> "head"/"tail" -> pmid -> ann_list
+    """
+    real_type_to_umbrella_type = {
+        real_type: umbrella_type
+        for umbrella_type, real_type_list in entity_type_to_real_type_mapping.items()
+        for real_type in real_type_list
+    }
+    kb = KB(data_dir)
+    kb.load_index(("type_id", "type_name"))
+
+    for idname in ["type_id", "type_name"]:
+        start_time = time.time()
+
+        # group real type keys by umbrella key, then read and merge one group at a time
+        umbrella_key_to_key_list = defaultdict(lambda: [])
+        for key in kb.key[idname]:
+            _type, idname_key = key
+            if _type in real_type_to_umbrella_type:
+                umbrella_key_to_key_list[(real_type_to_umbrella_type[_type], idname_key)].append(key)
+
+        def get_key_value():
+            for umbrella_key, key_list in umbrella_key_to_key_list.items():
+                ht_pmid_annset = {"head": defaultdict(lambda: set()), "tail": defaultdict(lambda: set())}
+                for key in key_list:
+                    for ht, pmid_to_ann in kb.query_ht_pmid_annlist_by_type_idname(idname, key).items():
+                        for pmid, ann_list in pmid_to_ann.items():
+                            ht_pmid_annset[ht][pmid].update(tuple(ann) for ann in ann_list)
+                ht_pmid_ann = {
+                    ht: {
+                        pmid: sorted(ann_set)
+                        for pmid, ann_set in pmid_to_annset.items()
+                    }
+                    for ht, pmid_to_annset in ht_pmid_annset.items()
+                }
+                yield umbrella_key, ht_pmid_ann
+            return
+
+        k_file = os.path.join(data_dir, f"umbrella_{idname}_key.jsonl")
+        v_file = os.path.join(data_dir, f"umbrella_{idname}_value.jsonl")
+        write_disk_dict(k_file, v_file, get_key_value())
+
+        keys = len(umbrella_key_to_key_list)
+        run_time = time.time() - start_time
+        logger.info(f"[KB] wrote {keys:,} umbrella_{idname} keys in {run_time:.1f} sec")
+    return
+
+
+def build_kb_pmid_index(data_dir, min_value_bytes=1000000):
+    """
+    Offline per-pmid slices of posting lists larger than min_value_bytes
+
+    {idname}_pmid_db.bin
+        key: [type, id/name, pmid] -> {"head": ann_list, "tail": ann_list}, "head"/"tail" omitted when empty
+        key: [type, id/name] -> "1", marks the posting list as covered
+    """
+    idname_list = [
+        idname
+        for idname in ["type_id", "type_name", "umbrella_type_id", "umbrella_type_name"]
+        if os.path.exists(os.path.join(data_dir, f"{idname}_key.jsonl"))
+    ]
+    kb = KB(data_dir)
+    kb.load_index(idname_list)
+
+    for idname in idname_list:
+        start_time = time.time()
+        key_offset_list = sorted(kb.key[idname].items(), key=lambda ko: ko[1])
+        value_file_size = os.path.getsize(os.path.join(data_dir, f"{idname}_value.jsonl"))
+        offset_list = [offset for _key, offset in key_offset_list] + [value_file_size]
+
+        db_file = os.path.join(data_dir, f"{idname}_pmid_db.bin")
+        db = dbm.gnu.open(db_file, "nf")
+        keys = 0
+        pmids = 0
+
+        for ki, (key, offset) in enumerate(key_offset_list):
+            if offset_list[ki + 1] - offset < min_value_bytes:
+                continue
+
+            pmid_to_ht_ann = defaultdict(lambda: {})
+            for ht, pmid_to_ann in kb.query_ht_pmid_annlist_by_type_idname(idname, key).items():
+                for pmid, ann_list in pmid_to_ann.items():
+                    pmid_to_ht_ann[pmid][ht] = ann_list
+
+            for pmid, ht_ann in pmid_to_ht_ann.items():
+                db[json.dumps([*key, pmid])] = json.dumps(ht_ann)
+            db[json.dumps(key)] = "1"
+            keys += 1
+            pmids += len(pmid_to_ht_ann)
+
+        db.close()
+        run_time = time.time() - start_time
+        logger.info(f"[KB] wrote {db_file}: {keys:,} keys, {pmids:,} (key, pmid) slices in {run_time:.1f} sec")
+    return
+
+
 class PaperKB:
     def __init__(self, data_dir):
         self.data_dir = data_dir
@@ -2425,6 +5351,15 @@ class QA:
         self.top_p = 10
         self.top_t = 30
 
+        # entity name -> integer id, shared by disease, gene, and variant sets;
+        # only names of retrieved docs join it, so it is bounded by the vocabulary of the index
+        self.name_to_index = {}
+        # LRU cache: retriv doc id -> (pmid, disease set, gene set, variant set, triplet_list, lowercase triplet list)
+        # retriv has no corpus iterator, so docs are mapped on retrieval instead of at load time
+        self.doc_cache_size = 100000
+        self.doc_to_entity = OrderedDict()
+        self.lock = threading.Lock()
+
         if self.retriv_dir:
             self.load_data()
         return
@@ -2438,8 +5373,53 @@ class QA:
         logger.info("[qa] done loading retriv index")
         return
 
-    def query_paper(self, question, d_set=None, g_set=None, v_set=None):
-        logger.info(f"[qa] [question] {question}")
+    def get_index_set(self, name_list):
+        # a name outside the vocabulary matches no doc mapped so far, so it is dropped instead of added
+        index_set = set()
+        for name in name_list:
+            index = self.name_to_index.get(name)
+            if index is not None:
+                index_set.add(index)
+        return index_set
+
+    def add_index_set(self, name_list):
+        with self.lock:
+            return {self.name_to_index.setdefault(name, len(self.name_to_index)) for name in name_list}
+
+    def get_doc_entity(self, search_result):
+        doc_id = search_result["id"]
+        with self.lock:
+            doc_entity = self.doc_to_entity.get(doc_id)
+            if doc_entity is not None:
+                self.doc_to_entity.move_to_end(doc_id)
+                return doc_entity
+
+        p, d_name_matches, g_name_matches, v_name_matches, triplet_list = search_result["datum"]
+        d_index_set = self.add_index_set(d_name_matches)
+
+        # a variant match also counts as a match of its gene
+        g_name_list = list(g_name_matches)
+        for v in v_name_matches:
+            i = v.find("_")
+            g_name_list.append(v[:i])
+        g_index_set = self.add_index_set(g_name_list)
+        v_index_set = self.add_index_set(v_name_matches)
+
+        t_list = [
+            f"{head} {predicate} {tail}".lower()
+            for head, predicate, tail in triplet_list
+        ]
+        doc_entity = (p, d_index_set, g_index_set, v_index_set, triplet_list, t_list)
+        with self.lock:
+            self.doc_to_entity[doc_id] = doc_entity
+            while len(self.doc_to_entity) > self.doc_cache_size:
+                self.doc_to_entity.popitem(last=False)
+        return doc_entity
+
+    def search_and_filter(self, question, d_set=None, g_set=None, v_set=None):
+        request_deadline = get_request_deadline()
+        request_deadline.check("QA retrieval")
+
         logger.info(f"[qa] retrieving knowledge...")
         search_result_list = self.retriever.search(
             query=question,
@@ -2449,183 +5429,105 @@ class QA:
         logger.info(f"{len(search_result_list):,} search_results")
 
         logger.info("[qa] filtering by targets...")
+        vocabulary_size = None
         result_list = []
         p_set = set()
         t_set = set()
 
         for search_result in search_result_list:
-            datum = search_result["datum"]
-            p, d_name_matches, g_name_matches, v_name_matches, triplet_list = datum
+            if request_deadline.is_expired():
+                logger.info("[qa] request deadline reached, stop filtering")
+                break
+            p, doc_d_set, doc_g_set, doc_v_set, triplet_list, t_list = self.get_doc_entity(search_result)
+            # a target name may have just joined the vocabulary with this doc, so targets are mapped again
+            if vocabulary_size != len(self.name_to_index):
+                vocabulary_size = len(self.name_to_index)
+                d_index_set = self.get_index_set(d_set or ())
+                g_index_set = self.get_index_set(g_set or ())
+                v_index_set = self.get_index_set(v_set or ())
             if not triplet_list:
                 continue
-            if d_set:
-                for d in d_set:
-                    if d in d_name_matches:
-                        break
-                else:
-                    continue
-            if g_set or v_set:
-                for g in g_set:
-                    if g in g_name_matches:
-                        break
-                else:
-                    for v2 in v_name_matches:
-                        i = v2.find("_")
-                        g2 = v2[:i]
-                        if g2 in g_set:
-                            break
-                    else:
-                        for v in v_set:
-                            if v in v_name_matches:
-                                break
-                        else:
-                            continue
+            if d_set and d_index_set.isdisjoint(doc_d_set):
+                continue
+            if (g_set or v_set) \
+                    and g_index_set.isdisjoint(doc_g_set) and v_index_set.isdisjoint(doc_v_set):
+                continue
             result_list.append((p, triplet_list))
 
             p_set.add(p)
-            for head, predicate, tail in triplet_list:
-                t = f"{head} {predicate} {tail}".lower()
-                t_set.add(t)
+            t_set.update(t_list)
             if len(p_set) >= self.top_p and len(t_set) >= self.top_t:
                 break
         pmids = len(p_set)
         triplets = len(t_set)
         logger.info(f"{len(result_list):,} filtered_results: {pmids:,} pmids; {triplets:,} triplets;")
+        return result_list, p_set
+
+    def query_paper(self, question, d_set=None, g_set=None, v_set=None):
+        logger.info(f"[qa] [question] {question}")
+        result_list, p_set = self.search_and_filter(question, d_set, g_set, v_set)
         return p_set
 
     def query(self, question, d_set, g_set, v_set):
         logger.info(f"[qa] [question] {question}")
-        logger.info(f"[qa] retrieving knowledge...")
-        search_result_list = self.retriever.search(
-            query=question,
-            return_docs=True,
-            cutoff=self.top_dgp,
-        )
-        logger.info(f"{len(search_result_list):,} search_results")
-
-        logger.info("[qa] filtering by targets...")
-        result_list = []
-        p_set = set()
-        t_set = set()
-
-        for search_result in search_result_list:
-            datum = search_result["datum"]
-            p, d_name_matches, g_name_matches, v_name_matches, triplet_list = datum
-            if not triplet_list:
-                continue
-            if d_set:
-                for d in d_set:
-                    if d in d_name_matches:
-                        break
-                else:
-                    continue
-            if g_set or v_set:
-                for g in g_set:
-                    if g in g_name_matches:
-                        break
-                else:
-                    for v2 in v_name_matches:
-                        i = v2.find("_")
-                        g2 = v2[:i]
-                        if g2 in g_set:
-                            break
-                    else:
-                        for v in v_set:
-                            if v in v_name_matches:
-                                break
-                        else:
-                            continue
-            result_list.append((p, triplet_list))
-
-            p_set.add(p)
-            for head, predicate, tail in triplet_list:
-                t = f"{head} {predicate} {tail}".lower()
-                t_set.add(t)
-            if len(p_set) >= self.top_p and len(t_set) >= self.top_t:
-                break
-        pmids = len(p_set)
-        triplets = len(t_set)
-        logger.info(f"{len(result_list):,} filtered_results: {pmids:,} pmids; {triplets:,} triplets;")
+        result_list, p_set = self.search_and_filter(question, d_set, g_set, v_set)
 
         if result_list:
-            answer_text = run_qa(question, "gpt-4o", "", 1000)
-            answer_completion = run_qka_stream(question, answer_text, result_list, "gpt-4o", "", 7000)
+            answer_text = get_cached_text(
+                "gpt-4o", question,
+                lambda: get_llm_governor("gpt-4o").run(lambda: run_qa(question, "gpt-4o", "", 1000)),
+                parameters={"function": "run_qa", "max_tokens": 1000},
+            )
+            answer_completion = self.get_knowledge_answer_completion(question, answer_text, result_list)
         else:
-            answer_completion = run_qa_stream(question, "gpt-4o", "", 1000)
+            answer_completion = self.get_parametric_answer_completion(question)
         return answer_completion, p_set
 
-    async def async_query(self, question, d_set, g_set, v_set):
-        logger.info(f"[qa] [question] {question}")
-
-        # parametric answering
-        async_qa_task = asyncio.create_task(
-            async_run_qa(question, "gpt-4o", "", 1000)
+    @staticmethod
+    def get_knowledge_answer_completion(question, answer_text, result_list):
+        return get_cached_completion_stream(
+            "gpt-4o", [question, answer_text, result_list],
+            lambda: get_llm_governor("gpt-4o").stream(
+                lambda: run_qka_stream(question, answer_text, result_list, "gpt-4o", "", 7000),
+            ),
+            parameters={"function": "run_qka_stream", "max_tokens": 7000},
         )
-        await asyncio.sleep(0)
 
-        # retrieval
-        logger.info(f"[qa] retrieving knowledge...")
-        search_result_list = self.retriever.search(
-            query=question,
-            return_docs=True,
-            cutoff=self.top_dgp,
+    @staticmethod
+    def get_parametric_answer_completion(question):
+        # same answer as run_qa, so both share one cache entry
+        return get_cached_completion_stream(
+            "gpt-4o", question,
+            lambda: get_llm_governor("gpt-4o").stream(lambda: run_qa_stream(question, "gpt-4o", "", 1000)),
+            parameters={"function": "run_qa", "max_tokens": 1000},
         )
-        logger.info(f"{len(search_result_list):,} search_results")
 
-        logger.info("[qa] filtering by targets...")
-        result_list = []
-        p_set = set()
-        t_set = set()
+    async def async_query(self, question, d_set, g_set, v_set):
+        logger.info(f"[qa] [question] {question}")
 
-        for search_result in search_result_list:
-            datum = search_result["datum"]
-            p, d_name_matches, g_name_matches, v_name_matches, triplet_list = datum
-            if not triplet_list:
-                continue
-            if d_set:
-                for d in d_set:
-                    if d in d_name_matches:
-                        break
-                else:
-                    continue
-            if g_set or v_set:
-                for g in g_set:
-                    if g in g_name_matches:
-                        break
-                else:
-                    for v2 in v_name_matches:
-                        i = v2.find("_")
-                        g2 = v2[:i]
-                        if g2 in g_set:
-                            break
-                    else:
-                        for v in v_set:
-                            if v in v_name_matches:
-                                break
-                        else:
-                            continue
-            result_list.append((p, triplet_list))
+        # parametric answering
+        async def get_answer_text():
+            async_gpt_task = await async_run_qa(question, "gpt-4o", "", 1000)
+            task_datum = await async_gpt_task
+            return task_datum.text_out_list[0]
 
-            p_set.add(p)
-            for head, predicate, tail in triplet_list:
-                t = f"{head} {predicate} {tail}".lower()
-                t_set.add(t)
-            if len(p_set) >= self.top_p and len(t_set) >= self.top_t:
-                break
-        pmids = len(p_set)
-        triplets = len(t_set)
-        logger.info(f"{len(result_list):,} filtered_results: {pmids:,} pmids; {triplets:,} triplets;")
+        async_qa_task = asyncio.create_task(async_get_cached_text(
+            "gpt-4o", question, lambda: get_llm_governor("gpt-4o").async_run(get_answer_text),
+            parameters={"function": "run_qa", "max_tokens": 1000},
+        ))
+        await asyncio.sleep(0)
+
+        # retrieval is CPU bound, so it runs in a worker thread while the parametric answer is generated
+        result_list, p_set = await asyncio.to_thread(self.search_and_filter, question, d_set, g_set, v_set)
 
         # combine retrieval and parametric answer
         if result_list:
-            async_gpt_task = await async_qa_task
-            task_datum = await async_gpt_task
-            answer_text = task_datum.text_out_list[0]
-            answer_completion = run_qka_stream(question, answer_text, result_list, "gpt-4o", "", 7000)
+            answer_text = await async_qa_task
+            answer_completion = self.get_knowledge_answer_completion(question, answer_text, result_list)
 
         else:
             async_qa_task.cancel()
-            answer_completion = run_qa_stream(question, "gpt-4o", "", 1000)
+            answer_completion = self.get_parametric_answer_completion(question)
 
         return answer_completion, p_set
 
@@ -2858,6 +5760,7 @@ class CGDInferenceKB:
                 for result in result_list:
                     query_dict[result] = True
                 del result_list
+        get_request_deadline().check("CGD inference")
 
         # retrieve CD data indices
         index_list = []
@@ -2888,8 +5791,12 @@ class CGDInferenceKB:
 
         # collect data
         #   path data should have been sorted by score
+        request_deadline = get_request_deadline()
         cd_data = []
         for index in index_list:
+            if request_deadline.is_expired():
+                logger.info(f"[CGD Inference KB] request deadline reached after {len(cd_data):,} CDs")
+                break
             c, d, cd_score, pathlist = json.loads(self.cd_index_to_path_db[json.dumps(index)])
             all_cgds = len(pathlist)
             cgd_data = []
@@ -2910,7 +5817,13 @@ class CGDInferenceKB:
 
 
 def run_paper_qa(question, paper_list):
-    completion = run_pqa_stream(question, paper_list, "gpt-4o", "", 7000)
+    completion = get_cached_completion_stream(
+        "gpt-4o", [question, paper_list],
+        lambda: get_llm_governor("gpt-4o").stream(
+            lambda: run_pqa_stream(question, paper_list, "gpt-4o", "", 7000),
+        ),
+        parameters={"function": "run_pqa_stream", "max_tokens": 7000},
+    )
     return completion
 
 
@@ -3048,6 +5961,66 @@ def test_kb(kb_dir):
     return
 
 
+def get_rss_mb():
+    with open("/proc/self/status", "r", encoding="utf8") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def test_query_embedding_backend(backend, onnx_file=None, query_file=None, runs=3):
+    # held-out queries, one per line
+    if query_file:
+        query_list = read_lines(query_file)
+    else:
+        query_list = [
+            "What is the role of BRAF V600E in melanoma?",
+            "Does metformin reduce cancer risk in patients with type 2 diabetes?",
+            "rs113488022",
+            "EGFR tyrosine kinase inhibitor resistance in non-small cell lung cancer",
+            "Which genes are associated with hypertrophic cardiomyopathy?",
+            "Is CRISPR-Cas9 gene editing effective for sickle cell disease?",
+            "TP53 mutations and prognosis in breast cancer",
+            "Statin use and risk of Alzheimer's disease",
+        ]
+    query_list = [f"query: {query}" for query in query_list]
+    model = "Snowflake/snowflake-arctic-embed-l-v2.0"
+
+    name_to_embedding = {}
+    for name in ["torch", backend]:
+        rss = get_rss_mb()
+        start_time = time.time()
+        embedding_model = TransformersEmbedding(model, max_length=8192, backend=name, onnx_file=onnx_file)
+        load_time = time.time() - start_time
+        model_rss = get_rss_mb() - rss
+
+        # one query per forward pass, as in EmbeddingPaperRetriever.query()
+        latency_list = []
+        embedding_list = []
+        for _ in range(runs):
+            embedding_list = []
+            for query in query_list:
+                start_time = time.time()
+                embedding_list.append(embedding_model.embed([query])[0])
+                latency_list.append(time.time() - start_time)
+        name_to_embedding[name] = np.stack(embedding_list)
+
+        latency_list = sorted(latency_list)
+        p50 = latency_list[len(latency_list) // 2] * 1000
+        p95 = latency_list[min(len(latency_list) - 1, int(len(latency_list) * 0.95))] * 1000
+        logger.info(
+            f"[{name}] load={load_time:.1f} sec, model RSS={model_rss:,.0f} MB,"
+            f" latency p50={p50:.1f} ms, p95={p95:.1f} ms"
+        )
+        del embedding_model
+
+    # cosine agreement against fp32, embeddings are L2 normalized
+    cosine = np.sum(name_to_embedding["torch"] * name_to_embedding[backend], axis=1)
+    logger.info(f"[{backend} vs torch] cosine mean={cosine.mean():.4f}, min={cosine.min():.4f}")
+    return cosine
+
+
 def test_meta(meta_dir):
     kb_meta = Meta(meta_dir)
 
@@ -3069,6 +6042,16 @@ def main():
 
     parser.add_argument("--meta_dir", type=str, default="/volume/penghsuanli-genome2-nas2/pubtator/data/meta")
 
+    parser.add_argument("--nen_dir", type=str)
+
+    parser.add_argument("--query_embedding_backend", type=str, default="torch-int8")
+    parser.add_argument("--query_embedding_onnx_file", type=str)
+    parser.add_argument("--query_file", type=str)
+
+    parser.add_argument("--qdrant_server", type=str)
+    parser.add_argument("--qdrant_collection", type=str)
+    parser.add_argument("--embedding_store_dir", type=str)
+
     arg = parser.parse_args()
     for key, value in vars(arg).items():
         if value is not None:
@@ -3077,6 +6060,12 @@ def main():
     # test_v2g(arg.variant_dir, arg.gene_dir)
     # test_kb(arg.kb_dir)
     # test_meta(arg.meta_dir)
+    # build_nen_qgram_index(arg.nen_dir)
+    # build_nen_type_id_name_index(arg.nen_dir)
+    # build_kb_umbrella_index(arg.kb_dir)
+    # build_kb_pmid_index(arg.kb_dir)
+    # test_query_embedding_backend(arg.query_embedding_backend, arg.query_embedding_onnx_file, arg.query_file)
+    # build_local_embedding_store(arg.qdrant_server, arg.qdrant_collection, arg.embedding_store_dir)
     return
 
 
@@ -4,26 +4,31 @@ import sys
 import copy
 import html
 import json
+import math
+import hashlib
 import time
 import asyncio
 import logging
+import contextvars
 import traceback
 import urllib.parse
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, render_template, request, stream_with_context
+from flask import Flask, Response, g, render_template, request, stream_with_context
+from openai import OpenAI, AuthenticationError
 
 from kb_utils import query_variant, NEN, V2G
 from kb_utils import NCBIGene, VariantNEN, KB, PaperKB, GeVarToGLOF, Meta
 from kb_utils import GVDScore, GDScore, DiseaseToGene
 from kb_utils import MESHNameKB, MESHGraph, MESHChemical, ChemicalDiseaseKB
-from kb_utils import ner_gvdc_mapping, entity_type_to_real_type_mapping
+from kb_utils import ner_gvdc_mapping
 from kb_utils import get_paper_meta_html
 from kb_utils import CGDInferenceKB
 from kb_utils import NCBIGene2025
 from kb_utils import UMLSIndex, UMLSDoc, UMLSPaperRetriever
 from kb_utils import PaperImpactRanker, UMLSImpactPaperRetriever, EmbeddingPaperRetriever
-from kb_utils import UMLSImpactEmbeddingPaperRetriever, PaperText, PubMedQA
+from kb_utils import UMLSImpactEmbeddingPaperRetriever, PaperText, PubMedQA, CircuitBreaker
 from summary_utils import Summary
 from VarSum_germline import GermlineVarSum
 try:
@@ -32,6 +37,12 @@ try:
 except ModuleNotFoundError:
     pass
 from kb_utils import QA, run_paper_qa
+from kb_utils import configure_llm_cache, get_cached_text, get_llm_cache_stats
+from kb_utils import RateLimiter, LLMQueueTimeout, configure_llm_governor, get_llm_governor, get_llm_governor_stats
+from kb_utils import Deadline, DeadlineExceeded, set_request_deadline, get_request_deadline, partial_result_message
+from kb_utils import busy_result_message
+from kb_utils import AdmissionRejected, configure_bulkhead, get_bulkhead, get_bulkhead_stats, bulkhead_context
+from kb_utils import get_single_flight, get_single_flight_stats
 
 app = Flask(__name__)
 logger = logging.getLogger(__name__)
@@ -80,6 +91,54 @@ paper_text = PaperText(None)
 pubmed_qa = PubMedQA(None, None)
 kb_type = None
 show_aid = False
+litsum_executor = ThreadPoolExecutor(max_workers=8)
+litsum_rate_limiter = RateLimiter()
+litsum_model = "gpt-4o"
+litsum_prompt_version = 1
+litsum_api_key_hash_set = set()
+request_timeout_dict = {}
+max_request_timeout = 600
+
+# endpoint -> cost class, each class admitted by its own bulkhead; other endpoints are "cheap"
+endpoint_to_cost_class = {
+    **{
+        endpoint: "heavy"
+        for endpoint in [
+            "/run_rel", "/query_rel", "/query_rel_statistics",
+            "/run_umls_doc", "/query_umls_doc",
+            "/run_disease_to_gene", "/query_disease_to_gene",
+            "/run_cgd_drug_discovery", "/query_cgd_drug_discovery",
+            "/run_umls_paper_search", "/query_umls_paper_search",
+            "/run_umls_impact_paper_search", "/query_umls_impact_paper_search",
+            "/run_umls_impact_embedding_paper_search", "/query_umls_impact_embedding_paper_search",
+            "/run_question_to_paper", "/query_question_to_paper",
+            "/run_gvd_stats", "/query_gvd_stats",
+            "/run_gd_db", "/query_gd_db",
+            "/run_mesh_disease", "/query_mesh_disease",
+            "/run_chemical_disease", "/query_chemical_disease",
+            "/run_varsum", "/query_varsum",
+            "/query_name_to_id_alias_batch",
+        ]
+    },
+    **{
+        endpoint: "llm"
+        for endpoint in [
+            "/run_qa", "/query_qa",
+            "/run_pubmed_qa", "/query_pubmed_qa",
+            "/run_litsum", "/query_litsum",
+            "/run_chemical_disease_qa", "/query_chemical_disease_qa",
+            "/run_yolo",
+        ]
+    },
+    # never configured, so metrics stay reachable when the other classes are full
+    **{
+        endpoint: "stats"
+        for endpoint in [
+            "/query_llm_governor_stats", "/query_circuit_breaker_stats", "/query_llm_cache_stats",
+            "/query_admission_stats", "/query_single_flight_stats",
+        ]
+    },
+}
 
 
 @app.route("/")
@@ -404,6 +463,80 @@ def query_name_to_id_alias():
     return json.dumps(response)
 
 
+@app.route("/query_name_to_id_alias_batch", methods=["GET", "POST"])
+def query_name_to_id_alias_batch():
+    # url argument (GET: query_list is a json list) or json body (POST: query_list is a list)
+    if request.method == "POST":
+        arg = json.loads(request.data)
+        query_list = arg["query_list"]
+    else:
+        arg = request.args
+        query_list = json.loads(arg["query_list"])
+
+    query_list = [query.strip() for query in query_list]
+    case_sensitive = arg.get("case_sensitive", "N") == "Y"
+    max_length_diff = int(arg.get("max_length_diff", 1))
+    min_similarity = float(arg.get("min_similarity", 0.85))
+    max_names = int(arg.get("max_names", 20))
+    max_aliases = int(arg.get("max_aliases", 20))
+
+    queries = len(query_list)
+    unique_queries = len(set(query_list))
+    logger.info(
+        f"queries={queries:,}"
+        f" unique_queries={unique_queries:,}"
+        f" case_sensitive={case_sensitive}"
+        f" max_length_diff={max_length_diff}"
+        f" min_similarity_ratio={min_similarity}"
+        f" max_aliases={max_aliases}"
+    )
+
+    def response_generator():
+        start_time = time.time()
+
+        # one json line per query, in the order of query_list
+        for query, match_list in nen.resolve_many(
+                query_list,
+                case_sensitive=case_sensitive,
+                max_length_diff=max_length_diff,
+                min_similarity=min_similarity,
+                max_names=max_names,
+                max_aliases=max_aliases,
+        ):
+            response = {
+                "query": query,
+                "match_list": [
+                    {
+                        "name": name,
+                        "similarity": similarity,
+                        "type_id_alias_list": [
+                            {
+                                "type": _type,
+                                "id": _id,
+                                "type_id_name_frequency": id_frequency,
+                                "alias_list": [
+                                    {
+                                        "alias": alias,
+                                        "type_id_alias_frequency": alias_frequency,
+                                    }
+                                    for alias, alias_frequency in alias_frequency_list
+                                ],
+                            }
+                            for _type, _id, id_frequency, alias_frequency_list in type_id_alias_list
+                        ],
+                    }
+                    for name, similarity, type_id_alias_list in match_list
+                ],
+            }
+            yield json.dumps(response) + "\n"
+
+        total_time = time.time() - start_time
+        logger.info(f"[NEN batch] resolved {queries:,} queries in {total_time:.1f}s")
+        return
+
+    return Response(stream_with_context(response_generator()), mimetype="application/x-ndjson")
+
+
 @app.route("/run_id_to_name", methods=["POST"])
 def run_id_to_name():
     arg = json.loads(request.data)
@@ -413,11 +546,8 @@ def run_id_to_name():
 
     logger.info(f"[query] type={_type} id={_id}")
 
-    # expand the umbrella type to real types and query KB
-    name_frequency_list = []
-    for _type in entity_type_to_real_type_mapping.get(_type, [_type]):
-        name_frequency_list += nen.get_aliases_by_id(_type, _id, max_aliases=top_k)
-    name_frequency_list = sorted(name_frequency_list, key=lambda nf: -nf[1])[:top_k]
+    # umbrella types are expanded to real types, or pre-merged in the NEN index
+    name_frequency_list = nen.get_aliases_by_umbrella_id(_type, _id, max_aliases=top_k)
 
     # table html
     table_html = f"<table><tr><th>Name</th><th>Frequency</th></tr>"
@@ -455,11 +585,8 @@ def query_id_to_name():
 
     logger.info(f"[query] type={_type} id={_id}")
 
-    # expand the umbrella type to real types and query KB
-    name_frequency_list = []
-    for _type in entity_type_to_real_type_mapping.get(_type, [_type]):
-        name_frequency_list += nen.get_aliases_by_id(_type, _id, max_aliases=top_k)
-    name_frequency_list = sorted(name_frequency_list, key=lambda nf: -nf[1])[:top_k]
+    # umbrella types are expanded to real types, or pre-merged in the NEN index
+    name_frequency_list = nen.get_aliases_by_umbrella_id(_type, _id, max_aliases=top_k)
     response["name_frequency_list"] = name_frequency_list
 
     return json.dumps(response)
@@ -759,9 +886,11 @@ class Rel:
         self.raw_arg = raw_arg
         self.str_arg = str_arg
         self.arg = copy.deepcopy(str_arg)
+        self.deadline = get_request_deadline()
 
         self.paper_list = []
         self.statistics = {}
+        self.is_partial = False
 
         self.text_summary = {}
         self.html_summary = ""
@@ -843,6 +972,7 @@ class Rel:
 
             elif arg["paper_sort"] == "citation":
                 for pi, paper in enumerate(paper_list):
+                    self.deadline.check("paper sorting")
                     paper.get_meta()
                     try:
                         citation = int(paper.meta["citation"])
@@ -852,6 +982,7 @@ class Rel:
 
             elif arg["paper_sort"] == "year":
                 for pi, paper in enumerate(paper_list):
+                    self.deadline.check("paper sorting")
                     paper.get_meta()
                     try:
                         year = int(paper.meta["year"])
@@ -861,6 +992,7 @@ class Rel:
 
             elif arg["paper_sort"] == "journal_impact":
                 for pi, paper in enumerate(paper_list):
+                    self.deadline.check("paper sorting")
                     paper.get_meta()
                     try:
                         journal_impact = float(paper.meta["journal_impact"])
@@ -881,12 +1013,23 @@ class Rel:
         self.paper_list = paper_list
         return
 
+    def truncate_paper_list(self, papers):
+        # keep the papers already processed when the request deadline is reached
+        logger.info(f"[Rel] request deadline reached, returning {papers:,}/{len(self.paper_list):,} papers")
+        self.paper_list = self.paper_list[:papers]
+        self.is_partial = True
+        return
+
     def get_paper_relation(self):
-        for paper in self.paper_list:
+        for pi, paper in enumerate(self.paper_list):
+            if self.deadline.is_expired():
+                self.truncate_paper_list(pi)
+                break
             paper.get_sentence_and_relation()
         return
 
     def get_paper_meta(self):
+        # meta lookups are cheap, so every paper kept by get_paper_relation() gets its meta
         for paper in self.paper_list:
             if not paper.meta:
                 paper.get_meta()
@@ -924,7 +1067,11 @@ class Rel:
     def get_summary(self):
         arg = self.arg
 
-        if kb_type == "relation" and self.paper_list:
+        if self.deadline.is_expired():
+            logger.info("[summary] request deadline reached, skipped")
+            self.is_partial = True
+
+        if kb_type == "relation" and self.paper_list and not self.is_partial:
             try:
                 summary = Summary(self.paper_list, arg["e1_spec"], arg["e2_spec"], arg["pmid"])
                 summary.run_pipeline()
@@ -1091,8 +1238,10 @@ def run_rel():
     relation_table_html += "</table>"
 
     # combined html
+    partial_html = f"<div>{html.escape(partial_result_message)}</div><br />" if rel.is_partial else ""
     result = \
-        rel.html_summary \
+        partial_html \
+        + rel.html_summary \
         + "<br /><br />" \
         + statistics_table_html \
         + "<br /><br />" \
@@ -1113,26 +1262,32 @@ def query_rel():
         raw_arg = json.loads(request.data)
 
     rel = Rel(raw_arg)
-    rel.run_pipeline()
 
-    response = {
-        "url_argument": rel.str_arg,
-        "result_statistics": rel.statistics,
-        "paper_list": [
-            {
-                "pmid": paper.pmid,
-                "meta": paper.meta,
-                "sentence_data": paper.sentence_index_to_sentence_mention,
-                "annotator_to_relation": paper.annotator_to_relation,
-            }
-            for paper in rel.paper_list
-        ],
-        "summary": {
-            "text_summary": rel.text_summary,
-            "html_summary": rel.html_summary,
-        },
-    }
-    return json.dumps(response)
+    def run():
+        rel.run_pipeline()
+
+        response = {
+            "url_argument": rel.str_arg,
+            "result_statistics": rel.statistics,
+            "is_partial": rel.is_partial,
+            "paper_list": [
+                {
+                    "pmid": paper.pmid,
+                    "meta": paper.meta,
+                    "sentence_data": paper.sentence_index_to_sentence_mention,
+                    "annotator_to_relation": paper.annotator_to_relation,
+                }
+                for paper in rel.paper_list
+            ],
+            "summary": {
+                "text_summary": rel.text_summary,
+                "html_summary": rel.html_summary,
+            },
+        }
+        return json.dumps(response)
+
+    # identical concurrent queries share one run
+    return get_single_flight(request.path).run(get_request_key(request.path, rel.str_arg), run)
 
 
 @app.route("/query_rel_statistics", methods=["GET", "POST"])
@@ -1563,35 +1718,135 @@ def query_varsum():
     return json.dumps(response)
 
 
-@app.route("/run_litsum", methods=["POST"])
-def run_litsum():
-    # argument
-    data = json.loads(request.data)
-    gpt_utils.openai.api_key = data["openai_api_key"]
-    query = json.loads(data["query"])
-    logger.info(f"query={query}")
+class InvalidAPIKey(Exception):
+    pass
 
-    entity_1 = query["entity_1"]
-    entity_2 = query["entity_2"]
-    pmid_list = query["pmid_list"]
 
-    # paper summary
-    paper_html_list = []
-    papergpt_list = []
+def check_litsum_api_key(api_key):
+    """
+    Cached summaries skip the LLM call, so the key of the request is checked with the provider first;
+    accepted keys are remembered by hash
+    """
+    if not api_key:
+        raise InvalidAPIKey("openai_api_key is required")
+    key_hash = hashlib.sha256(api_key.encode("utf8")).hexdigest()
+    if key_hash in litsum_api_key_hash_set:
+        return
+
+    try:
+        with OpenAI(api_key=api_key, max_retries=0, timeout=10.0) as client:
+            client.models.list()
+    except AuthenticationError:
+        raise InvalidAPIKey("openai_api_key is not accepted by the LLM provider")
+    litsum_api_key_hash_set.add(key_hash)
+    return
+
+
+def get_litsum_model(gpt):
+    # gpt_utils picks the model; litsum_model names it for the cache key when the instance does not
+    return getattr(gpt, "model", None) or litsum_model
+
+
+def get_gpt_state(gpt):
+    # every attribute that survives json, e.g., paper_summary of PaperGPT, which ReviewGPT reads
+    state = {}
+    for name, value in vars(gpt).items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        state[name] = value
+    return state
+
+
+def get_paper_summary(papergpt, pmid, title, abstract, entity_1, entity_2):
+    def generate():
+        get_llm_governor("gpt").run(papergpt.get_paper_summary)
+        return json.dumps(get_gpt_state(papergpt))
 
+    # keyed by the model and prompt version, so a new model or prompt does not serve stale summaries;
+    # a hit restores the whole state left by get_paper_summary(), not only paper_summary
+    state = get_cached_text(
+        get_litsum_model(papergpt), [pmid, title, abstract, entity_1, entity_2], generate,
+        parameters={"function": "PaperGPT.get_paper_summary", "prompt_version": litsum_prompt_version, "state": True},
+    )
+    vars(papergpt).update(json.loads(state))
+    return
+
+
+def get_review_summary(reviewgpt, papergpt_list, entity_1, entity_2):
+    def generate():
+        get_llm_governor("gpt").run(reviewgpt.get_summary)
+        return json.dumps(get_gpt_state(reviewgpt))
+
+    paper_state_list = [get_gpt_state(papergpt) for papergpt in papergpt_list]
+    try:
+        state = get_cached_text(
+            get_litsum_model(reviewgpt), [paper_state_list, entity_1, entity_2], generate,
+            parameters={"function": "ReviewGPT.get_summary", "prompt_version": litsum_prompt_version, "state": True},
+        )
+        vars(reviewgpt).update(json.loads(state))
+    except DeadlineExceeded as e:
+        # keep the paper summaries already written
+        logger.info(f"[litsum] review: {e}")
+        reviewgpt.summary = f"No review. {partial_result_message}"
+    return
+
+
+def get_litsum_paper_list(entity_1, entity_2, pmid_list):
+    """
+
+    :return: [(pmid, title, abstract, papergpt), ...] in pmid_list order;
+        papergpt is None if the paper is not found or the request deadline is reached before its summary
+    """
+    start_time = time.time()
+
+    # paper_nen reads through one shared file handle, so papers are read here, before the fan-out
+    paper_list = []
     for pmid in pmid_list:
         paper = paper_nen.query_data(pmid)
-        title = paper["title"]
-        abstract = paper["abstract"]
+        paper_list.append((pmid, paper["title"], paper["abstract"]))
+
+    def run_paper(pmid, title, abstract):
+        if not title and not abstract:
+            return pmid, title, abstract, None
 
-        if title or abstract:
+        try:
+            litsum_rate_limiter.wait()
             papergpt = PaperGPT(pmid, title, abstract, entity_1, entity_2)
-            papergpt.get_paper_summary()
+            get_paper_summary(papergpt, pmid, title, abstract, entity_1, entity_2)
+        except DeadlineExceeded as e:
+            logger.info(f"[litsum] {pmid}: {e}")
+            papergpt = None
+        return pmid, title, abstract, papergpt
+
+    # summaries run concurrently across papers, bounded by the shared executor;
+    # each task runs in a copy of the request context, so it sees the request deadline
+    context_list = [contextvars.copy_context() for _paper in paper_list]
+    paper_list = list(litsum_executor.map(
+        lambda context, paper: context.run(run_paper, *paper), context_list, paper_list,
+    ))
+
+    run_time = time.time() - start_time
+    logger.info(f"[litsum] summarized {len(paper_list):,} papers in {run_time:.1f} sec")
+    return paper_list
+
+
+def get_litsum_html(entity_1, entity_2, pmid_list):
+    # paper summary
+    paper_html_list = []
+    papergpt_list = []
+
+    for pmid, title, abstract, papergpt in get_litsum_paper_list(entity_1, entity_2, pmid_list):
+        if papergpt:
             papergpt_list.append(papergpt)
 
             title_html = html.escape(title)
             summary_html = html.escape(papergpt.paper_summary)
             summary_html = summary_html.replace("\n", "<br />")
+        elif title or abstract:
+            title_html = html.escape(title)
+            summary_html = html.escape(f"No summary. {partial_result_message}")
         else:
             title_html = "Paper not found"
             summary_html = "No summary."
@@ -1610,50 +1865,23 @@ def run_litsum():
 
     # review summary
     reviewgpt = ReviewGPT(papergpt_list, entity_1, entity_2)
-    reviewgpt.get_summary()
+    get_review_summary(reviewgpt, papergpt_list, entity_1, entity_2)
     review_html = html.escape(reviewgpt.summary)
 
     result = \
         f'<div style="font-size: 16px; font-weight: bold; line-height: 200%;">[REVIEW] {entity_1} and {entity_2}</div><br />' \
         f'<div style="font-size: 16px; line-height: 200%;">{review_html}</div><br /><hr /><br />' \
         f"{all_paper_html}"
+    return result
 
-    response = {"result": result}
-    return json.dumps(response)
-
-
-@app.route("/query_litsum")
-def query_litsum():
-    response = {}
-
-    # url argument
-    openai_api_key = request.args.get("openai_api_key")
-    gpt_utils.openai.api_key = openai_api_key
-
-    query = request.args.get("query")
-    response["url_argument"] = {
-        "query": query,
-        "openai_api_key": "yolo",
-    }
-    query = json.loads(query)
-    logger.info(f"query={query}")
-
-    entity_1 = query["entity_1"]
-    entity_2 = query["entity_2"]
-    pmid_list = query["pmid_list"]
 
+def get_litsum_summary(entity_1, entity_2, pmid_list):
     # paper summary
     paper_summary_list = []
     papergpt_list = []
 
-    for pmid in pmid_list:
-        paper = paper_nen.query_data(pmid)
-        title = paper["title"]
-        abstract = paper["abstract"]
-
-        if title or abstract:
-            papergpt = PaperGPT(pmid, title, abstract, entity_1, entity_2)
-            papergpt.get_paper_summary()
+    for pmid, title, abstract, papergpt in get_litsum_paper_list(entity_1, entity_2, pmid_list):
+        if papergpt:
             papergpt_list.append(papergpt)
 
             paper_summary_list.append({
@@ -1667,16 +1895,51 @@ def query_litsum():
                 "pmid": pmid,
                 "title": title,
                 "abstract": abstract,
-                "summary": "No summary.",
+                "summary": f"No summary. {partial_result_message}" if title or abstract else "No summary.",
             })
 
-    response["paper_summary_list"] = paper_summary_list
-
     # review summary
     reviewgpt = ReviewGPT(papergpt_list, entity_1, entity_2)
-    reviewgpt.get_summary()
-    response["review_summary"] = reviewgpt.summary
+    get_review_summary(reviewgpt, papergpt_list, entity_1, entity_2)
+    return paper_summary_list, reviewgpt.summary
+
+
+@app.route("/run_litsum", methods=["POST"])
+def run_litsum():
+    # argument
+    data = json.loads(request.data)
+    check_litsum_api_key(data.get("openai_api_key"))
+    gpt_utils.openai.api_key = data["openai_api_key"]
+    query = json.loads(data["query"])
+    logger.info(f"query={query}")
+
+    result = get_litsum_html(query["entity_1"], query["entity_2"], query["pmid_list"])
+    response = {"result": result}
+    return json.dumps(response)
+
+
+@app.route("/query_litsum")
+def query_litsum():
+    response = {}
+
+    # url argument
+    openai_api_key = request.args.get("openai_api_key")
+    check_litsum_api_key(openai_api_key)
+    gpt_utils.openai.api_key = openai_api_key
+
+    query = request.args.get("query")
+    response["url_argument"] = {
+        "query": query,
+        "openai_api_key": "yolo",
+    }
+    query = json.loads(query)
+    logger.info(f"query={query}")
 
+    paper_summary_list, review_summary = get_litsum_summary(
+        query["entity_1"], query["entity_2"], query["pmid_list"],
+    )
+    response["paper_summary_list"] = paper_summary_list
+    response["review_summary"] = review_summary
     return json.dumps(response)
 
 
@@ -2131,57 +2394,61 @@ def query_disease_to_gene():
     }
     logger.info(f"query={query}")
 
-    # mesh
-    query_mesh_list = query.get("mesh_list", [])
-    query_disease_list = query.get("disease_list", [])
-    mesh_to_disease, disease_to_mesh = get_term_mesh_mapping_for_disease_to_gene(query_mesh_list, query_disease_list)
-    for disease, mesh_set in disease_to_mesh.items():
-        logger.info(f"[query] disease={disease} mesh_set={mesh_set}")
-
-    # query the score of each <disease, gene> pair
-    (
-        gene_score_list, disease_to_gene_list, gene_disease_score,
-    ) = disease_to_gene.get_score(mesh_to_disease, disease_to_mesh)
+    def run():
+        # mesh
+        query_mesh_list = query.get("mesh_list", [])
+        query_disease_list = query.get("disease_list", [])
+        mesh_to_disease, disease_to_mesh = get_term_mesh_mapping_for_disease_to_gene(query_mesh_list, query_disease_list)
+        for disease, mesh_set in disease_to_mesh.items():
+            logger.info(f"[query] disease={disease} mesh_set={mesh_set}")
+
+        # query the score of each <disease, gene> pair
+        (
+            gene_score_list, disease_to_gene_list, gene_disease_score,
+        ) = disease_to_gene.get_score(mesh_to_disease, disease_to_mesh)
+
+        # (gene, name) -> score
+        gene_to_name = {}
+        gene_name_score_list = []
+        for gene, score in gene_score_list:
+            name = ncbi_gene.id_to_name.get(gene, "-")
+            gene_to_name[gene] = name
+            gene_name_score_list.append(((gene, name), f"{score:.2f}"))
+
+        # (disease, mesh_list) -> [(gene, name), ...]
+        disease_gene_list = []
+        for disease, gene_list in disease_to_gene_list.items():
+            mesh_set = disease_to_mesh[disease]
+            if mesh_set:
+                mesh_list = list(mesh_set)
+            else:
+                mesh_list = ["-"]
 
-    # (gene, name) -> score
-    gene_to_name = {}
-    gene_name_score_list = []
-    for gene, score in gene_score_list:
-        name = ncbi_gene.id_to_name.get(gene, "-")
-        gene_to_name[gene] = name
-        gene_name_score_list.append(((gene, name), f"{score:.2f}"))
-
-    # (disease, mesh_list) -> [(gene, name), ...]
-    disease_gene_list = []
-    for disease, gene_list in disease_to_gene_list.items():
-        mesh_set = disease_to_mesh[disease]
-        if mesh_set:
-            mesh_list = list(mesh_set)
-        else:
-            mesh_list = ["-"]
+            gene_list = [
+                (gene, gene_to_name[gene])
+                for gene in gene_list
+            ]
 
-        gene_list = [
-            (gene, gene_to_name[gene])
-            for gene in gene_list
-        ]
+            disease_gene_list.append(((disease, mesh_list), gene_list))
 
-        disease_gene_list.append(((disease, mesh_list), gene_list))
+        # (gene, name) -> [(disease, score), ...]
+        gene_disease_score_list = []
+        for gene, _score in gene_score_list:
+            gene_disease_score_list.append([
+                (gene, gene_to_name[gene]),
+                [
+                    (disease, f"{score:.2f}")
+                    for disease, score in gene_disease_score[gene].items()
+                ]
+            ])
 
-    # (gene, name) -> [(disease, score), ...]
-    gene_disease_score_list = []
-    for gene, _score in gene_score_list:
-        gene_disease_score_list.append([
-            (gene, gene_to_name[gene]),
-            [
-                (disease, f"{score:.2f}")
-                for disease, score in gene_disease_score[gene].items()
-            ]
-        ])
+        response["gene_score_list"] = gene_name_score_list
+        response["disease_gene_list"] = disease_gene_list
+        response["gene_disease_score_list"] = gene_disease_score_list
+        return json.dumps(response)
 
-    response["gene_score_list"] = gene_name_score_list
-    response["disease_gene_list"] = disease_gene_list
-    response["gene_disease_score_list"] = gene_disease_score_list
-    return json.dumps(response)
+    # identical concurrent queries share one run
+    return get_single_flight(request.path).run(get_request_key(request.path, query), run)
 
 
 @app.route("/run_mesh_disease", methods=["POST"])
@@ -2566,15 +2833,7 @@ def query_question_to_paper():
     return json.dumps(response)
 
 
-@app.route("/run_qa", methods=["GET", "POST"])
-def run_qa():
-    # query
-    if request.method == "GET":
-        query = json.loads(request.args.get("query"))
-    else:
-        query = json.loads(request.data)["query"]
-    logger.info(f"[run_qa:query] {query}")
-
+def get_qa_target_set(query, lower_variant_name=True):
     # disease
     d_set = set(query.get("disease_id_list", []))
     d_name_set = set(query.get("disease_name_list", []))
@@ -2611,18 +2870,15 @@ def run_qa():
         else:
             continue
 
-        for v_v in variant_nen.name_to_id.get(v_v_name.lower(), []):
+        for v_v in variant_nen.name_to_id.get(v_v_name.lower() if lower_variant_name else v_v_name, []):
             v = v_g + "_" + v_v
             v_set.add(v)
     logger.info(f"v_set={v_set}")
 
-    # qa
-    question = query["question"]
-    answer_completion, p_set = asyncio.run(
-        qa.async_query(question, d_set, g_set, v_set)
-    )
+    return d_set, g_set, v_set
 
-    # reference
+
+def get_qa_reference_line_list(p_set):
     pmid_to_meta = {
         p: kb_meta.get_meta_by_pmid(p)
         for p in p_set
@@ -2651,23 +2907,66 @@ def run_qa():
             + f"<td>{citation}</td></tr>"
         )
     reference_line_list.append("</table>")
+    return reference_line_list
 
-    def response():
-        yield '<div class="answer">'
+
+def get_qa_html_stream(answer_completion, reference_line_list):
+    yield '<div class="answer">'
+    try:
         for chunk in answer_completion:
             text = chunk.choices[0].delta.content
             if text:
                 text = html.escape(text)
                 text = text.replace("\n", "<br />")
                 yield text
-        yield "</div>"
-        yield "<br /><br />"
-        for line in reference_line_list:
-            yield line
-        yield "<br /><br /><br /><br /><br />"
-        return
+    except LLMQueueTimeout as e:
+        # the governor slot is taken on the first chunk, after the response has started
+        logger.info(f"[qa] {e}")
+        yield "<br /><br />" + html.escape(busy_result_message)
+    except DeadlineExceeded as e:
+        logger.info(f"[qa] {e}")
+        yield "<br /><br />" + html.escape(partial_result_message)
+    yield "</div>"
+    yield "<br /><br />"
+    for line in reference_line_list:
+        yield line
+    yield "<br /><br /><br /><br /><br />"
+    return
 
-    return stream_with_context(response())
+
+def get_qa_answer(answer_completion):
+    answer = ""
+    try:
+        for chunk in answer_completion:
+            text = chunk.choices[0].delta.content
+            if text:
+                answer += text
+    except DeadlineExceeded as e:
+        logger.info(f"[qa] {e}")
+        answer += f"\n\n{partial_result_message}"
+    return answer
+
+
+@app.route("/run_qa", methods=["GET", "POST"])
+def run_qa():
+    # query
+    if request.method == "GET":
+        query = json.loads(request.args.get("query"))
+    else:
+        query = json.loads(request.data)["query"]
+    logger.info(f"[run_qa:query] {query}")
+
+    # qa
+    d_set, g_set, v_set = get_qa_target_set(query)
+    question = query["question"]
+    answer_completion, p_set = asyncio.run(
+        qa.async_query(question, d_set, g_set, v_set)
+    )
+
+    # reference
+    reference_line_list = get_qa_reference_line_list(p_set)
+
+    return stream_with_context(get_qa_html_stream(answer_completion, reference_line_list))
 
 
 @app.route("/query_qa", methods=["GET", "POST"])
@@ -2685,57 +2984,13 @@ def query_qa():
         "query": query,
     }
 
-    # disease
-    d_set = set(query.get("disease_id_list", []))
-    d_name_set = set(query.get("disease_name_list", []))
-    for d_name in d_name_set:
-        mesh_set = mesh_name_kb.get_mesh_id_by_all_source_name(d_name)
-        for mesh in mesh_set:
-            d_set.add(mesh)
-    logger.info(f"d_set={d_set}")
-
-    # gene
-    g_set = set(query.get("gene_id_list", []))
-    g_name_set = set(query.get("gene_name_list", []))
-    for g_name in g_name_set:
-        if g_name in ncbi_gene.name_to_id:
-            g_set.add(ncbi_gene.name_to_id[g_name])
-        elif g_name in ncbi_gene.alias_to_id:
-            g_set.add(ncbi_gene.alias_to_id[g_name])
-    logger.info(f"g_set={g_set}")
-
-    # variant
-    v_set = set(query.get("variant_id_list", []))
-    v_name_set = set(query.get("variant_name_list", []))
-    for v_name in v_name_set:
-        i = v_name.find("_")
-        if i == -1:
-            continue
-
-        v_g_name, v_v_name = v_name[:i], v_name[i + 1:]
-        if v_g_name in ncbi_gene.name_to_id:
-            v_g = ncbi_gene.name_to_id[v_g_name]
-        elif v_g_name in ncbi_gene.alias_to_id:
-            v_g = ncbi_gene.alias_to_id[v_g_name]
-        else:
-            continue
-
-        for v_v in variant_nen.name_to_id.get(v_v_name, []):
-            v = v_g + "_" + v_v
-            v_set.add(v)
-    logger.info(f"v_set={v_set}")
-
     # qa
+    d_set, g_set, v_set = get_qa_target_set(query, lower_variant_name=False)
     question = query["question"]
     answer_completion, p_set = asyncio.run(
         qa.async_query(question, d_set, g_set, v_set)
     )
-    answer = ""
-    for chunk in answer_completion:
-        text = chunk.choices[0].delta.content
-        if text:
-            answer += text
-    response["answer"] = answer
+    response["answer"] = get_qa_answer(answer_completion)
     response["pmid_list"] = list(p_set)
 
     return json.dumps(response)
@@ -3149,12 +3404,19 @@ def run_chemical_disease_qa():
 
     def response():
         yield '<div class="answer">'
-        for chunk in answer_completion:
-            text = chunk.choices[0].delta.content
-            if text:
-                text = html.escape(text)
-                text = text.replace("\n", "<br />")
-                yield text
+        try:
+            for chunk in answer_completion:
+                text = chunk.choices[0].delta.content
+                if text:
+                    text = html.escape(text)
+                    text = text.replace("\n", "<br />")
+                    yield text
+        except LLMQueueTimeout as e:
+            logger.info(f"[chemical_disease_qa] {e}")
+            yield "<br /><br />" + html.escape(busy_result_message)
+        except DeadlineExceeded as e:
+            logger.info(f"[chemical_disease_qa] {e}")
+            yield "<br /><br />" + html.escape(partial_result_message)
         yield "</div>"
         yield "<br /><br />"
         for line in reference_line_list:
@@ -3234,6 +3496,7 @@ def run_cgd_drug_discovery():
     logger.info(f"[run_cgd_drug_discovery] all_cds={all_cds:,}")
     returned_cds = len(cd_data)
     logger.info(f"[run_cgd_drug_discovery] returned_cds={returned_cds:,}")
+    is_partial = get_request_deadline().is_expired()
 
     # result table
     html_rank = html.escape(f"Top {returned_cds:,}/{all_cds:,}")
@@ -3318,6 +3581,8 @@ def run_cgd_drug_discovery():
                        f"</tr>")
 
     html_table += "</table>"
+    if is_partial:
+        html_table = f"<div>{html.escape(partial_result_message)}</div><br />" + html_table
     logger.info(f"[run_cgd_drug_discovery] result table created")
 
     response = {"result": html_table}
@@ -3351,12 +3616,14 @@ def query_cgd_drug_discovery():
     logger.info(f"[query_cgd_drug_discovery] all_cds={all_cds:,}")
     returned_cds = len(cd_data)
     logger.info(f"[query_cgd_drug_discovery] returned_cds={returned_cds:,}")
+    is_partial = get_request_deadline().is_expired()
 
     # result
     response = {
         "query": query,
         "all_cds": all_cds,
         "cd_data": cd_data,
+        "is_partial": is_partial,
     }
     return json.dumps(response)
 
@@ -3870,6 +4137,33 @@ def query_umls_impact_embedding_paper_search():
     return json.dumps(response)
 
 
+def get_pubmed_qa_html_chunk(event, data):
+    if event == "degraded":
+        return f'<div class="degraded">{html.escape(data)}</div><br />'
+    if event == "paper_list":
+        reference = pubmed_qa.get_reference(data, is_html=True)
+        return f'<div class="reference">{reference}</div><br /><div class="answer">'
+    return html.escape(data).replace("\n", "<br />")
+
+
+def get_pubmed_qa_ndjson_line(event, data):
+    if event == "degraded":
+        line = {"degraded": True, "message": data}
+    elif event == "paper_list":
+        line = {
+            "reference": pubmed_qa.get_reference(data, is_html=False),
+            "pmid_list": [pmid for pmid, _title, _abstract in data],
+        }
+    else:
+        line = {"text": data}
+    return json.dumps(line) + "\n"
+
+
+def is_ndjson_requested(query, accept):
+    # existing clients expect one JSON response, so streaming needs "stream": true or an ndjson Accept header
+    return query.get("stream", "application/x-ndjson" in (accept or ""))
+
+
 @app.route("/run_pubmed_qa", methods=["GET", "POST"])
 def run_pubmed_qa():
     # query
@@ -3881,8 +4175,19 @@ def run_pubmed_qa():
 
     text = query.get("query")
     level = query.get("level", None)
-    response = pubmed_qa.query(text, level=level, is_html=True)
-    return json.dumps(response)
+
+    if not query.get("stream", False):
+        response = pubmed_qa.query(text, level=level, is_html=True)
+        return json.dumps(response)
+
+    # opt-in: references as soon as retrieval finishes, then generated text as it arrives
+    def response():
+        for event, data in pubmed_qa.query_stream(text, level=level):
+            yield get_pubmed_qa_html_chunk(event, data)
+        yield "</div>"
+        return
+
+    return stream_with_context(response())
 
 
 @app.route("/query_pubmed_qa", methods=["GET", "POST"])
@@ -3896,7 +4201,173 @@ def query_pubmed_qa():
 
     text = query.get("query")
     level = query.get("level", None)
-    response = pubmed_qa.query(text, level=level, is_html=False)
+
+    # identical concurrent questions share one retrieval and generation
+    single_flight = get_single_flight(request.path)
+    key = get_request_key(request.path, query)
+
+    if not is_ndjson_requested(query, request.headers.get("Accept")):
+        response = single_flight.run(key, lambda: pubmed_qa.query(text, level=level, is_html=False))
+        return json.dumps(response)
+
+    # opt-in ndjson: {"reference": ..., "pmid_list": [...]} once retrieval finishes, then {"text": ...} chunks
+    def response():
+        stream = single_flight.stream(
+            key, lambda: pubmed_qa.query_stream(text, level=level),
+            partial_chunk=("text", f"\n\n{partial_result_message}"),
+        )
+        for event, data in stream:
+            yield get_pubmed_qa_ndjson_line(event, data)
+        return
+
+    return Response(stream_with_context(response()), mimetype="application/x-ndjson")
+
+
+@app.errorhandler(InvalidAPIKey)
+def handle_invalid_api_key(e):
+    logger.info(f"[litsum] {e}")
+    response = {"error": str(e)}
+    return json.dumps(response), 401
+
+
+@app.errorhandler(LLMQueueTimeout)
+def handle_llm_queue_timeout(e):
+    logger.info(f"[LLM Governor] {e}")
+    response = {"error": str(e)}
+    return json.dumps(response), 503, {"Retry-After": "10"}
+
+
+def get_valid_timeout(value):
+    # 0, negative, and non-finite values would lift the deadline, so they are ignored
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(timeout) or timeout <= 0:
+        return None
+    return timeout
+
+
+def get_body_timeout(data):
+    # POST arguments come as a JSON object in the body
+    try:
+        arg = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(arg, dict):
+        return arg.get("request_timeout")
+    return None
+
+
+def get_request_timeout(path, header_timeout, argument_timeout):
+    """
+    Timeout from the X-Request-Timeout header or the request_timeout argument,
+    else the default of the endpoint, else the "default" entry; at most max_request_timeout
+
+    :return: seconds, or None for no deadline
+    """
+    timeout = get_valid_timeout(request_timeout_dict.get(path, request_timeout_dict.get("default")))
+    for value in [argument_timeout, header_timeout]:
+        value = get_valid_timeout(value)
+        if value is not None:
+            timeout = value
+    if max_request_timeout:
+        timeout = min(timeout or max_request_timeout, max_request_timeout)
+    return timeout
+
+
+@app.before_request
+def set_deadline():
+    argument_timeout = request.args.get("request_timeout")
+    if argument_timeout is None and request.method == "POST":
+        argument_timeout = get_body_timeout(request.data)
+    timeout = get_request_timeout(request.path, request.headers.get("X-Request-Timeout"), argument_timeout)
+    set_request_deadline(Deadline(timeout))
+    return
+
+
+@app.errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(e):
+    logger.info(f"[Deadline] {request.path}: {e}")
+    response = {"error": str(e)}
+    return json.dumps(response), 504
+
+
+def get_cost_class(path):
+    return endpoint_to_cost_class.get(path, "cheap")
+
+
+def get_request_key(path, arg):
+    # identical requests differ at most in argument order and in their own deadline
+    arg = {name: value for name, value in arg.items() if name != "request_timeout"}
+    return json.dumps([path, arg], sort_keys=True)
+
+
+@app.before_request
+def admit_request():
+    # requests served through the ASGI app are admitted there
+    if bulkhead_context.get() is not None:
+        return
+    # a queued request would hold a server thread that cheap requests need, so it is rejected with 429 instead;
+    # the async server queues, as its waiting requests hold no thread
+    bulkhead = get_bulkhead(get_cost_class(request.path))
+    bulkhead.acquire(is_queued=False)
+    g.bulkhead = bulkhead
+    return
+
+
+@app.after_request
+def release_streamed_request(response):
+    # a streamed response holds its slot until the stream is exhausted or closed
+    if response.is_streamed and "bulkhead" in g:
+        response.call_on_close(g.pop("bulkhead").release)
+    return response
+
+
+@app.teardown_request
+def release_request(_exception):
+    bulkhead = g.pop("bulkhead", None)
+    if bulkhead is not None:
+        bulkhead.release()
+    return
+
+
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(e):
+    logger.info(f"[Admission] {request.path}: {e}")
+    response = {"error": str(e)}
+    return json.dumps(response), e.status, {"Retry-After": str(e.retry_after)}
+
+
+@app.route("/query_admission_stats", methods=["GET", "POST"])
+def query_admission_stats():
+    response = get_bulkhead_stats()
+    return json.dumps(response)
+
+
+@app.route("/query_single_flight_stats", methods=["GET", "POST"])
+def query_single_flight_stats():
+    response = get_single_flight_stats()
+    return json.dumps(response)
+
+
+@app.route("/query_llm_governor_stats", methods=["GET", "POST"])
+def query_llm_governor_stats():
+    response = get_llm_governor_stats()
+    return json.dumps(response)
+
+
+@app.route("/query_circuit_breaker_stats", methods=["GET", "POST"])
+def query_circuit_breaker_stats():
+    response = {
+        "embedding": umls_impact_embedding_paper_retriever.circuit_breaker.get_stats(),
+    }
+    return json.dumps(response)
+
+
+@app.route("/query_llm_cache_stats", methods=["GET", "POST"])
+def query_llm_cache_stats():
+    response = get_llm_cache_stats()
     return json.dumps(response)
 
 
@@ -3963,12 +4434,32 @@ class Arg:
         self.umls_dir = self.get_complete_path(raw_arg.get("umls_dir"))
         self.paper_impact_dir = self.get_complete_path(raw_arg.get("paper_impact_dir"))
         self.query_embedding = raw_arg.get("query_embedding")
+        self.query_embedding_backend = raw_arg.get("query_embedding_backend", "torch")
+        self.query_embedding_onnx_file = self.get_complete_path(raw_arg.get("query_embedding_onnx_file"))
+        self.query_embedding_max_length = raw_arg.get("query_embedding_max_length", 512)
+        self.query_embedding_socket = raw_arg.get("query_embedding_socket")
+        self.embedding_store_dir = self.get_complete_path(raw_arg.get("embedding_store_dir"))
+        self.embedding_circuit_breaker = raw_arg.get("embedding_circuit_breaker", {})
         self.qdrant_server = raw_arg.get("qdrant_server")
         self.qdrant_collection = raw_arg.get("qdrant_collection")
         self.paper_text_dir = self.get_complete_path(raw_arg.get("paper_text_dir"))
+        self.pubmed_qa_context_tokens = raw_arg.get("pubmed_qa_context_tokens", {})
         self.kb_type = raw_arg.get("kb_type")
         self.kb_dir = self.get_complete_path(raw_arg.get("kb_dir"))
         self.show_aid = raw_arg.get("show_aid", "false")
+        self.llm_cache_file = self.get_complete_path(raw_arg.get("llm_cache_file"))
+        self.llm_cache_ttl = raw_arg.get("llm_cache_ttl", 604800)
+        self.llm_cache_max_entries = raw_arg.get("llm_cache_max_entries", 100000)
+        self.litsum_workers = raw_arg.get("litsum_workers", 8)
+        self.litsum_requests_per_second = raw_arg.get("litsum_requests_per_second")
+        self.litsum_model = raw_arg.get("litsum_model", "gpt-4o")
+        self.litsum_prompt_version = raw_arg.get("litsum_prompt_version", 1)
+        self.llm_governor = raw_arg.get("llm_governor", {})
+        self.llm_governor_lock_dir = raw_arg.get("llm_governor_lock_dir")
+        self.request_timeout = raw_arg.get("request_timeout", {})
+        self.admission_control = raw_arg.get("admission_control", {})
+        self.endpoint_cost_class = raw_arg.get("endpoint_cost_class", {})
+        self.max_request_timeout = raw_arg.get("max_request_timeout", 600)
         return
 
     def get_complete_path(self, path):
@@ -4017,6 +4508,8 @@ def main():
         kb = KB(arg.kb_dir)
         kb.load_data()
         kb.load_index()
+        kb.load_umbrella_index()
+        kb.load_pmid_index()
         kb_type = arg.kb_type
 
     if arg.gvd_score_dir:
@@ -4080,13 +4573,20 @@ def main():
         global embedding_paper_retriever
         embedding_paper_retriever = EmbeddingPaperRetriever(
             arg.query_embedding, arg.qdrant_server, arg.qdrant_collection,
+            query_embedding_backend=arg.query_embedding_backend,
+            query_embedding_onnx_file=arg.query_embedding_onnx_file,
+            query_embedding_max_length=arg.query_embedding_max_length,
+            query_embedding_socket=arg.query_embedding_socket,
+            embedding_store_dir=arg.embedding_store_dir,
         )
 
     if arg.umls_dir and arg.paper_impact_dir and arg.query_embedding:
         global umls_impact_embedding_paper_retriever
+        # {"failure_threshold": ..., "slow_time": ..., "stage_timeout": ..., "recovery_time": ...}
         umls_impact_embedding_paper_retriever = UMLSImpactEmbeddingPaperRetriever(
             umls_impact_paper_retriever=umls_impact_paper_retriever,
             embedding_paper_retriever=embedding_paper_retriever,
+            circuit_breaker=CircuitBreaker("Embedding", **arg.embedding_circuit_breaker),
         )
 
     if arg.paper_text_dir:
@@ -4095,12 +4595,49 @@ def main():
 
     if arg.umls_dir and arg.paper_impact_dir and arg.query_embedding and arg.paper_text_dir:
         global pubmed_qa
-        pubmed_qa = PubMedQA(umls_impact_embedding_paper_retriever, paper_text)
+        # {"fedgpt-medium": ..., "gpt-4.1": ..., ...} overrides the default context budget of each model
+        pubmed_qa = PubMedQA(
+            umls_impact_embedding_paper_retriever, paper_text, umls_doc=umls_doc,
+            model_to_context_tokens=arg.pubmed_qa_context_tokens,
+        )
 
     if True:
         global show_aid
         show_aid = arg.show_aid == "true"
 
+    if arg.llm_cache_file:
+        configure_llm_cache(arg.llm_cache_file, ttl=arg.llm_cache_ttl, max_entries=arg.llm_cache_max_entries)
+
+    if True:
+        global litsum_executor, litsum_rate_limiter
+        litsum_executor = ThreadPoolExecutor(max_workers=arg.litsum_workers)
+        litsum_rate_limiter = RateLimiter(arg.litsum_requests_per_second)
+
+    if True:
+        global litsum_model, litsum_prompt_version
+        # bump litsum_prompt_version when the PaperGPT or ReviewGPT prompts change
+        litsum_model = arg.litsum_model
+        litsum_prompt_version = arg.litsum_prompt_version
+
+    # {"openai": {"requests_per_second": ..., "burst": ..., "max_in_flight": ..., "max_queue_time": ...}, "fedgpt": {...}}
+    for name, governor_arg in arg.llm_governor.items():
+        configure_llm_governor(name, lock_dir=arg.llm_governor_lock_dir, **governor_arg)
+
+    if True:
+        global request_timeout_dict, max_request_timeout
+        # {"default": ..., "/query_rel": ..., "/query_qa": ..., ...} in seconds;
+        # without "default", unlisted endpoints get max_request_timeout, and no deadline if that is 0 or null
+        request_timeout_dict = arg.request_timeout
+        max_request_timeout = arg.max_request_timeout
+
+    # {"/query_umls_doc": "heavy", ...} overrides endpoint_to_cost_class
+    endpoint_to_cost_class.update(arg.endpoint_cost_class)
+
+    # {"cheap": {"max_concurrent": ..., "max_queue": ..., "max_queue_time": ..., "retry_after": ...}, "heavy": {...}, "llm": {...}}
+    # max_queue and max_queue_time apply to asgi_server.py; the Flask server does not queue
+    for name, bulkhead_arg in arg.admission_control.items():
+        configure_bulkhead(name, **bulkhead_arg)
+
     logger.info("API loaded")
     return
 
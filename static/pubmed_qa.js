@@ -1,36 +1,53 @@
-function post_run(){
+async function post_run(){
     document.getElementById("div_status").innerHTML = "Loading...";
 
     query = document.getElementById("ta_query").value
     query = JSON.parse(query)
-    request_data = {"query": query};
-
-    fetch("./run_pubmed_qa", {method: "post", body: JSON.stringify(request_data)})
-    .then(function(response){
-        return response.json();
-    })
-    .then(function(response_data){
-        document.getElementById("div_result").innerHTML = response_data;
-        document.getElementById("div_status").innerHTML = "Ready";
-    })
+    request_data = {"query": {...query, "stream": true}};
+
+    const response = await fetch("./run_pubmed_qa", {method: "post", body: JSON.stringify(request_data)});
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    result = ""
+
+    while (true) {
+      const {value, done} = await reader.read();
+      if (done) break;
+      result += value
+      document.getElementById("div_result").innerHTML = result;
+    }
+    document.getElementById("div_status").innerHTML = "Ready";
 }
 
-function post_query(){
+async function post_query(){
     document.getElementById("div_status").innerHTML = "Loading...";
 
     query = document.getElementById("ta_query").value
     query = JSON.parse(query)
-    request_data = {"query": query};
-
-    fetch("./query_pubmed_qa", {method: "post", body: JSON.stringify(request_data)})
-    .then(function(response){
-        return response.json();
-    })
-    .then(function(response_data){
-        text = "<pre><code>" + JSON.stringify(response_data, null, 4) + "</code></pre>";
-        document.getElementById("div_result").innerHTML = text;
-        document.getElementById("div_status").innerHTML = "Ready";
-    })
+    request_data = {"query": {...query, "stream": true}};
+
+    const response = await fetch(
+        "./query_pubmed_qa",
+        {method: "post", headers: {"Accept": "application/x-ndjson"}, body: JSON.stringify(request_data)},
+    );
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    buffer = ""
+    line_list = []
+
+    while (true) {
+      const {value, done} = await reader.read();
+      if (done) break;
+      buffer += value
+
+      // one json object per line
+      lines = buffer.split("\n")
+      buffer = lines.pop()
+      for (const line of lines) {
+        if (line) line_list.push(JSON.parse(line));
+      }
+      text = "<pre><code>" + line_list.map(line => JSON.stringify(line)).join("\n") + "</code></pre>";
+      document.getElementById("div_result").innerHTML = text;
+    }
+    document.getElementById("div_status").innerHTML = "Ready";
 }
 
 function get_query(){